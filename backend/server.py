@@ -1,8 +1,17 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+import time
+# Taken before the framework imports so the startup timings include them
+IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, status, UploadFile, File
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, PyMongoError
+from pymongo.read_preferences import SecondaryPreferred
+import pymongo
 import os
 import logging
 from pathlib import Path
@@ -12,27 +21,792 @@ import uuid
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+try:
+    # Optional: verifies the same HS256 tokens several times faster than python-jose
+    import jwt as pyjwt
+except ImportError:
+    pyjwt = None
+from abc import ABC, abstractmethod
 import base64
+import csv
+import io
+import zlib
+import hashlib
+import hmac
+import asyncio
+import math
+import json
+import functools
+import heapq
+import itertools
+import random
+import threading
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, namedtuple, deque
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Database configuration
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+    "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "10")),
+    "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+    "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    # Dates are stored as BSON dates and read back as UTC-aware datetimes
+    "tz_aware": True,
+}
+# Per-request time budget for all Mongo work, by route class (0 disables)
+MONGO_TIME_BUDGETS_MS = {
+    "read": int(os.environ.get("MONGO_TIME_BUDGET_READ_MS", "2000")),
+    "write": int(os.environ.get("MONGO_TIME_BUDGET_WRITE_MS", "5000")),
+    "search": int(os.environ.get("MONGO_TIME_BUDGET_SEARCH_MS", "3000")),
+    "analytics": int(os.environ.get("MONGO_TIME_BUDGET_ANALYTICS_MS", "10000")),
+}
+# Admission control: priorities are "critical" (auth, order creation),
+# "normal" and "low" (search, analytics, leaderboards)
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "200"))
+ADMISSION_LATENCY_TARGET_MS = float(os.environ.get("ADMISSION_LATENCY_TARGET_MS", "1000"))
+ADMISSION_QUEUE_WAIT_MS = {
+    "critical": float(os.environ.get("ADMISSION_QUEUE_WAIT_CRITICAL_MS", "5000")),
+    "normal": float(os.environ.get("ADMISSION_QUEUE_WAIT_NORMAL_MS", "1000")),
+    "low": float(os.environ.get("ADMISSION_QUEUE_WAIT_LOW_MS", "0")),
+}
+REQUEST_DEADLINE_MS = {
+    "critical": float(os.environ.get("REQUEST_DEADLINE_CRITICAL_MS", "15000")),
+    "normal": float(os.environ.get("REQUEST_DEADLINE_NORMAL_MS", "10000")),
+    "low": float(os.environ.get("REQUEST_DEADLINE_LOW_MS", "5000")),
+}
+
+# Schema migrations: backfills run in batches with a pause between them.
+# Workers stay unready while any migration is pending; with
+# MIGRATE_ON_STARTUP one of them applies them (set it to false to only run
+# them with `python backend_migrate.py apply`)
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", "1000"))
+MIGRATION_BATCH_PAUSE_MS = float(os.environ.get("MIGRATION_BATCH_PAUSE_MS", "50"))
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "true").lower() == "true"
+
+# Message retention: messages older than MESSAGE_HOT_DAYS move to
+# per-conversation buckets in `messages_archive` (0 disables archival)
+MESSAGE_HOT_DAYS = int(os.environ.get("MESSAGE_HOT_DAYS", "90"))
+MESSAGE_ARCHIVE_BUCKET_SIZE = int(os.environ.get("MESSAGE_ARCHIVE_BUCKET_SIZE", "100"))
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.environ.get("MESSAGE_ARCHIVE_BATCH_SIZE", "1000"))
+MESSAGE_ARCHIVE_PAUSE_MS = float(os.environ.get("MESSAGE_ARCHIVE_PAUSE_MS", "200"))
+MESSAGE_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("MESSAGE_ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+# "Similar products": top-k neighbours per product from co-likes and order
+# co-occurrence, rebuilt fully every SIMILAR_REBUILD_SECONDS and refreshed
+# incrementally every SIMILAR_REFRESH_SECONDS (0 disables the job)
+SIMILAR_PRODUCTS_K = int(os.environ.get("SIMILAR_PRODUCTS_K", "20"))
+SIMILAR_ORDER_WEIGHT = float(os.environ.get("SIMILAR_ORDER_WEIGHT", "2.0"))
+SIMILAR_MAX_BASKET = int(os.environ.get("SIMILAR_MAX_BASKET", "200"))
+SIMILAR_REBUILD_SECONDS = int(os.environ.get("SIMILAR_REBUILD_SECONDS", "21600"))
+SIMILAR_REFRESH_SECONDS = int(os.environ.get("SIMILAR_REFRESH_SECONDS", "300"))
+
+# Home feed: candidate lists precomputed every FEED_REFRESH_SECONDS (0
+# disables the job) and blended per request with these weights
+FEED_SIZE = int(os.environ.get("FEED_SIZE", "20"))
+FEED_CANDIDATES = int(os.environ.get("FEED_CANDIDATES", "100"))
+FEED_NEARBY_STORES = int(os.environ.get("FEED_NEARBY_STORES", "10"))
+FEED_GRID_DEGREES = float(os.environ.get("FEED_GRID_DEGREES", "0.1"))
+FEED_TRENDING_DAYS = int(os.environ.get("FEED_TRENDING_DAYS", "7"))
+FEED_ORDER_WEIGHT = float(os.environ.get("FEED_ORDER_WEIGHT", "3.0"))
+FEED_WEIGHTS = {
+    "personal": float(os.environ.get("FEED_WEIGHT_PERSONAL", "1.0")),
+    "nearby": float(os.environ.get("FEED_WEIGHT_NEARBY", "0.8")),
+    "trending": float(os.environ.get("FEED_WEIGHT_TRENDING", "0.5")),
+}
+FEED_REFRESH_SECONDS = int(os.environ.get("FEED_REFRESH_SECONDS", "600"))
+FEED_REBUILD_SECONDS = int(os.environ.get("FEED_REBUILD_SECONDS", "86400"))
+FEED_CACHE_SIZE = int(os.environ.get("FEED_CACHE_SIZE", "10000"))
+FEED_CACHE_TTL_SECONDS = int(os.environ.get("FEED_CACHE_TTL_SECONDS", "300"))
+
+# Faceted browse: page size cap, price facet bucket boundaries and how long
+# facet counts for one filter combination are reused
+BROWSE_PAGE_MAX = int(os.environ.get("BROWSE_PAGE_MAX", "100"))
+BROWSE_PRICE_BUCKETS = [float(b) for b in os.environ.get("BROWSE_PRICE_BUCKETS", "0,50,100,250,500,1000").split(",")]
+BROWSE_DEFAULT_RADIUS_KM = float(os.environ.get("BROWSE_DEFAULT_RADIUS_KM", "10"))
+BROWSE_FACET_CACHE_SIZE = int(os.environ.get("BROWSE_FACET_CACHE_SIZE", "1000"))
+BROWSE_FACET_CACHE_TTL_SECONDS = int(os.environ.get("BROWSE_FACET_CACHE_TTL_SECONDS", "60"))
+# A store's products/services: page size when none is given (the old fixed cap) and the maximum
+STORE_CATALOGUE_PAGE_MAX = int(os.environ.get("STORE_CATALOGUE_PAGE_MAX", "1000"))
+
+# Store-owner order streams: events kept per store for Last-Event-ID replay,
+# how they reach other workers ("mongo" polls the log, "memory" is
+# single-process only) and the keep-alive interval
+ORDER_EVENT_LOG_SIZE = int(os.environ.get("ORDER_EVENT_LOG_SIZE", "500"))
+ORDER_EVENT_LOG_HOURS = int(os.environ.get("ORDER_EVENT_LOG_HOURS", "72"))
+ORDER_STREAM_BROKER = os.environ.get("ORDER_STREAM_BROKER", "mongo")
+ORDER_STREAM_POLL_MS = int(os.environ.get("ORDER_STREAM_POLL_MS", "1000"))
+ORDER_STREAM_HEARTBEAT_SECONDS = int(os.environ.get("ORDER_STREAM_HEARTBEAT_SECONDS", "15"))
+
+# Store-owner exports: documents per cursor batch, bytes per streamed chunk
+# and exports running at once per worker (others wait their turn)
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_BATCH_SIZE_MAX = int(os.environ.get("EXPORT_BATCH_SIZE_MAX", "10000"))
+EXPORT_CHUNK_BYTES = int(os.environ.get("EXPORT_CHUNK_BYTES", "65536"))
+EXPORT_MAX_CONCURRENT = int(os.environ.get("EXPORT_MAX_CONCURRENT", "4"))
+
+# Background jobs: concurrent jobs per worker, idle poll interval, how long a
+# claimed job is leased (and each run may take), retries with exponential
+# backoff, and how long finished jobs stay queryable
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "4"))
+JOB_POLL_MS = int(os.environ.get("JOB_POLL_MS", "1000"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get("JOB_RETRY_MAX_SECONDS", "600"))
+JOB_RETENTION_HOURS = int(os.environ.get("JOB_RETENTION_HOURS", "24"))
+
+# Public read-only endpoints may read from secondaries, at most this stale (90s minimum)
+MONGO_SECONDARY_READS = os.environ.get("MONGO_SECONDARY_READS", "true").lower() == "true"
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", "90"))
+
+# Slow query capture
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", "100"))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.environ.get("SLOW_QUERY_EXPLAIN_SAMPLE_RATE", "0.1"))
+SLOW_QUERY_BUFFER_SIZE = int(os.environ.get("SLOW_QUERY_BUFFER_SIZE", "200"))
+SLOW_QUERY_LOG_INTERVAL_SECONDS = int(os.environ.get("SLOW_QUERY_LOG_INTERVAL_SECONDS", "300"))
+# Distinct query shapes aggregated between two slow query log summaries
+SLOW_QUERY_SUMMARY_SHAPES = int(os.environ.get("SLOW_QUERY_SUMMARY_SHAPES", "1000"))
+
+# Startup warm-up: comma-separated public GET paths requested once, after the
+# Mongo pool is open, before /ready reports the worker ready
+WARMUP_PATHS = [path.strip() for path in os.environ.get(
+    "WARMUP_PATHS",
+    "/api/stores,/api/services,/api/analytics/popular-products,/api/analytics/top-rated-stores,"
+    "/api/browse/products,/api/browse/services,/api/browse/stores"
+).split(",") if path.strip()]
+
+# Bearer token the Prometheus scraper sends to /metrics; unset hides the endpoint
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Comma-separated emails allowed to use /api/admin endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email.strip()}
+
+# ==========================
+# INSTRUMENTATION
+# ==========================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricsRegistry:
+    """Minimal thread-safe metrics store rendered in the Prometheus text format.
+
+    Mongo command listeners run on Motor's executor threads, hence the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._histograms = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._meta[name] = (metric_type, help_text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        with self._lock:
+            key = (name, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, labels: tuple, value: float):
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, value: float, buckets: tuple = LATENCY_BUCKETS):
+        with self._lock:
+            key = (name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self) -> dict:
+        """Copy of the counter and gauge values, keyed by (name, labels)."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (h[0], list(h[1]), h[2], h[3]) for key, h in self._histograms.items()}
+        
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._format_labels(labels + (('le', bound),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("boral_http_requests_total", "counter", "HTTP requests by method, route and status code.")
+metrics.describe("boral_http_request_duration_seconds", "histogram", "HTTP request latency until the response starts.")
+metrics.describe("boral_http_request_db_seconds", "histogram", "Time spent in MongoDB commands per HTTP request.")
+metrics.describe("boral_http_requests_in_flight", "gauge", "HTTP requests currently being processed.")
+metrics.describe("boral_mongo_commands_total", "counter", "MongoDB commands by originating route and command.")
+metrics.describe("boral_mongo_command_seconds_total", "counter", "MongoDB command time by originating route and command.")
+metrics.describe("boral_mongo_documents_total", "counter", "Documents returned or affected by MongoDB commands.")
+metrics.describe("boral_mongo_slow_commands_total", "counter", "MongoDB commands slower than SLOW_QUERY_THRESHOLD_MS.")
+
+class RequestStats:
+    """Timings for one request, shared with Motor's executor threads via a context variable."""
+
+    __slots__ = ("route", "start", "db_seconds", "db_commands", "db_documents", "handler_seconds", "handler_end")
+
+    def __init__(self):
+        self.route = "<unmatched>"
+        self.start = time.perf_counter()
+        self.db_seconds = 0.0
+        self.db_commands = 0
+        self.db_documents = 0
+        self.handler_seconds = 0.0
+        self.handler_end = None
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+# time.monotonic() by which the current request must have finished
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+def request_time_remaining() -> Optional[float]:
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+_stats_lock = threading.Lock()
+
+def count_reply_documents(reply) -> int:
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if "n" in reply:
+        return int(reply["n"])
+    if "value" in reply:
+        return 1 if reply["value"] else 0
+    return 0
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Attributes MongoDB command time and document counts to the current request."""
+
+    def started(self, event):
+        pass
+
+    def _record(self, event, documents: int):
+        seconds = event.duration_micros / 1e6
+        stats = request_stats.get()
+        route = stats.route if stats else "<background>"
+        if stats:
+            with _stats_lock:
+                stats.db_seconds += seconds
+                stats.db_commands += 1
+                stats.db_documents += documents
+        labels = (("route", route), ("command", event.command_name))
+        metrics.inc("boral_mongo_commands_total", labels)
+        metrics.inc("boral_mongo_command_seconds_total", labels, seconds)
+        if documents:
+            metrics.inc("boral_mongo_documents_total", labels, documents)
+
+    def succeeded(self, event):
+        self._record(event, count_reply_documents(event.reply))
+
+    def failed(self, event):
+        self._record(event, 0)
+
+# Command fields kept when showing a slow query; payloads such as inserted
+# documents or update bodies (which may hold base64 images) are dropped.
+SLOW_QUERY_FIELDS = {
+    "find": ("filter", "sort", "projection", "limit", "skip"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"),
+    "update": ("updates",),
+    "delete": ("deletes",),
+}
+EXPLAINABLE_COMMANDS = set(SLOW_QUERY_FIELDS)
+# Fields that belong to the wire protocol rather than the query
+COMMAND_SESSION_FIELDS = {"lsid", "$db", "$clusterTime", "txnNumber", "$readPreference", "readConcern", "writeConcern"}
+
+def query_shape(value):
+    """Replace literal values with their type name so similar queries group together."""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [query_shape(item) for item in value[:3]]
+    return type(value).__name__
+
+class SlowQueryRecorder(monitoring.CommandListener):
+    """Captures MongoDB commands slower than a threshold into a bounded ring buffer.
+
+    A sample of them (and the first occurrence of every query shape) is
+    explained with the queryPlanner verbosity, which plans the query without
+    running it again.
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS, buffer_size: int = SLOW_QUERY_BUFFER_SIZE,
+                 sample_rate: float = SLOW_QUERY_EXPLAIN_SAMPLE_RATE):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.entries = deque(maxlen=buffer_size)
+        self.loop = None
+        # In-flight commands and the plans of explained shapes, shared by
+        # pymongo's listener threads and the event loop
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._explained = OrderedDict()
+        # Running per-shape aggregates since the last log_summary(), fed from pymongo's listener threads
+        self._summary_lock = threading.Lock()
+        self._summary = {}
+        self._summary_dropped = 0
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE_COMMANDS:
+            with self._lock:
+                if len(self._pending) >= 10000:
+                    # Never expected; drops the oldest, likely leaked by a dropped connection
+                    self._pending.popitem(last=False)
+                self._pending[(event.connection_id, event.request_id)] = (event.command, event.database_name)
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms or event.command_name == "explain":
+            return
+        self._record(event, duration_ms, pending)
+
+    def failed(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        duration_ms = event.duration_micros / 1000
+        if duration_ms >= self.threshold_ms and event.command_name != "explain":
+            self._record(event, duration_ms, pending, failed=True)
+
+    def _record(self, event, duration_ms: float, pending, failed: bool = False):
+        stats = request_stats.get()
+        route = stats.route if stats else "<background>"
+        command, database = pending if pending else ({}, event.database_name)
+        fields = SLOW_QUERY_FIELDS.get(event.command_name, ())
+        query = {field: command[field] for field in fields if field in command}
+        if event.command_name == "update":
+            query["updates"] = [{"q": update.get("q")} for update in query.get("updates", [])[:3]]
+        fingerprint = json.dumps(
+            [event.command_name, command.get(event.command_name), query_shape(query)], default=str, sort_keys=True
+        )
+        with self._lock:
+            plan_summary = self._explained.get(fingerprint)
+            # Checked and claimed together, so one thread explains a shape's first occurrence
+            explain = bool(pending) and self.loop is not None and (
+                fingerprint not in self._explained or random.random() < self.sample_rate
+            )
+            if explain:
+                self._explained[fingerprint] = plan_summary
+        
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "route": route,
+            "database": database,
+            "collection": command.get(event.command_name),
+            "command": event.command_name,
+            "duration_ms": round(duration_ms, 2),
+            "failed": failed,
+            "query": json.loads(json.dumps(query, default=str)),
+            "fingerprint": fingerprint,
+            "plan_summary": plan_summary,
+            "explain": None,
+        }
+        self.entries.append(entry)
+        with self._summary_lock:
+            if fingerprint in self._summary or len(self._summary) < SLOW_QUERY_SUMMARY_SHAPES:
+                self._accumulate(self._summary, entry)
+            else:
+                self._summary_dropped += 1
+        metrics.inc("boral_mongo_slow_commands_total", (("route", route), ("command", event.command_name)))
+        
+        if explain:
+            explain_spec = {key: value for key, value in command.items() if key not in COMMAND_SESSION_FIELDS}
+            self.loop.call_soon_threadsafe(asyncio.ensure_future, self._explain(entry, database, explain_spec))
+
+    async def _explain(self, entry: dict, database: str, spec: dict):
+        try:
+            result = await client[database].command({"explain": spec, "verbosity": "queryPlanner"})
+        except Exception as e:
+            entry["explain"] = {"error": str(e)}
+            return
+        winning_plan = result.get("queryPlanner", {}).get("winningPlan", {})
+        entry["explain"] = json.loads(json.dumps(winning_plan, default=str))
+        entry["plan_summary"] = summarize_plan(winning_plan)
+        with self._lock:
+            self._explained[entry["fingerprint"]] = entry["plan_summary"]
+            while len(self._explained) > 1000:
+                self._explained.popitem(last=False)
+
+    @staticmethod
+    def _accumulate(groups: dict, entry: dict):
+        group = groups.setdefault(entry["fingerprint"], {
+            "route": entry["route"],
+            "collection": entry["collection"],
+            "command": entry["command"],
+            "plan_summary": entry["plan_summary"],
+            "count": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+        })
+        group["count"] += 1
+        group["total_ms"] = round(group["total_ms"] + entry["duration_ms"], 2)
+        group["max_ms"] = max(group["max_ms"], entry["duration_ms"])
+        group["plan_summary"] = entry["plan_summary"] or group["plan_summary"]
+
+    def worst_offenders(self, entries, limit: int = 5) -> List[dict]:
+        groups = {}
+        for entry in entries:
+            self._accumulate(groups, entry)
+        return sorted(groups.values(), key=lambda group: group["total_ms"], reverse=True)[:limit]
+
+    def log_summary(self):
+        with self._summary_lock:
+            groups, self._summary = self._summary, {}
+            dropped, self._summary_dropped = self._summary_dropped, 0
+        with self._lock:
+            for fingerprint, group in groups.items():
+                # Explains finish after the command was recorded
+                group["plan_summary"] = group["plan_summary"] or self._explained.get(fingerprint)
+        worst = sorted(groups.values(), key=lambda group: group["total_ms"], reverse=True)[:5]
+        for group in worst:
+            logger.warning(
+                "Slow query: %s.%s from %s x%d total=%.1fms max=%.1fms plan=%s",
+                group["collection"], group["command"], group["route"], group["count"],
+                group["total_ms"], group["max_ms"], group["plan_summary"] or "unknown"
+            )
+        if dropped:
+            logger.warning("Slow query: %d more commands of unsummarised shapes", dropped)
+
+def summarize_plan(plan: dict) -> str:
+    """Flatten a winning plan into e.g. "FETCH > IXSCAN {store_id: 1}" or "COLLSCAN"."""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("keyPattern"):
+            stage += " " + json.dumps(plan["keyPattern"], default=str)
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(stages)
+
+slow_query_recorder = SlowQueryRecorder()
+
+# Route templates whose Mongo time budget differs from the method default
+# (GET -> "read", anything else -> "write")
+ROUTE_CLASSES = {
+    "/api/search": "search",
+    "/api/browse/{kind}": "search",
+    "/api/stores/{store_id}/analytics": "analytics",
+}
+
+class TimedRoute(APIRoute):
+    """Records the matched route template and the endpoint's own run time.
+
+    Also runs the whole request under a `pymongo.timeout` budget for its
+    route class, capped by the request deadline set by admission control, so
+    every Mongo call it makes (connection checkout included) carries the
+    remaining time as `maxTimeMS` and none can hang a request.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kw):
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kw)
+            finally:
+                stats = request_stats.get()
+                if stats:
+                    stats.handler_end = time.perf_counter()
+                    stats.handler_seconds += stats.handler_end - start
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path_format
+        route_class = ROUTE_CLASSES.get(route, "read" if self.methods == {"GET"} else "write")
+        budget_ms = MONGO_TIME_BUDGETS_MS.get(route_class)
+        budget = budget_ms / 1000 if budget_ms else None
+        
+        async def route_handler(request):
+            stats = request_stats.get()
+            if stats:
+                stats.route = route
+            timeout = budget
+            remaining = request_time_remaining()
+            if remaining is not None:
+                if remaining <= 0:
+                    raise HTTPException(status_code=503, detail="انتهت مهلة الطلب")
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            with pymongo.timeout(timeout):
+                return await handler(request)
+        return route_handler
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency, status codes and in-flight requests.
+
+    Adds a `Server-Timing` header splitting each response into db (Mongo
+    commands), handler (endpoint body, including its db time), serialize
+    (endpoint return to response start) and total.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status_code = 500
+        duration = None
+        self.in_flight += 1
+        metrics.set("boral_http_requests_in_flight", (), self.in_flight)
+        
+        async def send_wrapper(message):
+            nonlocal status_code, duration
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                duration = now - stats.start
+                status_code = message["status"]
+                timings = [f"db;dur={stats.db_seconds * 1000:.1f}"]
+                if stats.handler_end is not None:
+                    timings.append(f"handler;dur={stats.handler_seconds * 1000:.1f}")
+                    timings.append(f"serialize;dur={(now - stats.handler_end) * 1000:.1f}")
+                timings.append(f"total;dur={duration * 1000:.1f}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(timings).encode())
+                ]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+            self.in_flight -= 1
+            metrics.set("boral_http_requests_in_flight", (), self.in_flight)
+            if duration is None:
+                duration = time.perf_counter() - stats.start
+            route_labels = (("method", scope["method"]), ("route", stats.route))
+            metrics.inc("boral_http_requests_total", route_labels + (("status", status_code),))
+            metrics.observe("boral_http_request_duration_seconds", route_labels, duration)
+            metrics.observe("boral_http_request_db_seconds", route_labels, stats.db_seconds)
+
+metrics.describe("boral_mongo_pool_max_size", "gauge", "Configured maximum connections per Mongo server.")
+metrics.describe("boral_mongo_pool_connections", "gauge", "Open pooled connections per Mongo server.")
+metrics.describe("boral_mongo_pool_checked_out", "gauge", "Connections currently checked out per Mongo server.")
+metrics.describe("boral_mongo_pool_waiting", "gauge", "Operations waiting for a pooled connection per Mongo server.")
+metrics.describe("boral_mongo_pool_checkout_failures_total", "counter", "Failed connection checkouts by reason.")
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Tracks connection pool utilisation per server address."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gauges = {}
+
+    def _add(self, event, gauge: str, delta: int):
+        address = "%s:%s" % event.address
+        with self._lock:
+            key = (gauge, address)
+            value = self._gauges[key] = max(0, self._gauges.get(key, 0) + delta)
+        metrics.set(gauge, (("address", address),), value)
+
+    def pool_created(self, event):
+        metrics.set("boral_mongo_pool_max_size", (("address", "%s:%s" % event.address),),
+                    event.options.get("maxPoolSize", MONGO_CLIENT_OPTIONS["maxPoolSize"]))
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(event, "boral_mongo_pool_connections", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event, "boral_mongo_pool_connections", -1)
+
+    def connection_check_out_started(self, event):
+        self._add(event, "boral_mongo_pool_waiting", 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(event, "boral_mongo_pool_waiting", -1)
+        metrics.inc("boral_mongo_pool_checkout_failures_total",
+                    (("address", "%s:%s" % event.address), ("reason", str(event.reason))))
+
+    def connection_checked_out(self, event):
+        self._add(event, "boral_mongo_pool_waiting", -1)
+        self._add(event, "boral_mongo_pool_checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._add(event, "boral_mongo_pool_checked_out", -1)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=[MongoCommandMetrics(), slow_query_recorder, MongoPoolMetrics()],
+    **MONGO_CLIENT_OPTIONS
+)
 db = client[os.environ['DB_NAME']]
+# Read-only public endpoints (store lists, search, leaderboards) tolerate
+# slightly stale data, so they may be served by secondaries
+db_read = client.get_database(
+    os.environ['DB_NAME'],
+    read_preference=SecondaryPreferred(max_staleness=MONGO_MAX_STALENESS_SECONDS)
+) if MONGO_SECONDARY_READS else db
 
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-change-in-production-boral-2024")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+# Key rotation: "<kid>:<secret>,..." verification keys chosen by the token's
+# `kid` header, new tokens signed with JWT_ACTIVE_KID. Tokens without a kid
+# (and all tokens when JWT_ACTIVE_KID is unset) use SECRET_KEY.
+JWT_KEYS = dict(entry.split(":", 1) for entry in os.environ.get("JWT_KEYS", "").split(",") if ":" in entry)
+JWT_ACTIVE_KID = os.environ.get("JWT_ACTIVE_KID") or None
+if JWT_ACTIVE_KID and JWT_ACTIVE_KID not in JWT_KEYS:
+    raise RuntimeError(f"JWT_ACTIVE_KID {JWT_ACTIVE_KID!r} has no key in JWT_KEYS")
+# "pyjwt", "jose", or "auto" (PyJWT when installed)
+JWT_BACKEND = os.environ.get("JWT_BACKEND", "auto")
+# Verified tokens whose claims are reused until they expire
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", "10000"))
+# Email/username availability: a Bloom filter sized for this many users at
+# this false positive rate, refreshed with accounts other workers created or
+# changed every USER_FILTER_REFRESH_SECONDS (0 disables it: always query)
+USER_FILTER_CAPACITY = int(os.environ.get("USER_FILTER_CAPACITY", "1000000"))
+USER_FILTER_ERROR_RATE = float(os.environ.get("USER_FILTER_ERROR_RATE", "0.001"))
+USER_FILTER_REFRESH_SECONDS = int(os.environ.get("USER_FILTER_REFRESH_SECONDS", "5"))
+USER_FILTER_BATCH_SIZE = int(os.environ.get("USER_FILTER_BATCH_SIZE", "5000"))
+
+# Ownership cache
+STORE_OWNER_CACHE_SIZE = int(os.environ.get("STORE_OWNER_CACHE_SIZE", "10000"))
+# Other workers only learn of a deleted or new store when their entry expires
+STORE_OWNER_CACHE_TTL_SECONDS = int(os.environ.get("STORE_OWNER_CACHE_TTL_SECONDS", "60"))
+
+# Rate limiting ("<requests>/<seconds>" per route group, empty to disable)
+RATE_LIMITS = {
+    "auth": os.environ.get("RATE_LIMIT_AUTH", "10/60"),
+    # The signup form checks availability as the user types
+    "availability": os.environ.get("RATE_LIMIT_AVAILABILITY", "120/60"),
+    "search": os.environ.get("RATE_LIMIT_SEARCH", "60/60"),
+    "upload": os.environ.get("RATE_LIMIT_UPLOAD", "20/60"),
+    "default": os.environ.get("RATE_LIMIT_DEFAULT", "600/60"),
+}
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+# Reverse proxies in front of the app (1: the ingress). The client IP is the
+# X-Forwarded-For entry that many from the right, the one the outermost
+# trusted proxy saw; entries further left are client-supplied. Set 0 only
+# when clients connect directly.
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", "1"))
 
 security = HTTPBearer()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup() and shutdown() are defined in STARTUP, after everything they start
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
 # Create the main app
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+app = FastAPI(lifespan=lifespan)
+api_router = APIRouter(prefix="/api", route_class=TimedRoute)
+
+# ==========================
+# IDS
+# ==========================
+
+_id_lock = threading.Lock()
+_last_id_ms = 0
+_last_id_counter = 0
+
+def new_id(at: Optional[datetime] = None) -> str:
+    """Return a time-ordered UUIDv7 (RFC 9562) string for a new document.
+
+    The first 48 bits are the Unix time in milliseconds, so ids compare in
+    creation order both as strings and as UUIDs and inserts land on the
+    right-hand edge of every index on `id`. Within one millisecond the
+    12-bit counter after the version keeps ids from this process strictly
+    increasing. Pass `at` to mint an id for a past timestamp when
+    backfilling; those are not checked for monotonicity.
+    """
+    global _last_id_ms, _last_id_counter
+    if at is not None:
+        ms = int(at.timestamp() * 1000)
+        counter = random.getrandbits(12)
+    else:
+        with _id_lock:
+            ms = time.time_ns() // 1_000_000
+            if ms > _last_id_ms:
+                _last_id_ms, _last_id_counter = ms, random.getrandbits(11)
+            else:
+                _last_id_counter += 1
+                if _last_id_counter > 0xFFF:
+                    _last_id_ms, _last_id_counter = _last_id_ms + 1, 0
+            ms, counter = _last_id_ms, _last_id_counter
+    value = (ms & 0xFFFFFFFFFFFF) << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | int.from_bytes(os.urandom(8), "big") >> 2
+    return str(uuid.UUID(int=value))
+
+def id_created_at(doc_id: str) -> Optional[datetime]:
+    """Creation time encoded in a time-ordered id, None for legacy uuid4 ids"""
+    try:
+        parsed = uuid.UUID(doc_id)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if parsed.version != 7:
+        return None
+    return datetime.fromtimestamp((parsed.int >> 80) / 1000, tz=timezone.utc)
+
+def id_floor(at: datetime) -> str:
+    """Smallest time-ordered id minted at or after `at`, for range queries on `id`.
+
+    Legacy uuid4 ids carry no timestamp and fall anywhere in the range, so
+    collections that still hold them must keep filtering on `created_at`.
+    """
+    return str(uuid.UUID(int=(int(at.timestamp() * 1000) & 0xFFFFFFFFFFFF) << 80 | 0x7 << 76 | 0b10 << 62))
 
 # ==========================
 # MODELS
@@ -49,7 +823,7 @@ class UserCreate(UserBase):
 
 class User(UserBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     avatar: Optional[str] = None
     is_store_owner: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -80,13 +854,26 @@ class StoreCreate(StoreBase):
 
 class Store(StoreBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     owner_id: str
     rating: float = 0.0
     reviews_count: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class StoreSnapshot(BaseModel):
+    """Copy of the owning store's display fields embedded in products and services"""
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    name: str
+    owner_id: str
+    rating: float = 0.0
+    reviews_count: int = 0
+    address: str
+    latitude: float
+    longitude: float
+    logo: Optional[str] = None
+
 class ProductBase(BaseModel):
     name: str
     description: str
@@ -108,8 +895,9 @@ class ProductUpdate(BaseModel):
 
 class Product(ProductBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     store_id: str
+    store: Optional[StoreSnapshot] = None
     likes: int = 0
     liked_by: List[str] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -128,8 +916,9 @@ class ServiceCreate(ServiceBase):
 
 class Service(ServiceBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     store_id: str
+    store: Optional[StoreSnapshot] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class MessageBase(BaseModel):
@@ -141,7 +930,8 @@ class MessageCreate(MessageBase):
 
 class Message(MessageBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
+    conversation_id: Optional[str] = None
     sender_id: str
     is_read: bool = False
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -155,33 +945,42 @@ class ReviewCreate(ReviewBase):
 
 class Review(ReviewBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     store_id: str
     user_id: str
     user_name: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
-class OrderItemBase(BaseModel):
+class OrderItemCreate(BaseModel):
     product_id: Optional[str] = None
     service_id: Optional[str] = None
-    quantity: int = 1
+    quantity: int = Field(default=1, ge=1)
+
+class OrderItemBase(OrderItemCreate):
     price: float
     name: str
 
 class OrderBase(BaseModel):
     store_id: str
-    items: List[OrderItemBase]
-    total: float
     notes: Optional[str] = None
 
 class OrderCreate(OrderBase):
-    pass
+    # Prices and the total are computed server-side; client-sent values are ignored
+    items: List[OrderItemCreate]
+
+class OrderStatusChange(BaseModel):
+    status: str
+    changed_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    changed_by: Optional[str] = None
 
 class Order(OrderBase):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
+    items: List[OrderItemBase]
+    total: float
     order_status: str = "pending"  # pending, confirmed, completed, cancelled
+    status_history: List[OrderStatusChange] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ==========================
@@ -194,17 +993,106 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class JoseBackend:
+    def encode(self, claims: dict, key: str, headers: Optional[dict]) -> str:
+        return jwt.encode(claims, key, algorithm=ALGORITHM, headers=headers)
+
+    def kid(self, token: str) -> Optional[str]:
+        return jwt.get_unverified_header(token).get("kid")
+
+    def decode(self, token: str, key: str) -> dict:
+        return jwt.decode(token, key, algorithms=[ALGORITHM])
+
+class PyJWTBackend:
+    """PyJWT, with its errors raised as jose's JWTError so callers handle one type"""
+
+    def encode(self, claims: dict, key: str, headers: Optional[dict]) -> str:
+        return pyjwt.encode(claims, key, algorithm=ALGORITHM, headers=headers)
+
+    def kid(self, token: str) -> Optional[str]:
+        try:
+            return pyjwt.get_unverified_header(token).get("kid")
+        except pyjwt.PyJWTError as exc:
+            raise JWTError(str(exc)) from exc
+
+    def decode(self, token: str, key: str) -> dict:
+        try:
+            return pyjwt.decode(token, key, algorithms=[ALGORITHM])
+        except pyjwt.PyJWTError as exc:
+            raise JWTError(str(exc)) from exc
+
+def jwt_backend(name: str = JWT_BACKEND):
+    if name == "pyjwt" or (name == "auto" and pyjwt is not None):
+        return PyJWTBackend()
+    return JoseBackend()
+
+token_backend = jwt_backend()
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of token hash -> verified claims, each entry dropped at the token's `exp`.
+
+    Tokens live for days and are presented on every request, so most
+    requests skip signature verification entirely.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        claims, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return claims
+
+    def set(self, token: str, claims: dict):
+        if not isinstance(claims.get("exp"), (int, float)):
+            return
+        key = self.key(token)
+        self._entries[key] = (claims, claims["exp"])
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+verified_tokens = VerifiedTokenCache(JWT_CACHE_SIZE)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    if JWT_ACTIVE_KID:
+        return token_backend.encode(to_encode, JWT_KEYS[JWT_ACTIVE_KID], {"kid": JWT_ACTIVE_KID})
+    return token_backend.encode(to_encode, SECRET_KEY, None)
+
+def decode_access_token(token: str) -> dict:
+    """Verified claims of a token, from the cache when it has been seen before; raises JWTError"""
+    claims = verified_tokens.get(token)
+    if claims is None:
+        kid = token_backend.kid(token)
+        if kid is None:
+            key = SECRET_KEY
+        elif kid in JWT_KEYS:
+            key = JWT_KEYS[kid]
+        else:
+            raise JWTError("Unknown signing key")
+        claims = token_backend.decode(token, key)
+        verified_tokens.set(token, claims)
+    return claims
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
@@ -215,35 +1103,470 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     if user_doc is None:
         raise HTTPException(status_code=401, detail="User not found")
     
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    
     return User(**user_doc)
 
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if current_user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="غير مصرح")
+    return current_user
+
+# ==========================
+# OWNERSHIP UTILITIES
+# ==========================
+
+class StoreOwnerCache:
+    """Bounded LRU cache of store_id -> owner_id and owner_id -> owned store ids.
+
+    A store's owner never changes, so entries only need dropping when a store
+    is created or deleted. This worker drops them straight away; entries on
+    other workers expire after `ttl` seconds, and writes that need the store
+    document itself re-check that it still exists.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = STORE_OWNER_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._owners = OrderedDict()
+        self._stores = OrderedDict()
+
+    def _get(self, data: OrderedDict, key):
+        entry = data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del data[key]
+            return None
+        data.move_to_end(key)
+        return value
+
+    def _put(self, data: OrderedDict, key, value):
+        data[key] = (time.monotonic() + self.ttl, value)
+        data.move_to_end(key)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def get_owner(self, store_id: str) -> Optional[str]:
+        return self._get(self._owners, store_id)
+
+    def set_owner(self, store_id: str, owner_id: str):
+        self._put(self._owners, store_id, owner_id)
+
+    def get_stores(self, owner_id: str) -> Optional[List[str]]:
+        return self._get(self._stores, owner_id)
+
+    def set_stores(self, owner_id: str, store_ids: List[str]):
+        self._put(self._stores, owner_id, list(store_ids))
+        for store_id in store_ids:
+            self.set_owner(store_id, owner_id)
+
+    def add_store(self, store_id: str, owner_id: str):
+        self.set_owner(store_id, owner_id)
+        store_ids = self._get(self._stores, owner_id)
+        if store_ids is not None and store_id not in store_ids:
+            store_ids.append(store_id)
+
+    def forget_owner(self, owner_id: str):
+        self._stores.pop(owner_id, None)
+
+    def forget_store(self, store_id: str):
+        entry = self._owners.pop(store_id, None)
+        if entry is not None:
+            self.forget_owner(entry[1])
+
+store_owner_cache = StoreOwnerCache(STORE_OWNER_CACHE_SIZE)
+
+async def get_store_owner_id(store_id: str) -> Optional[str]:
+    owner_id = store_owner_cache.get_owner(store_id)
+    if owner_id is None:
+        store = await db.stores.find_one({"id": store_id}, {"_id": 0, "owner_id": 1})
+        if not store:
+            return None
+        owner_id = store['owner_id']
+        store_owner_cache.set_owner(store_id, owner_id)
+    return owner_id
+
+async def get_owned_store_ids(owner_id: str) -> List[str]:
+    store_ids = store_owner_cache.get_stores(owner_id)
+    if store_ids is None:
+        stores = await db.stores.find({"owner_id": owner_id}, {"_id": 0, "id": 1}).to_list(None)
+        store_ids = [store['id'] for store in stores]
+        store_owner_cache.set_stores(owner_id, store_ids)
+    return store_ids
+
+def require_store_owner(detail: str = "غير مصرح", hide_missing: bool = False):
+    """Dependency factory checking that the current user owns the `store_id` path parameter.
+
+    With `hide_missing` a missing store is reported as 403 rather than 404.
+    """
+    async def dependency(store_id: str, current_user: User = Depends(get_current_user)) -> User:
+        owner_id = await get_store_owner_id(store_id)
+        if owner_id is None and not hide_missing:
+            raise HTTPException(status_code=404, detail="المتجر غير موجود")
+        if owner_id != current_user.id:
+            raise HTTPException(status_code=403, detail=detail)
+        return current_user
+    return dependency
+
+async def owned_write(collection, doc_id: str, current_user: User, operation, not_found: str, forbidden: str,
+                      conflict: str = "تعذر تحديث العنصر، حاول مرة أخرى"):
+    """Run `operation(filter)` scoped to the stores the current user owns.
+
+    The filter combines the document id with the owned store ids, so the hot
+    path is a single round trip. Only when nothing matched is the document
+    looked up again to tell 404 from 403; a stale owned-stores entry (e.g. a
+    store created on another worker) is refreshed and retried once. If the
+    user does own the document, the operation's own conditions rejected it
+    and a 409 is raised.
+    """
+    for attempt in range(2):
+        owned = await get_owned_store_ids(current_user.id)
+        result = await operation({"id": doc_id, "store_id": {"$in": owned}})
+        if result:
+            return result
+        doc = await collection.find_one({"id": doc_id}, {"_id": 0, "store_id": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail=not_found)
+        if await get_store_owner_id(doc['store_id']) != current_user.id:
+            raise HTTPException(status_code=403, detail=forbidden)
+        if attempt or doc['store_id'] in owned:
+            raise HTTPException(status_code=409, detail=conflict)
+        store_owner_cache.forget_owner(current_user.id)
+
+# ==========================
+# STORE SNAPSHOTS
+# ==========================
+
+STORE_SNAPSHOT_FIELDS = ("id", "name", "owner_id", "rating", "reviews_count", "address", "latitude", "longitude", "logo")
+STORE_SNAPSHOT_PROJECTION = {"_id": 0, "snapshot_version": 1, **{field: 1 for field in STORE_SNAPSHOT_FIELDS}}
+
+def store_snapshot(store: dict) -> dict:
+    """The `store` field embedded in the store's products and services.
+
+    `version` mirrors the store's `snapshot_version`, which every write to a
+    snapshot field increments, so a slower fan-out can never overwrite a
+    newer snapshot.
+    """
+    snapshot = {field: store.get(field) for field in STORE_SNAPSHOT_FIELDS}
+    snapshot['version'] = store.get('snapshot_version', 0)
+    return snapshot
+
+async def fan_out_store_snapshot(store: dict):
+    """Refresh the embedded snapshot on all of a store's products and services, one update_many per collection"""
+    snapshot = store_snapshot(store)
+    query = {"store_id": store['id'], "store.version": {"$not": {"$gte": snapshot['version']}}}
+    await asyncio.gather(
+        db.products.update_many(query, {"$set": {"store": snapshot}}),
+        db.services.update_many(query, {"$set": {"store": snapshot}}),
+    )
+
+async def attach_store_snapshots(docs: List[dict]) -> List[dict]:
+    """Fill in `store` on documents written before snapshots existed, with one query for all of them"""
+    missing = {doc['store_id'] for doc in docs if not doc.get('store')}
+    if missing:
+        stores = await db_read.stores.find({"id": {"$in": list(missing)}}, STORE_SNAPSHOT_PROJECTION).to_list(len(missing))
+        snapshots = {store['id']: store_snapshot(store) for store in stores}
+        for doc in docs:
+            if not doc.get('store'):
+                doc['store'] = snapshots.get(doc['store_id'])
+    return docs
+
+# ==========================
+# BACKGROUND JOBS
+# ==========================
+
+# Side effects that need not delay the response are queued in `jobs` and
+# run after it by a JobRunner on every worker. A job is claimed with a
+# lease, so one left behind by a crashed or restarted worker is picked up
+# again once its lease expires. Jobs run at least once: handlers must be
+# safe to repeat.
+
+job_handlers = {}
+
+def job(name: str):
+    """Register an async handler for jobs of type `name`, called with the job's args as keywords"""
+    def register(handler):
+        job_handlers[name] = handler
+        return handler
+    return register
+
+class JobRunner:
+    """Claims due jobs from `jobs` and runs up to `concurrency` of them at once"""
+
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, poll_interval: float = JOB_POLL_MS / 1000,
+                 lease_seconds: float = JOB_LEASE_SECONDS):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.owner = new_id()
+        self._wake = asyncio.Event()
+        self._running = set()
+        self._task = None
+
+    def wake(self):
+        """Look for work now rather than at the next poll, e.g. right after enqueueing"""
+        self._wake.set()
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {"status": "running", "owner": self.owner, "lease_until": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def execute(self, job_doc: dict):
+        started = time.perf_counter()
+        handler = job_handlers.get(job_doc['name'])
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job {job_doc['name']!r}")
+            with pymongo.timeout(self.lease_seconds):
+                await handler(**job_doc.get('args', {}))
+        except Exception as exc:
+            attempts = job_doc['attempts']
+            final = handler is None or attempts >= job_doc.get('max_attempts', JOB_MAX_ATTEMPTS)
+            now = datetime.now(timezone.utc)
+            update = {"status": "failed" if final else "queued", "error": f"{type(exc).__name__}: {exc}"}
+            if final:
+                update['finished_at'] = now
+                logger.exception("Job %s (%s) failed after %d attempts", job_doc['_id'], job_doc['name'], attempts)
+            else:
+                delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+                update['run_at'] = now + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+            status = update['status']
+        else:
+            update = {"status": "done", "finished_at": datetime.now(timezone.utc)}
+            status = "done"
+        metrics.inc("boral_jobs_total", (("name", job_doc['name']), ("status", status)))
+        metrics.observe("boral_job_seconds", (("name", job_doc['name']),), time.perf_counter() - started)
+        try:
+            await db.jobs.update_one({"_id": job_doc['_id'], "owner": self.owner}, {"$set": update})
+        except PyMongoError:
+            logger.exception("Could not record the outcome of job %s", job_doc['_id'])
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            try:
+                while len(self._running) < self.concurrency:
+                    job_doc = await self.claim()
+                    if job_doc is None:
+                        break
+                    task = asyncio.create_task(self.execute(job_doc))
+                    self._running.add(task)
+                    task.add_done_callback(self._finished)
+            except Exception:
+                logger.exception("Claiming jobs failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _finished(self, task):
+        self._running.discard(task)
+        self._wake.set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Running jobs are abandoned to their lease and retried elsewhere
+        if self._task:
+            self._task.cancel()
+        for task in list(self._running):
+            task.cancel()
+
+job_runner = JobRunner()
+
+metrics.describe("boral_jobs_total", "counter", "Background job runs by outcome")
+metrics.describe("boral_job_seconds", "histogram", "Background job run time")
+
+async def enqueue_job(name: str, args: dict, key: Optional[str] = None, user_id: Optional[str] = None,
+                      delay: float = 0, max_attempts: int = JOB_MAX_ATTEMPTS) -> str:
+    """Queue a job and return its id.
+
+    `key` makes enqueueing idempotent: a job with the same key is queued at
+    most once, and the existing job's id is returned for repeats.
+    """
+    now = datetime.now(timezone.utc)
+    doc = {
+        "_id": key or new_id(),
+        "name": name,
+        "args": args,
+        "user_id": user_id,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_at": now + timedelta(seconds=delay),
+        "created_at": now,
+    }
+    try:
+        await db.jobs.insert_one(doc)
+    except DuplicateKeyError:
+        if key is None:
+            raise
+        return key
+    job_runner.wake()
+    return doc['_id']
+
+# ==========================
+# ACCOUNT NAMES
+# ==========================
+
+# Every worker keeps a Bloom filter of the emails and usernames in use, so
+# the signup form's live availability check skips Mongo for names never
+# used; possible hits (and every check before the first load) go to one
+# indexed `$or` query. Names freed by a profile change stay in the filter and
+# just cost that query. The filter only sees other workers' accounts once it
+# refreshes, so it is a hint: uniqueness itself is enforced by the unique
+# `email` and `username` indexes when register and update_profile write.
+
+class BloomFilter:
+    """Probabilistic set: no false negatives, false positives at `error_rate` up to `capacity` values"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+class AccountNames:
+    """The worker's filter of account emails and usernames, loaded and refreshed by maintain_account_names"""
+
+    FIELDS = ("email", "username")
+
+    def __init__(self):
+        self.filter: Optional[BloomFilter] = None
+        self.synced_at: Optional[datetime] = None
+
+    def add(self, user_doc: dict, bloom: Optional[BloomFilter] = None):
+        bloom = bloom or self.filter
+        if bloom is None:
+            return
+        for field in self.FIELDS:
+            if user_doc.get(field):
+                bloom.add(f"{field}:{user_doc[field]}")
+
+    def might_exist(self, field: str, value: str) -> bool:
+        return self.filter is None or f"{field}:{value}" in self.filter
+
+    async def _stream(self, query: dict, bloom: Optional[BloomFilter] = None):
+        cursor = db.users.find(query, {"_id": 0, "email": 1, "username": 1}).batch_size(USER_FILTER_BATCH_SIZE)
+        async for user_doc in cursor:
+            self.add(user_doc, bloom)
+
+    async def load(self):
+        """Build a new filter from every account, sized for twice the current count if that exceeds capacity.
+
+        The current filter keeps answering until the new one is complete.
+        """
+        started = datetime.now(timezone.utc)
+        users = await db.users.estimated_document_count()
+        bloom = BloomFilter(len(self.FIELDS) * max(USER_FILTER_CAPACITY, 2 * users), USER_FILTER_ERROR_RATE)
+        await self._stream({}, bloom)
+        self.filter = bloom
+        self.synced_at = started
+        # Accounts this worker added to the old filter while the new one streamed
+        await self.refresh()
+        logger.info("Account name filter loaded: %d users, %d KiB", users, len(bloom.bits) // 1024)
+
+    async def refresh(self):
+        """Add accounts created or changed since the last sync; rebuild once the filter is over capacity"""
+        if self.filter.count > self.filter.capacity:
+            await self.load()
+            return
+        started = datetime.now(timezone.utc)
+        # Overlap by a refresh interval so clock skew between workers can't drop a change
+        await self._stream({"updated_at": {"$gte": self.synced_at - timedelta(seconds=USER_FILTER_REFRESH_SECONDS)}})
+        self.synced_at = started
+
+account_names = AccountNames()
+
+async def maintain_account_names():
+    # The first load is part of warm_up()
+    while True:
+        await asyncio.sleep(USER_FILTER_REFRESH_SECONDS)
+        try:
+            if account_names.filter is None:
+                await account_names.load()
+            else:
+                await account_names.refresh()
+        except Exception:
+            logger.exception("Account name filter refresh failed")
+
+async def taken_account_names(**values: Optional[str]) -> dict:
+    """Whether each given email/username is used by an account, querying only the filter's possible hits"""
+    values = {field: value for field, value in values.items() if value is not None}
+    possible = {field: value for field, value in values.items() if account_names.might_exist(field, value)}
+    metrics.inc("boral_account_name_checks_total", (("result", "queried" if possible else "filtered"),))
+    if not possible:
+        return {field: False for field in values}
+    
+    user_docs = await db.users.find(
+        {"$or": [{field: value} for field, value in possible.items()]},
+        {"_id": 0, "email": 1, "username": 1}
+    ).to_list(None)
+    return {
+        field: any(user_doc.get(field) == value for user_doc in user_docs)
+        for field, value in values.items()
+    }
+
+metrics.describe("boral_account_name_checks_total", "counter", "Email/username checks answered by the filter or by a query")
+
 # ==========================
 # AUTH ROUTES
 # ==========================
 
+async def duplicate_account_error(exc: DuplicateKeyError, email: str, user_id: str) -> HTTPException:
+    """The 400 for an email or username already taken, from the unique index the write hit"""
+    key_pattern = (exc.details or {}).get("keyPattern")
+    if key_pattern is None:
+        # Servers before 4.2 don't say which index; look the email up instead
+        key_pattern = {"email": 1} if await db.users.find_one({"email": email, "id": {"$ne": user_id}}, {"_id": 1}) else {}
+    if "email" in key_pattern:
+        return HTTPException(status_code=400, detail="البريد الإلكتروني مسجل بالفعل")
+    return HTTPException(status_code=400, detail="اسم المستخدم مستخدم بالفعل")
+
 @api_router.post("/auth/register", response_model=Token)
 async def register(user_data: UserCreate):
-    existing_user = await db.users.find_one({"email": user_data.email})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="البريد الإلكتروني مسجل بالفعل")
-    
-    existing_username = await db.users.find_one({"username": user_data.username})
-    if existing_username:
-        raise HTTPException(status_code=400, detail="اسم المستخدم مستخدم بالفعل")
-    
     user_dict = user_data.model_dump(exclude={"password"})
     user_obj = User(**user_dict)
     
     hashed_password = get_password_hash(user_data.password)
     
     doc = user_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     doc['password_hash'] = hashed_password
+    doc['updated_at'] = user_obj.created_at
     
-    await db.users.insert_one(doc)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError as exc:
+        raise await duplicate_account_error(exc, user_obj.email, user_obj.id)
+    account_names.add(doc)
     
     access_token = create_access_token(data={"sub": user_obj.id})
     
@@ -258,15 +1581,21 @@ async def login(credentials: UserLogin):
     if not verify_password(credentials.password, user_doc['password_hash']):
         raise HTTPException(status_code=401, detail="البريد الإلكتروني أو كلمة المرور غير صحيحة")
     
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-    
     user_obj = User(**{k: v for k, v in user_doc.items() if k != 'password_hash'})
     
     access_token = create_access_token(data={"sub": user_obj.id})
     
     return Token(access_token=access_token, token_type="bearer", user=user_obj)
 
+@api_router.get("/auth/availability")
+async def check_availability(email: Optional[str] = None, username: Optional[str] = None):
+    """Whether an email and/or username can still be registered, for live checks on the signup form"""
+    if email is None and username is None:
+        raise HTTPException(status_code=400, detail="يجب تحديد البريد الإلكتروني أو اسم المستخدم")
+    
+    taken = await taken_account_names(email=email, username=username)
+    return {field: not is_taken for field, is_taken in taken.items()}
+
 @api_router.get("/auth/me", response_model=User)
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
@@ -288,14 +1617,17 @@ async def get_user_info(user_id: str):
 @api_router.put("/auth/profile", response_model=User)
 async def update_profile(user_data: UserBase, current_user: User = Depends(get_current_user)):
     update_data = user_data.model_dump()
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": update_data}
-    )
+    update_data['updated_at'] = datetime.now(timezone.utc)
+    try:
+        await db.users.update_one(
+            {"id": current_user.id},
+            {"$set": update_data}
+        )
+    except DuplicateKeyError as exc:
+        raise await duplicate_account_error(exc, user_data.email, current_user.id)
     
     updated_user = await db.users.find_one({"id": current_user.id}, {"_id": 0})
-    if isinstance(updated_user.get('created_at'), str):
-        updated_user['created_at'] = datetime.fromisoformat(updated_user['created_at'])
+    account_names.add(updated_user)
     
     return User(**{k: v for k, v in updated_user.items() if k != 'password_hash'})
 
@@ -332,13 +1664,7 @@ async def get_stores(category: Optional[str] = None, search: Optional[str] = Non
             {'description': {'$regex': search, '$options': 'i'}}
         ]
     
-    stores = await db.stores.find(query, {"_id": 0}).to_list(1000)
-    
-    for store in stores:
-        if isinstance(store.get('created_at'), str):
-            store['created_at'] = datetime.fromisoformat(store['created_at'])
-        if isinstance(store.get('updated_at'), str):
-            store['updated_at'] = datetime.fromisoformat(store['updated_at'])
+    stores = await db_read.stores.find(query, {"_id": 0}).to_list(1000)
     
     return stores
 
@@ -348,11 +1674,6 @@ async def get_store(store_id: str):
     if not store:
         raise HTTPException(status_code=404, detail="المتجر غير موجود")
     
-    if isinstance(store.get('created_at'), str):
-        store['created_at'] = datetime.fromisoformat(store['created_at'])
-    if isinstance(store.get('updated_at'), str):
-        store['updated_at'] = datetime.fromisoformat(store['updated_at'])
-    
     return Store(**store)
 
 @api_router.post("/stores", response_model=Store)
@@ -362,68 +1683,56 @@ async def create_store(store_data: StoreCreate, current_user: User = Depends(get
     store_obj = Store(**store_dict)
     
     doc = store_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.stores.insert_one(doc)
+    store_owner_cache.add_store(store_obj.id, current_user.id)
     
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"is_store_owner": True}}
-    )
+    if not current_user.is_store_owner:
+        await enqueue_job("mark_store_owner", {"user_id": current_user.id}, key=f"mark_store_owner:{current_user.id}",
+                          user_id=current_user.id)
     
     return store_obj
 
+@job("mark_store_owner")
+async def mark_store_owner(user_id: str):
+    await db.users.update_one({"id": user_id}, {"$set": {"is_store_owner": True}})
+
 @api_router.put("/stores/{store_id}", response_model=Store)
-async def update_store(store_id: str, store_data: StoreCreate, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
-        raise HTTPException(status_code=404, detail="المتجر غير موجود")
-    
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بتعديل هذا المتجر")
-    
+async def update_store(store_id: str, store_data: StoreCreate, current_user: User = Depends(require_store_owner("غير مصرح لك بتعديل هذا المتجر"))):
     update_data = store_data.model_dump()
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
-    await db.stores.update_one(
+    updated_store = await db.stores.find_one_and_update(
         {"id": store_id},
-        {"$set": update_data}
+        {"$set": update_data, "$inc": {"snapshot_version": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    
-    updated_store = await db.stores.find_one({"id": store_id}, {"_id": 0})
-    if isinstance(updated_store.get('created_at'), str):
-        updated_store['created_at'] = datetime.fromisoformat(updated_store['created_at'])
-    if isinstance(updated_store.get('updated_at'), str):
-        updated_store['updated_at'] = datetime.fromisoformat(updated_store['updated_at'])
+    await fan_out_store_snapshot(updated_store)
     
     return Store(**updated_store)
 
 @api_router.delete("/stores/{store_id}")
-async def delete_store(store_id: str, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
-        raise HTTPException(status_code=404, detail="المتجر غير موجود")
-    
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بحذف هذا المتجر")
-    
+async def delete_store(store_id: str, current_user: User = Depends(require_store_owner("غير مصرح لك بحذف هذا المتجر"))):
     await db.stores.delete_one({"id": store_id})
-    await db.products.delete_many({"store_id": store_id})
-    await db.services.delete_many({"store_id": store_id})
+    store_owner_cache.forget_store(store_id)
+    job_id = await enqueue_job(
+        "delete_store_catalogue", {"store_id": store_id}, key=f"delete_store_catalogue:{store_id}", user_id=current_user.id
+    )
     
-    return {"message": "تم حذف المتجر بنجاح"}
+    return {"message": "تم حذف المتجر بنجاح", "job_id": job_id}
+
+@job("delete_store_catalogue")
+async def delete_store_catalogue(store_id: str):
+    await asyncio.gather(
+        db.products.delete_many({"store_id": store_id}),
+        db.services.delete_many({"store_id": store_id}),
+    )
 
 @api_router.get("/stores/owner/my-stores", response_model=List[Store])
 async def get_my_stores(current_user: User = Depends(get_current_user)):
     stores = await db.stores.find({"owner_id": current_user.id}, {"_id": 0}).to_list(100)
     
-    for store in stores:
-        if isinstance(store.get('created_at'), str):
-            store['created_at'] = datetime.fromisoformat(store['created_at'])
-        if isinstance(store.get('updated_at'), str):
-            store['updated_at'] = datetime.fromisoformat(store['updated_at'])
-    
     return stores
 
 # ==========================
@@ -431,80 +1740,79 @@ async def get_my_stores(current_user: User = Depends(get_current_user)):
 # ==========================
 
 @api_router.get("/stores/{store_id}/products", response_model=List[Product])
-async def get_store_products(store_id: str):
-    products = await db.products.find({"store_id": store_id}, {"_id": 0}).to_list(1000)
-    
-    for product in products:
-        if isinstance(product.get('created_at'), str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
-        if isinstance(product.get('updated_at'), str):
-            product['updated_at'] = datetime.fromisoformat(product['updated_at'])
-        # Ensure backward compatibility: convert old 'image' field to 'images' array
-        if 'image' in product and 'images' not in product:
-            product['images'] = [product['image']] if product['image'] else []
-            del product['image']
-    
-    return products
+async def get_store_products(store_id: str, sort: str = "newest", category: Optional[str] = None,
+                             min_price: Optional[float] = None, max_price: Optional[float] = None,
+                             in_stock: bool = False, after: Optional[str] = None, limit: int = STORE_CATALOGUE_PAGE_MAX):
+    """A store's products, sorted and filtered server side.
+
+    Pages are keyset-paginated: pass the id of the last product received as
+    `after` with the same sort and filters to get the next page.
+    """
+    return await store_catalogue(
+        "products", store_id, sort, category, min_price, max_price, in_stock, after, limit
+    )
 
 @api_router.post("/stores/{store_id}/products", response_model=Product)
-async def create_product(store_id: str, product_data: ProductCreate, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
-        raise HTTPException(status_code=404, detail="المتجر غير موجود")
-    
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بإضافة منتجات لهذا المتجر")
-    
+async def create_product(store_id: str, product_data: ProductCreate, current_user: User = Depends(require_store_owner("غير مصرح لك بإضافة منتجات لهذا المتجر"))):
     product_dict = product_data.model_dump()
     product_dict['store_id'] = store_id
+    store = await db.stores.find_one({"id": store_id}, STORE_SNAPSHOT_PROJECTION)
+    if not store:
+        # Deleted on another worker whose owner cache entry this one still holds
+        store_owner_cache.forget_store(store_id)
+        raise HTTPException(status_code=404, detail="المتجر غير موجود")
+    product_dict['store'] = store_snapshot(store)
     product_obj = Product(**product_dict)
     
     doc = product_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.products.insert_one(doc)
     
     return product_obj
 
-@api_router.put("/products/{product_id}", response_model=Product)
-async def update_product(product_id: str, product_data: ProductUpdate, current_user: User = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id})
+@api_router.get("/products/{product_id}", response_model=Product)
+async def get_product(product_id: str):
+    product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="المنتج غير موجود")
     
-    store = await db.stores.find_one({"id": product['store_id']})
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بتعديل هذا المنتج")
+    await attach_store_snapshots([product])
     
+    return Product(**product)
+
+@api_router.put("/products/{product_id}", response_model=Product)
+async def update_product(product_id: str, product_data: ProductUpdate, current_user: User = Depends(get_current_user)):
     # Only update fields that are provided (not None)
     update_data = {k: v for k, v in product_data.model_dump(exclude_unset=True).items() if v is not None}
-    if update_data:
-        update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
-        await db.products.update_one(
-            {"id": product_id},
-            {"$set": update_data}
+    
+    async def apply(query):
+        if not update_data:
+            return await db.products.find_one(query, {"_id": 0})
+        update_data['updated_at'] = datetime.now(timezone.utc)
+        return await db.products.find_one_and_update(
+            query,
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
         )
     
-    updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if isinstance(updated_product.get('created_at'), str):
-        updated_product['created_at'] = datetime.fromisoformat(updated_product['created_at'])
-    if isinstance(updated_product.get('updated_at'), str):
-        updated_product['updated_at'] = datetime.fromisoformat(updated_product['updated_at'])
+    updated_product = await owned_write(
+        db.products, product_id, current_user, apply,
+        not_found="المنتج غير موجود", forbidden="غير مصرح لك بتعديل هذا المنتج"
+    )
     
     return Product(**updated_product)
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, current_user: User = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="المنتج غير موجود")
+    async def apply(query):
+        result = await db.products.delete_one(query)
+        return result.deleted_count
     
-    store = await db.stores.find_one({"id": product['store_id']})
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بحذف هذا المنتج")
-    
-    await db.products.delete_one({"id": product_id})
+    await owned_write(
+        db.products, product_id, current_user, apply,
+        not_found="المنتج غير موجود", forbidden="غير مصرح لك بحذف هذا المنتج"
+    )
     
     return {"message": "تم حذف المنتج بنجاح"}
 
@@ -522,6 +1830,7 @@ async def like_product(product_id: str, current_user: User = Depends(get_current
         {"id": product_id},
         {
             "$inc": {"likes": 1},
+            "$set": {"likes_changed_at": datetime.now(timezone.utc)},
             "$push": {"liked_by": current_user.id}
         }
     )
@@ -542,6 +1851,7 @@ async def unlike_product(product_id: str, current_user: User = Depends(get_curre
         {"id": product_id},
         {
             "$inc": {"likes": -1},
+            "$set": {"likes_changed_at": datetime.now(timezone.utc)},
             "$pull": {"liked_by": current_user.id}
         }
     )
@@ -560,37 +1870,30 @@ async def get_all_services(category: Optional[str] = None):
     
     services = await db.services.find(query, {"_id": 0}).to_list(1000)
     
-    for service in services:
-        if isinstance(service.get('created_at'), str):
-            service['created_at'] = datetime.fromisoformat(service['created_at'])
-    
     return services
 
 @api_router.get("/stores/{store_id}/services", response_model=List[Service])
-async def get_store_services(store_id: str):
-    services = await db.services.find({"store_id": store_id}, {"_id": 0}).to_list(1000)
-    
-    for service in services:
-        if isinstance(service.get('created_at'), str):
-            service['created_at'] = datetime.fromisoformat(service['created_at'])
-    
-    return services
+async def get_store_services(store_id: str, sort: str = "newest", category: Optional[str] = None,
+                             min_price: Optional[float] = None, max_price: Optional[float] = None,
+                             after: Optional[str] = None, limit: int = STORE_CATALOGUE_PAGE_MAX):
+    """A store's services, sorted, filtered and paginated like its products"""
+    return await store_catalogue(
+        "services", store_id, sort, category, min_price, max_price, False, after, limit
+    )
 
 @api_router.post("/stores/{store_id}/services", response_model=Service)
-async def create_service(store_id: str, service_data: ServiceCreate, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store:
-        raise HTTPException(status_code=404, detail="المتجر غير موجود")
-    
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بإضافة خدمات لهذا المتجر")
-    
+async def create_service(store_id: str, service_data: ServiceCreate, current_user: User = Depends(require_store_owner("غير مصرح لك بإضافة خدمات لهذا المتجر"))):
     service_dict = service_data.model_dump()
     service_dict['store_id'] = store_id
+    store = await db.stores.find_one({"id": store_id}, STORE_SNAPSHOT_PROJECTION)
+    if not store:
+        # Deleted on another worker whose owner cache entry this one still holds
+        store_owner_cache.forget_store(store_id)
+        raise HTTPException(status_code=404, detail="المتجر غير موجود")
+    service_dict['store'] = store_snapshot(store)
     service_obj = Service(**service_dict)
     
     doc = service_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.services.insert_one(doc)
     
@@ -598,37 +1901,33 @@ async def create_service(store_id: str, service_data: ServiceCreate, current_use
 
 @api_router.put("/services/{service_id}", response_model=Service)
 async def update_service(service_id: str, service_data: ServiceCreate, current_user: User = Depends(get_current_user)):
-    service = await db.services.find_one({"id": service_id})
-    if not service:
-        raise HTTPException(status_code=404, detail="الخدمة غير موجودة")
+    update_data = service_data.model_dump()
     
-    store = await db.stores.find_one({"id": service['store_id']})
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بتعديل هذه الخدمة")
+    async def apply(query):
+        return await db.services.find_one_and_update(
+            query,
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
     
-    update_data = service_data.model_dump()
-    await db.services.update_one(
-        {"id": service_id},
-        {"$set": update_data}
+    updated_service = await owned_write(
+        db.services, service_id, current_user, apply,
+        not_found="الخدمة غير موجودة", forbidden="غير مصرح لك بتعديل هذه الخدمة"
     )
     
-    updated_service = await db.services.find_one({"id": service_id}, {"_id": 0})
-    if isinstance(updated_service.get('created_at'), str):
-        updated_service['created_at'] = datetime.fromisoformat(updated_service['created_at'])
-    
     return Service(**updated_service)
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str, current_user: User = Depends(get_current_user)):
-    service = await db.services.find_one({"id": service_id})
-    if not service:
-        raise HTTPException(status_code=404, detail="الخدمة غير موجودة")
-    
-    store = await db.stores.find_one({"id": service['store_id']})
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بحذف هذه الخدمة")
+    async def apply(query):
+        result = await db.services.delete_one(query)
+        return result.deleted_count
     
-    await db.services.delete_one({"id": service_id})
+    await owned_write(
+        db.services, service_id, current_user, apply,
+        not_found="الخدمة غير موجودة", forbidden="غير مصرح لك بحذف هذه الخدمة"
+    )
     
     return {"message": "تم حذف الخدمة بنجاح"}
 
@@ -636,54 +1935,127 @@ async def delete_service(service_id: str, current_user: User = Depends(get_curre
 # MESSAGE ROUTES
 # ==========================
 
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+
+def conversation_key(user_a: str, user_b: str) -> str:
+    """Identifier shared by both directions of a conversation between two users"""
+    return ":".join(sorted((user_a, user_b)))
+
+CONVERSATION_LIST_MAX = 1000
+
 @api_router.get("/messages/conversations", response_model=List[dict])
 async def get_conversations(current_user: User = Depends(get_current_user)):
-    sent = await db.messages.find({"sender_id": current_user.id}).to_list(1000)
-    received = await db.messages.find({"receiver_id": current_user.id}).to_list(1000)
+    """The user's conversations, most recent first.
+
+    Listed from `conversation_members`, which also holds the last message
+    of conversations written to since it was kept there; older ones look
+    theirs up, from the newest archive bucket once the messages moved.
+    """
+    members = await db.conversation_members.find(
+        {"user_id": current_user.id, "last_at": {"$exists": True}},
+        {"_id": 0, "conversation_id": 1, "unread": 1, "last_message": 1}
+    ).sort("last_at", -1).limit(CONVERSATION_LIST_MAX).to_list(CONVERSATION_LIST_MAX)
     
-    user_ids = set()
-    for msg in sent:
-        user_ids.add(msg['receiver_id'])
-    for msg in received:
-        user_ids.add(msg['sender_id'])
-    
-    conversations = []
-    for user_id in user_ids:
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
-        if user_doc:
-            last_msg = await db.messages.find_one(
-                {"$or": [
-                    {"sender_id": current_user.id, "receiver_id": user_id},
-                    {"sender_id": user_id, "receiver_id": current_user.id}
-                ]},
-                {"_id": 0},
-                sort=[("created_at", -1)]
-            )
-            
-            conversations.append({
-                "user": user_doc,
-                "last_message": last_msg
-            })
+    # The conversation key is both user ids, sorted
+    other_ids = {
+        member['conversation_id']: next((i for i in member['conversation_id'].split(":") if i != current_user.id), current_user.id)
+        for member in members
+    }
+    users = {
+        user_doc['id']: user_doc
+        for user_doc in await db.users.find(
+            {"id": {"$in": list(set(other_ids.values()))}}, {"_id": 0, "password_hash": 0}
+        ).to_list(None)
+    }
+    
+    last_messages = {member['conversation_id']: member['last_message'] for member in members if member.get('last_message')}
+    missing = [key for key in other_ids if key not in last_messages]
+    if missing:
+        found = await asyncio.gather(*(
+            db.messages.find_one({"conversation_id": key}, {"_id": 0}, sort=[("created_at", -1), ("id", -1)])
+            for key in missing
+        ))
+        last_messages.update((key, message) for key, message in zip(missing, found) if message)
+    archived_only = [key for key in missing if key not in last_messages]
+    if archived_only:
+        buckets = await asyncio.gather(*(
+            db.messages_archive.find_one({"conversation_id": key}, {"_id": 0, "messages": 1}, sort=[("last_at", -1)])
+            for key in archived_only
+        ))
+        for key, bucket in zip(archived_only, buckets):
+            if bucket and bucket['messages']:
+                last_messages[key] = max(bucket['messages'], key=lambda msg: (msg['created_at'], msg['id']))
     
-    return conversations
+    return [
+        {
+            "user": users[other_ids[member['conversation_id']]],
+            "last_message": last_messages.get(member['conversation_id']),
+            "unread": member.get('unread', 0)
+        }
+        for member in members
+        if other_ids[member['conversation_id']] in users
+    ]
 
 @api_router.get("/messages/{user_id}", response_model=List[Message])
-async def get_messages_with_user(user_id: str, current_user: User = Depends(get_current_user)):
-    messages = await db.messages.find({
-        "$or": [
-            {"sender_id": current_user.id, "receiver_id": user_id},
-            {"sender_id": user_id, "receiver_id": current_user.id}
+async def get_messages_with_user(user_id: str, before: Optional[str] = None, limit: int = MESSAGE_PAGE_SIZE,
+                                 current_user: User = Depends(get_current_user)):
+    """Conversation history newest-first; pass the oldest id received as `before` for the next page"""
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    key = conversation_key(current_user.id, user_id)
+    query = {"conversation_id": key}
+    anchor, archived_anchor = None, False
+    if before:
+        anchor = await db.messages.find_one({"id": before, "conversation_id": key}, {"_id": 0, "created_at": 1})
+        if not anchor:
+            anchor = await find_archived_message(key, before)
+            archived_anchor = True
+        if not anchor:
+            raise HTTPException(status_code=404, detail="الرسالة غير موجودة")
+        query["$or"] = [
+            {"created_at": {"$lt": anchor['created_at']}},
+            {"created_at": anchor['created_at'], "id": {"$lt": before}}
         ]
-    }, {"_id": 0}).sort("created_at", 1).to_list(1000)
     
-    for msg in messages:
-        if isinstance(msg.get('created_at'), str):
-            msg['created_at'] = datetime.fromisoformat(msg['created_at'])
+    other_read = db.conversation_members.find_one({"conversation_id": key, "user_id": user_id}, {"_id": 0, "last_read_at": 1})
+    if archived_anchor:
+        # Everything still in `messages` is newer than an archived message
+        messages, other_read = [], await other_read
+    else:
+        messages, other_read = await asyncio.gather(
+            db.messages.find(query, {"_id": 0}).sort([("created_at", -1), ("id", -1)]).limit(limit).to_list(limit),
+            other_read
+        )
     
-    await db.messages.update_many(
-        {"sender_id": user_id, "receiver_id": current_user.id},
-        {"$set": {"is_read": True}}
-    )
+    # Paging past the hot window continues into the archive
+    if len(messages) < limit:
+        last = messages[-1] if messages else (anchor and {**anchor, "id": before})
+        messages += await archived_messages(key, limit - len(messages), last)
+    
+    # Opening the conversation reads everything on the first page; the
+    # watermark only moves forward, so re-opening it writes nothing
+    newest_received = next((msg['created_at'] for msg in messages if msg['sender_id'] == user_id), None)
+    if newest_received and not before:
+        try:
+            previous = await db.conversation_members.find_one_and_update(
+                {"conversation_id": key, "user_id": current_user.id, "last_read_at": {"$not": {"$gte": newest_received}}},
+                {"$set": {"last_read_at": newest_received, "unread": 0}},
+                projection={"_id": 0, "unread": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            previous = None  # already read up to here
+        if previous and previous.get('unread'):
+            await bump_counter(user_counter_id(current_user.id), "unread_messages", -previous['unread'])
+    
+    # Sent messages count as read once they are under the other side's watermark
+    other_watermark = (other_read or {}).get('last_read_at')
+    for msg in messages:
+        if msg['sender_id'] == user_id:
+            msg['is_read'] = True
+        else:
+            msg['is_read'] = msg.get('is_read') or bool(other_watermark and msg['created_at'] <= other_watermark)
     
     return messages
 
@@ -691,15 +2063,198 @@ async def get_messages_with_user(user_id: str, current_user: User = Depends(get_
 async def send_message(message_data: MessageCreate, current_user: User = Depends(get_current_user)):
     message_dict = message_data.model_dump()
     message_dict['sender_id'] = current_user.id
+    message_dict['conversation_id'] = conversation_key(current_user.id, message_data.receiver_id)
     message_obj = Message(**message_dict)
     
     doc = message_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.messages.insert_one(doc)
+    # Both sides' `last_at` orders their conversation lists and
+    # `last_message` previews it, so the conversation is listed as soon as
+    # the message is sent
+    try:
+        await db.conversation_members.bulk_write([
+            UpdateOne(
+                {
+                    "conversation_id": message_obj.conversation_id,
+                    "user_id": member_id,
+                    "last_at": {"$not": {"$gt": message_obj.created_at}}
+                },
+                {"$set": {"last_at": message_obj.created_at, "last_message": message_obj.model_dump()}},
+                upsert=True
+            )
+            for member_id in {current_user.id, message_obj.receiver_id}
+        ], ordered=False)
+    except BulkWriteError as exc:
+        # The upsert collides with the member document when a newer message already set it
+        if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+            raise
+    await enqueue_job(
+        "count_unread_message",
+        {
+            "conversation_id": message_obj.conversation_id,
+            "receiver_id": message_obj.receiver_id,
+            "sender_id": current_user.id,
+            "created_at": message_obj.created_at,
+        },
+        key=f"count_unread_message:{message_obj.id}",
+        user_id=current_user.id
+    )
     
     return message_obj
 
+@job("count_unread_message")
+async def count_unread_message(conversation_id: str, receiver_id: str, sender_id: Optional[str] = None,
+                               created_at: Optional[datetime] = None):
+    # A retry after a partial failure can over-count by one; the next read of
+    # the conversation resets both counts from its watermark. Jobs queued
+    # before messages carried their time increment unconditionally.
+    member = {"conversation_id": conversation_id, "user_id": receiver_id}
+    if created_at:
+        # The job can run after the receiver already opened the conversation;
+        # a message under their read watermark is not unread
+        try:
+            await db.conversation_members.update_one(
+                {**member, "last_read_at": {"$not": {"$gte": created_at}}}, {"$inc": {"unread": 1}}, upsert=True
+            )
+        except DuplicateKeyError:
+            return
+    else:
+        await db.conversation_members.update_one(member, {"$inc": {"unread": 1}}, upsert=True)
+    await bump_counter(user_counter_id(receiver_id), "unread_messages", 1)
+
+# ==========================
+# MESSAGE RETENTION
+# ==========================
+
+MESSAGE_ARCHIVE_LEASE_SECONDS = 600
+
+metrics.describe("boral_messages_archived_total", "counter", "Messages moved to the archive.")
+
+async def find_archived_message(conversation_id: str, message_id: str) -> Optional[dict]:
+    bucket = await db.messages_archive.find_one(
+        {"conversation_id": conversation_id, "messages.id": message_id},
+        {"_id": 0, "messages": {"$elemMatch": {"id": message_id}}}
+    )
+    return bucket['messages'][0] if bucket else None
+
+async def archived_messages(conversation_id: str, limit: int, older_than: Optional[dict] = None) -> List[dict]:
+    """Up to `limit` archived messages, newest-first, older than the `older_than` message if given.
+
+    A conversation's buckets cover consecutive, non-overlapping time ranges,
+    so walking them newest-first can stop as soon as the page is full.
+    """
+    query = {"conversation_id": conversation_id}
+    if older_than:
+        query["first_at"] = {"$lte": older_than['created_at']}
+        cutoff = (older_than['created_at'], older_than['id'])
+    messages = []
+    async for bucket in db.messages_archive.find(query, {"_id": 0, "messages": 1}).sort("last_at", -1):
+        for msg in sorted(bucket['messages'], key=lambda m: (m['created_at'], m['id']), reverse=True):
+            if not older_than or (msg['created_at'], msg['id']) < cutoff:
+                messages.append(msg)
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+async def ensure_message_archive():
+    # Buckets are written once and rarely read: favour compression over speed
+    try:
+        await db.create_collection(
+            "messages_archive",
+            storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+        )
+    except CollectionInvalid:
+        pass
+
+async def archive_old_messages(cutoff: datetime, bucket_size: int = MESSAGE_ARCHIVE_BUCKET_SIZE,
+                               batch_size: int = MESSAGE_ARCHIVE_BATCH_SIZE,
+                               pause: float = MESSAGE_ARCHIVE_PAUSE_MS / 1000) -> int:
+    """Move messages created before `cutoff` into archive buckets, a batch at a time.
+
+    Batches are taken oldest-first per conversation and first fill up the
+    conversation's newest bucket, then start new ones (`_id` derived from
+    their first message). Messages already in a bucket are only deleted, so
+    if the process dies between writing buckets and deleting their messages
+    the next run does not archive them twice.
+    """
+    archived = 0
+    while True:
+        batch = await db.messages.find(
+            {"created_at": {"$lt": cutoff}, "conversation_id": {"$exists": True}}, {"_id": 0}
+        ).sort([("conversation_id", 1), ("created_at", 1), ("id", 1)]).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return archived
+        
+        by_conversation = {}
+        for msg in batch:
+            by_conversation.setdefault(msg['conversation_id'], []).append(msg)
+        already_archived = {
+            msg['id']
+            async for bucket in db.messages_archive.aggregate([
+                {"$match": {"conversation_id": {"$in": list(by_conversation)}, "messages.id": {"$in": [msg['id'] for msg in batch]}}},
+                {"$project": {"_id": 0, "messages.id": 1}},
+            ])
+            for msg in bucket['messages']
+        }
+        newest_buckets = {
+            group['_id']: group
+            async for group in db.messages_archive.aggregate([
+                {"$match": {"conversation_id": {"$in": list(by_conversation)}}},
+                {"$sort": {"conversation_id": 1, "last_at": -1}},
+                {"$group": {"_id": "$conversation_id", "bucket_id": {"$first": "$_id"},
+                            "count": {"$first": "$count"}, "last_at": {"$first": "$last_at"}}},
+            ])
+        }
+        operations = []
+        for conversation_id, messages in by_conversation.items():
+            messages = [msg for msg in messages if msg['id'] not in already_archived]
+            newest = newest_buckets.get(conversation_id)
+            if messages and newest and newest['count'] < bucket_size and messages[0]['created_at'] >= newest['last_at']:
+                appended, messages = messages[:bucket_size - newest['count']], messages[bucket_size - newest['count']:]
+                operations.append(UpdateOne(
+                    {"_id": newest['bucket_id'], "count": newest['count']},
+                    {
+                        "$push": {"messages": {"$each": appended}},
+                        "$inc": {"count": len(appended)},
+                        "$set": {"last_at": appended[-1]['created_at']},
+                    }
+                ))
+            for start in range(0, len(messages), bucket_size):
+                bucket = messages[start:start + bucket_size]
+                operations.append(ReplaceOne(
+                    {"_id": f"{conversation_id}:{bucket[0]['id']}"},
+                    {
+                        "conversation_id": conversation_id,
+                        "first_at": bucket[0]['created_at'],
+                        "last_at": bucket[-1]['created_at'],
+                        "count": len(bucket),
+                        "messages": bucket,
+                    },
+                    upsert=True
+                ))
+        if operations:
+            await db.messages_archive.bulk_write(operations, ordered=False)
+        await db.messages.delete_many({"id": {"$in": [msg['id'] for msg in batch]}})
+        
+        archived += len(batch)
+        metrics.inc("boral_messages_archived_total", (), len(batch))
+        if pause:
+            await asyncio.sleep(pause)
+
+async def archive_messages_periodically():
+    owner = new_id()
+    while True:
+        try:
+            if await acquire_lease("message_archive", owner, MESSAGE_ARCHIVE_LEASE_SECONDS):
+                cutoff = datetime.now(timezone.utc) - timedelta(days=MESSAGE_HOT_DAYS)
+                archived = await archive_old_messages(cutoff)
+                if archived:
+                    logger.info("Archived %d messages older than %s", archived, cutoff.date())
+        except Exception:
+            logger.exception("Message archival failed")
+        await asyncio.sleep(MESSAGE_ARCHIVE_INTERVAL_SECONDS)
+
 # ==========================
 # REVIEW ROUTES
 # ==========================
@@ -708,10 +2263,6 @@ async def send_message(message_data: MessageCreate, current_user: User = Depends
 async def get_store_reviews(store_id: str):
     reviews = await db.reviews.find({"store_id": store_id}, {"_id": 0}).to_list(1000)
     
-    for review in reviews:
-        if isinstance(review.get('created_at'), str):
-            review['created_at'] = datetime.fromisoformat(review['created_at'])
-    
     return reviews
 
 @api_router.post("/stores/{store_id}/reviews", response_model=Review)
@@ -731,19 +2282,30 @@ async def create_review(store_id: str, review_data: ReviewCreate, current_user:
     review_obj = Review(**review_dict)
     
     doc = review_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.reviews.insert_one(doc)
+    await enqueue_job("refresh_store_rating", {"store_id": store_id}, key=f"refresh_store_rating:{review_obj.id}",
+                      user_id=current_user.id)
     
-    all_reviews = await db.reviews.find({"store_id": store_id}).to_list(1000)
-    avg_rating = sum(r['rating'] for r in all_reviews) / len(all_reviews)
-    
-    await db.stores.update_one(
+    return review_obj
+
+@job("refresh_store_rating")
+async def refresh_store_rating(store_id: str):
+    """Recompute a store's rating from all its reviews and fan the new snapshot out"""
+    summary = await db.reviews.aggregate([
+        {"$match": {"store_id": store_id}},
+        {"$group": {"_id": None, "rating": {"$avg": "$rating"}, "count": {"$sum": 1}}},
+    ]).to_list(1)
+    if not summary:
+        return
+    updated_store = await db.stores.find_one_and_update(
         {"id": store_id},
-        {"$set": {"rating": round(avg_rating, 1), "reviews_count": len(all_reviews)}}
+        {"$set": {"rating": round(summary[0]['rating'], 1), "reviews_count": summary[0]['count']}, "$inc": {"snapshot_version": 1}},
+        projection=STORE_SNAPSHOT_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
-    
-    return review_obj
+    if updated_store:
+        await fan_out_store_snapshot(updated_store)
 
 # ==========================
 # SEARCH ROUTE
@@ -754,7 +2316,7 @@ async def search(q: str, scope: str = "all"):
     results = {"stores": [], "services": [], "products": []}
     
     if scope in ["all", "stores"]:
-        stores = await db.stores.find({
+        stores = await db_read.stores.find({
             "$or": [
                 {"name": {"$regex": q, "$options": "i"}},
                 {"description": {"$regex": q, "$options": "i"}},
@@ -763,16 +2325,10 @@ async def search(q: str, scope: str = "all"):
             ]
         }, {"_id": 0}).to_list(50)
         
-        for store in stores:
-            if isinstance(store.get('created_at'), str):
-                store['created_at'] = datetime.fromisoformat(store['created_at'])
-            if isinstance(store.get('updated_at'), str):
-                store['updated_at'] = datetime.fromisoformat(store['updated_at'])
-        
         results["stores"] = stores
     
     if scope in ["all", "services"]:
-        services = await db.services.find({
+        services = await db_read.services.find({
             "$or": [
                 {"name": {"$regex": q, "$options": "i"}},
                 {"description": {"$regex": q, "$options": "i"}},
@@ -780,14 +2336,10 @@ async def search(q: str, scope: str = "all"):
             ]
         }, {"_id": 0}).to_list(50)
         
-        for service in services:
-            if isinstance(service.get('created_at'), str):
-                service['created_at'] = datetime.fromisoformat(service['created_at'])
-        
-        results["services"] = services
+        results["services"] = await attach_store_snapshots(services)
     
     if scope in ["all", "products"]:
-        products = await db.products.find({
+        products = await db_read.products.find({
             "$or": [
                 {"name": {"$regex": q, "$options": "i"}},
                 {"description": {"$regex": q, "$options": "i"}},
@@ -795,28 +2347,208 @@ async def search(q: str, scope: str = "all"):
             ]
         }, {"_id": 0}).to_list(50)
         
-        for product in products:
-            if isinstance(product.get('created_at'), str):
-                product['created_at'] = datetime.fromisoformat(product['created_at'])
-        
-        results["products"] = products
+        results["products"] = await attach_store_snapshots(products)
     
     return results
 
+# ==========================
+# ORDER EVENTS
+# ==========================
+
+# Allowed order status transitions: pending -> confirmed -> completed, and
+# cancellation from any non-final state.
+ORDER_TRANSITIONS = {
+    "pending": {"confirmed", "cancelled"},
+    "confirmed": {"completed", "cancelled"},
+    "completed": set(),
+    "cancelled": set(),
+}
+
+order_event_handlers = []
+
+def on_order_event(handler):
+    """Register an async handler called as `handler(event)` for every order event.
+
+    Events are dicts with `type` ("order.created" or "order.status_changed"),
+    the full `order` document and, for status changes, `previous_status`.
+    Subscribers receive the order itself so they never need to re-query it.
+    """
+    order_event_handlers.append(handler)
+    return handler
+
+async def publish_order_event(event_type: str, order: dict, **extra):
+    event = {"type": event_type, "order": order, **extra}
+    results = await asyncio.gather(
+        *(handler(event) for handler in order_event_handlers),
+        return_exceptions=True
+    )
+    for handler, result in zip(order_event_handlers, results):
+        if isinstance(result, Exception):
+            logger.error("Order event handler %s failed for %s", handler.__name__, event_type, exc_info=result)
+
+@on_order_event
+async def release_cancelled_order_stock(event):
+    # Orders placed before stock was reserved at checkout have no `stock_reserved`
+    order = event['order']
+    if event['type'] == "order.status_changed" and order['order_status'] == "cancelled" and order.get('stock_reserved'):
+        await enqueue_job("release_order_stock", {"order_id": order['id']}, key=f"release_order_stock:{order['id']}",
+                          user_id=order['user_id'])
+
+@job("release_order_stock")
+async def release_order_stock(order_id: str):
+    """Give a cancelled order's stock back, claiming each product on the order so a retry skips those already released"""
+    order = await db.orders.find_one(
+        {"id": order_id, "order_status": "cancelled", "stock_reserved": True},
+        {"_id": 0, "items": 1, "stock_released": 1}
+    )
+    if not order:
+        return
+    released = set(order.get('stock_released', []))
+    reserved = {}
+    for item in order['items']:
+        if item.get('product_id') and item['product_id'] not in released:
+            reserved[item['product_id']] = reserved.get(item['product_id'], 0) + item.get('quantity', 1)
+    for product_id, quantity in reserved.items():
+        # Claim the product before giving its stock back, so a repeated run
+        # can never release it twice
+        claimed = await db.orders.update_one(
+            {"id": order_id, "stock_released": {"$ne": product_id}},
+            {"$addToSet": {"stock_released": product_id}}
+        )
+        if claimed.modified_count == 1:
+            try:
+                await db.products.update_one({"id": product_id}, {"$inc": {"stock": quantity}})
+            except PyMongoError:
+                # Hand the claim back so the retry releases it
+                await db.orders.update_one({"id": order_id}, {"$pull": {"stock_released": product_id}})
+                raise
+
 # ==========================
 # ORDER ROUTES
 # ==========================
 
+async def price_order_items(store_id: str, items: List[OrderItemCreate]) -> List[OrderItemBase]:
+    """Resolve names and prices for order items with one `$in` query per collection."""
+    if not items:
+        raise HTTPException(status_code=400, detail="الطلب لا يحتوي على عناصر")
+    
+    for item in items:
+        if bool(item.product_id) == bool(item.service_id):
+            raise HTTPException(status_code=400, detail="يجب تحديد منتج أو خدمة لكل عنصر")
+    
+    product_ids = list({item.product_id for item in items if item.product_id})
+    service_ids = list({item.service_id for item in items if item.service_id})
+    projection = {"_id": 0, "id": 1, "name": 1, "price": 1}
+    
+    products = {}
+    if product_ids:
+        docs = await db.products.find(
+            {"id": {"$in": product_ids}, "store_id": store_id}, projection
+        ).to_list(len(product_ids))
+        products = {doc['id']: doc for doc in docs}
+    
+    services = {}
+    if service_ids:
+        docs = await db.services.find(
+            {"id": {"$in": service_ids}, "store_id": store_id}, projection
+        ).to_list(len(service_ids))
+        services = {doc['id']: doc for doc in docs}
+    
+    priced = []
+    for item in items:
+        source = products.get(item.product_id) if item.product_id else services.get(item.service_id)
+        if source is None:
+            raise HTTPException(status_code=400, detail="أحد العناصر غير موجود في هذا المتجر")
+        priced.append(OrderItemBase(
+            product_id=item.product_id,
+            service_id=item.service_id,
+            quantity=item.quantity,
+            price=source['price'],
+            name=source['name']
+        ))
+    return priced
+
+async def release_stock(reserved: dict):
+    if reserved:
+        await asyncio.gather(*(
+            db.products.update_one({"id": product_id}, {"$inc": {"stock": quantity}})
+            for product_id, quantity in reserved.items()
+        ))
+
+async def reserve_stock(items: List[OrderItemBase]) -> dict:
+    """Atomically decrement stock for every product in the order.
+
+    Each product is decremented with a conditional `$inc` that only matches
+    while enough stock remains, so concurrent orders can never drive stock
+    negative. Products without a `stock` field (created before stock was
+    tracked) are unlimited and reserve nothing. If any product is short,
+    the reservations already made are released and the order is rejected.
+    """
+    quantities = {}
+    for item in items:
+        if item.product_id:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    if not quantities:
+        return {}
+    
+    results = await asyncio.gather(*(
+        db.products.update_one(
+            {"id": product_id, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}}
+        )
+        for product_id, quantity in quantities.items()
+    ), return_exceptions=True)
+    
+    reserved = {}
+    short = []
+    failed = False
+    for (product_id, quantity), result in zip(quantities.items(), results):
+        if isinstance(result, Exception):
+            failed = True
+        elif result.modified_count == 0:
+            short.append(product_id)
+        else:
+            reserved[product_id] = quantity
+    if short and not failed:
+        untracked = await db.products.find(
+            {"id": {"$in": short}, "stock": {"$exists": False}}, {"_id": 0, "id": 1}
+        ).to_list(len(short))
+        failed = len(untracked) < len(short)
+    
+    if failed:
+        await release_stock(reserved)
+        raise HTTPException(status_code=409, detail="الكمية المطلوبة غير متوفرة في المخزون")
+    return reserved
+
 @api_router.post("/orders", response_model=Order)
 async def create_order(order_data: OrderCreate, current_user: User = Depends(get_current_user)):
-    order_dict = order_data.model_dump()
-    order_dict['user_id'] = current_user.id
-    order_obj = Order(**order_dict)
+    items = await price_order_items(order_data.store_id, order_data.items)
+    total = round(sum(item.price * item.quantity for item in items), 2)
+    
+    order_obj = Order(
+        store_id=order_data.store_id,
+        notes=order_data.notes,
+        items=items,
+        total=total,
+        user_id=current_user.id,
+        status_history=[OrderStatusChange(status="pending", changed_by=current_user.id)]
+    )
     
     doc = order_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
-    await db.orders.insert_one(doc)
+    reserved = await reserve_stock(items)
+    doc['stock_reserved'] = bool(reserved)
+    if reserved:
+        # Unlimited products reserved nothing, so cancelling has nothing to give back
+        doc['stock_released'] = list({item.product_id for item in items if item.product_id and item.product_id not in reserved})
+    try:
+        await db.orders.insert_one(doc)
+    except Exception:
+        await release_stock(reserved)
+        raise
+    
+    doc.pop('_id', None)
+    await publish_order_event("order.created", doc)
     
     return order_obj
 
@@ -824,42 +2556,399 @@ async def create_order(order_data: OrderCreate, current_user: User = Depends(get
 async def get_my_orders(current_user: User = Depends(get_current_user)):
     orders = await db.orders.find({"user_id": current_user.id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     
-    for order in orders:
-        if isinstance(order.get('created_at'), str):
-            order['created_at'] = datetime.fromisoformat(order['created_at'])
-    
     return orders
 
 @api_router.get("/stores/{store_id}/orders", response_model=List[Order])
-async def get_store_orders(store_id: str, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store or store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح")
-    
+async def get_store_orders(store_id: str, current_user: User = Depends(require_store_owner(hide_missing=True))):
     orders = await db.orders.find({"store_id": store_id}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
-    for order in orders:
-        if isinstance(order.get('created_at'), str):
-            order['created_at'] = datetime.fromisoformat(order['created_at'])
-    
     return orders
 
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, order_status: str, current_user: User = Depends(get_current_user)):
-    order = await db.orders.find_one({"id": order_id})
-    if not order:
-        raise HTTPException(status_code=404, detail="الطلب غير موجود")
+    if order_status not in ORDER_TRANSITIONS:
+        raise HTTPException(status_code=400, detail="حالة الطلب غير صالحة")
     
-    store = await db.stores.find_one({"id": order['store_id']})
-    if store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح")
+    prior_states = [state for state, targets in ORDER_TRANSITIONS.items() if order_status in targets]
+    change = OrderStatusChange(status=order_status, changed_by=current_user.id).model_dump()
+    
+    # The prior-state condition makes the transition atomic: of two concurrent
+    # updates only one can match, and invalid transitions never match.
+    async def apply(query):
+        query['order_status'] = {"$in": prior_states}
+        return await db.orders.find_one_and_update(
+            query,
+            {"$set": {"order_status": order_status}, "$push": {"status_history": change}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    
+    previous = await owned_write(
+        db.orders, order_id, current_user, apply,
+        not_found="الطلب غير موجود", forbidden="غير مصرح",
+        conflict="لا يمكن تغيير حالة الطلب إلى هذه الحالة"
+    )
+    
+    order = {**previous, "order_status": order_status}
+    order['status_history'] = previous.get('status_history', []) + [change]
+    await publish_order_event("order.status_changed", order, previous_status=previous['order_status'])
+    
+    return {"message": "تم تحديث حالة الطلب", "order_status": order_status}
+
+# ==========================
+# BADGES
+# ==========================
+
+# Counters live in `counters`, one document per user ("user:<id>", holding
+# `unread_messages`) and per store ("store:<id>", holding `new_orders`).
+# Unread counts per conversation are kept on `conversation_members`.
+
+def user_counter_id(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def store_counter_id(store_id: str) -> str:
+    return f"store:{store_id}"
+
+async def bump_counter(counter_id: str, field: str, amount: int):
+    await db.counters.update_one({"_id": counter_id}, {"$inc": {field: amount}}, upsert=True)
+
+@on_order_event
+async def count_new_orders(event):
+    counter_id = store_counter_id(event['order']['store_id'])
+    if event['type'] == "order.created":
+        await bump_counter(counter_id, "new_orders", 1)
+    elif event.get('previous_status') == "pending":
+        await bump_counter(counter_id, "new_orders", -1)
+
+@api_router.get("/me/badges")
+async def get_badges(request: Request, current_user: User = Depends(get_current_user)):
+    """Unread messages and pending orders for the header badges, in one counters query.
+
+    Meant to be polled: responses carry an ETag and a short private
+    Cache-Control, and an unchanged poll gets an empty 304.
+    """
+    store_ids = await get_owned_store_ids(current_user.id)
+    counter_ids = [user_counter_id(current_user.id)] + [store_counter_id(store_id) for store_id in store_ids]
+    counters = await db.counters.find({"_id": {"$in": counter_ids}}).to_list(len(counter_ids))
+    counters = {counter['_id']: counter for counter in counters}
+    
+    new_orders = {
+        store_id: max(0, counters.get(store_counter_id(store_id), {}).get('new_orders', 0))
+        for store_id in store_ids
+    }
+    badges = {
+        "unread_messages": max(0, counters.get(user_counter_id(current_user.id), {}).get('unread_messages', 0)),
+        "new_orders": sum(new_orders.values()),
+        "new_orders_by_store": new_orders,
+    }
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {"order_status": order_status}}
+    etag = '"%s"' % hashlib.sha1(json.dumps(badges, sort_keys=True).encode()).hexdigest()[:16]
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=10", "Vary": "Authorization"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(badges, headers=headers)
+
+# ==========================
+# ORDER STREAM
+# ==========================
+
+# Every order event is appended to `order_events` with a per-store `seq`
+# (from the store's counters document), which is the SSE event id. The log
+# keeps the last ORDER_EVENT_LOG_SIZE events per store; a broker carries new
+# entries to the stream connections on every worker.
+
+class OrderEventBroker(ABC):
+    """Delivers logged order events to this worker's stream subscribers.
+
+    Subclass to use another transport (e.g. Redis pub/sub): `publish` is
+    called on the worker that logged the event and must end in `deliver`
+    on every worker. Delivery may repeat or reorder events; streams skip
+    what they have sent and fill gaps from the log.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers = {}
+
+    def subscribe(self, store_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(store_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, store_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(store_id)
+        if queues:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[store_id]
+
+    def deliver(self, event: dict):
+        for queue in self._subscribers.get(event['store_id'], ()):
+            # A full queue means a stalled client; the gap is replayed from the log when it catches up
+            if not queue.full():
+                queue.put_nowait(event)
+
+    @abstractmethod
+    async def publish(self, event: dict):
+        """Hand a logged event to the transport, ending in `deliver` on every worker"""
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MemoryOrderEventBroker(OrderEventBroker):
+    """In-process delivery, only correct with a single worker"""
+
+    async def publish(self, event: dict):
+        self.deliver(event)
+
+class MongoOrderEventBroker(OrderEventBroker):
+    """Polls `order_events` for the stores this worker has streams for.
+
+    Event `_id`s are time-ordered, so each poll asks for ids minted since
+    shortly before the previous poll; the overlap covers inserts that
+    commit out of id order across workers, and repeats are skipped.
+    """
+
+    def __init__(self, interval: float = ORDER_STREAM_POLL_MS / 1000, overlap: float = 5.0, queue_size: int = 100):
+        super().__init__(queue_size)
+        self.interval = interval
+        self.overlap = overlap
+        self._seen = OrderedDict()
+        self._task = None
+
+    async def publish(self, event: dict):
+        # Picked up by the pollers, this worker's included
+        pass
+
+    async def poll(self, since: datetime):
+        events = db.order_events.find(
+            {"_id": {"$gte": id_floor(since)}, "store_id": {"$in": list(self._subscribers)}}
+        ).sort("_id", ASCENDING)
+        now = time.monotonic()
+        async for event in events:
+            if event['_id'] not in self._seen:
+                self._seen[event['_id']] = now
+                self.deliver(event)
+        # Ids older than two windows can no longer come back
+        while self._seen and next(iter(self._seen.values())) < now - 2 * (self.interval + self.overlap):
+            self._seen.popitem(last=False)
+
+    async def run(self):
+        while True:
+            started = datetime.now(timezone.utc)
+            if self._subscribers:
+                try:
+                    await self.poll(started - timedelta(seconds=self.interval + self.overlap))
+                except Exception:
+                    logger.exception("Order event poll failed")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+ORDER_EVENT_BROKERS = {"memory": MemoryOrderEventBroker, "mongo": MongoOrderEventBroker}
+
+order_event_broker = ORDER_EVENT_BROKERS[ORDER_STREAM_BROKER]()
+
+@on_order_event
+async def log_order_event(event):
+    store_id = event['order']['store_id']
+    counter = await db.counters.find_one_and_update(
+        {"_id": store_counter_id(store_id)},
+        {"$inc": {"order_event_seq": 1}},
+        projection={"order_event_seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
+    seq = counter['order_event_seq']
+    data = {"type": event['type'], "order": Order(**event['order']).model_dump(mode="json")}
+    if 'previous_status' in event:
+        data['previous_status'] = event['previous_status']
+    entry = {
+        "_id": new_id(),
+        "store_id": store_id,
+        "seq": seq,
+        "data": json.dumps(data, ensure_ascii=False),
+        "created_at": datetime.now(timezone.utc),
+    }
+    await db.order_events.insert_one(entry)
+    await db.order_events.delete_many({"store_id": store_id, "seq": {"$lte": seq - ORDER_EVENT_LOG_SIZE}})
+    await order_event_broker.publish(entry)
+
+def sse_message(event: dict) -> str:
+    name = json.loads(event['data'])['type']
+    return f"id: {event['seq']}\nevent: {name}\ndata: {event['data']}\n\n"
+
+async def replay_order_events(store_id: str, after: int, until: Optional[int] = None) -> list:
+    query = {"store_id": store_id, "seq": {"$gt": after}}
+    if until is not None:
+        query['seq']['$lte'] = until
+    return await db.order_events.find(query, {"_id": 0}).sort("seq", ASCENDING).to_list(ORDER_EVENT_LOG_SIZE)
+
+async def order_event_stream(request: Request, store_id: str, last_event_id: Optional[int]):
+    queue = order_event_broker.subscribe(store_id)
+    try:
+        if last_event_id is None:
+            counter = await db.counters.find_one({"_id": store_counter_id(store_id)}, {"order_event_seq": 1})
+            last = (counter or {}).get('order_event_seq', 0)
+        else:
+            last = last_event_id
+            backlog = await replay_order_events(store_id, last)
+            if backlog and backlog[0]['seq'] > last + 1:
+                # Older events have left the log; the client has to reload its order list
+                yield "event: reset\ndata: {}\n\n"
+            for event in backlog:
+                yield sse_message(event)
+                last = event['seq']
+        yield f"retry: {ORDER_STREAM_HEARTBEAT_SECONDS * 1000}\n\n"
+        
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), ORDER_STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event['seq'] <= last:
+                continue
+            missed = await replay_order_events(store_id, last, event['seq']) if event['seq'] > last + 1 else [event]
+            for event in missed:
+                yield sse_message(event)
+                last = event['seq']
+    finally:
+        order_event_broker.unsubscribe(store_id, queue)
+
+@api_router.get("/stores/{store_id}/orders/stream")
+async def stream_store_orders(request: Request, store_id: str,
+                              current_user: User = Depends(require_store_owner(hide_missing=True))):
+    """Server-sent events for a store's new orders and status changes.
+
+    Event ids are the store's event sequence numbers: a reconnecting client
+    sends `Last-Event-ID` and gets what it missed from the event log, or a
+    `reset` event if that has already been trimmed.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    return StreamingResponse(
+        order_event_stream(request, store_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ==========================
+# EXPORTS
+# ==========================
+
+def order_export_row(order: dict) -> list:
+    items = "; ".join(f"{item['name']} x{item.get('quantity', 1)}" for item in order.get('items', []))
+    return [order['id'], order['created_at'].isoformat(), order['user_id'], order['order_status'],
+            order['total'], items, order.get('notes') or ""]
+
+def product_export_row(product: dict) -> list:
+    return [product['id'], product['created_at'].isoformat(), product['name'], product['category'],
+            product['price'], product.get('stock', 0), product.get('likes', 0), product['description']]
+
+def review_export_row(review: dict) -> list:
+    return [review['id'], review['created_at'].isoformat(), review['user_id'], review['user_name'],
+            review['rating'], review['comment']]
+
+# collection -> (model for JSONL, CSV columns, CSV row)
+EXPORTS = {
+    "orders": (Order, ["id", "created_at", "user_id", "order_status", "total", "items", "notes"], order_export_row),
+    "products": (Product, ["id", "created_at", "name", "category", "price", "stock", "likes", "description"], product_export_row),
+    "reviews": (Review, ["id", "created_at", "user_id", "user_name", "rating", "comment"], review_export_row),
+}
+
+EXPORT_SORT = [("created_at", ASCENDING), ("id", ASCENDING)]
+
+export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+def csv_safe(value):
+    # Customer-written text must not be read as a formula by spreadsheet apps
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+async def export_chunks(name: str, query: dict, export_format: str, compress: bool, batch_size: int):
+    """Encode a cursor as CSV or JSONL in EXPORT_CHUNK_BYTES chunks, gzipped on the fly if asked.
+
+    Only one cursor batch and one chunk are in memory at a time, whatever
+    the size of the export.
+    """
+    model, columns, to_row = EXPORTS[name]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == "csv":
+        writer.writerow(columns)
+    
+    def take():
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+    
+    async with export_slots:
+        cursor = db[name].find(query, {"_id": 0}).sort(EXPORT_SORT).batch_size(batch_size)
+        async for doc in cursor:
+            if export_format == "csv":
+                writer.writerow([csv_safe(value) for value in to_row(doc)])
+            else:
+                buffer.write(json.dumps(model(**doc).model_dump(mode="json"), ensure_ascii=False) + "\n")
+            if buffer.tell() >= EXPORT_CHUNK_BYTES:
+                chunk = take()
+                if chunk:
+                    yield chunk
+    chunk = take()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+@api_router.get("/stores/{store_id}/export/{kind}")
+async def export_store_data(store_id: str, kind: str, format: str = "csv", gzip: bool = False,
+                            since: Optional[datetime] = None, until: Optional[datetime] = None,
+                            after: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE,
+                            current_user: User = Depends(require_store_owner(hide_missing=True))):
+    """Stream a store's orders, products or reviews as a CSV or JSONL download.
+
+    Rows come oldest first, optionally limited to `since` <= created_at <
+    `until`. An interrupted export resumes from where it stopped by passing
+    the id of the last row received as `after` with the same range.
+    """
+    if kind not in EXPORTS:
+        raise HTTPException(status_code=404, detail="نوع التصدير غير موجود")
+    if format not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="صيغة التصدير غير مدعومة")
+    
+    query = {"store_id": store_id}
+    if since or until:
+        query['created_at'] = {}
+        if since:
+            query['created_at']['$gte'] = since
+        if until:
+            query['created_at']['$lt'] = until
+    if after:
+        anchor = await db[kind].find_one({"id": after, "store_id": store_id}, {"_id": 0, "created_at": 1, "id": 1})
+        if not anchor:
+            raise HTTPException(status_code=404, detail="العنصر غير موجود")
+        query = {"$and": [query, keyset_after(EXPORT_SORT, anchor)]}
     
-    return {"message": "تم تحديث حالة الطلب"}
+    filename = f"{kind}-{store_id}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_chunks(kind, query, format, gzip, max(1, min(batch_size, EXPORT_BATCH_SIZE_MAX))),
+        media_type="application/gzip" if gzip else ("text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 # ==========================
 # ANALYTICS ROUTES
@@ -868,32 +2957,18 @@ async def update_order_status(order_id: str, order_status: str, current_user: Us
 @api_router.get("/analytics/popular-products")
 async def get_popular_products(limit: int = 10):
     # Get products with most likes
-    products = await db.products.find({}, {"_id": 0}).sort("likes", -1).limit(limit).to_list(limit)
-    
-    for product in products:
-        if isinstance(product.get('created_at'), str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
+    products = await db_read.products.find({}, {"_id": 0}).sort("likes", -1).limit(limit).to_list(limit)
     
-    return products
+    return await attach_store_snapshots(products)
 
 @api_router.get("/analytics/top-rated-stores")
 async def get_top_rated_stores(limit: int = 10):
-    stores = await db.stores.find({}, {"_id": 0}).sort("rating", -1).limit(limit).to_list(limit)
-    
-    for store in stores:
-        if isinstance(store.get('created_at'), str):
-            store['created_at'] = datetime.fromisoformat(store['created_at'])
-        if isinstance(store.get('updated_at'), str):
-            store['updated_at'] = datetime.fromisoformat(store['updated_at'])
+    stores = await db_read.stores.find({}, {"_id": 0}).sort("rating", -1).limit(limit).to_list(limit)
     
     return stores
 
 @api_router.get("/stores/{store_id}/analytics")
-async def get_store_analytics(store_id: str, current_user: User = Depends(get_current_user)):
-    store = await db.stores.find_one({"id": store_id})
-    if not store or store['owner_id'] != current_user.id:
-        raise HTTPException(status_code=403, detail="غير مصرح")
-    
+async def get_store_analytics(store_id: str, current_user: User = Depends(require_store_owner(hide_missing=True))):
     # Get orders count and total revenue
     orders = await db.orders.find({"store_id": store_id}).to_list(10000)
     total_orders = len(orders)
@@ -913,6 +2988,681 @@ async def get_store_analytics(store_id: str, current_user: User = Depends(get_cu
         "average_order_value": total_revenue / total_orders if total_orders > 0 else 0
     }
 
+# ==========================
+# RECOMMENDATIONS
+# ==========================
+
+def item_neighbours(baskets: np.ndarray, items: np.ndarray, basket_weights: np.ndarray, n_items: int, k: int,
+                    rows: Optional[np.ndarray] = None, max_basket: int = SIMILAR_MAX_BASKET):
+    """Top-k cosine neighbours per item from (basket, item) memberships.
+
+    Two items are similar when they appear in the same baskets: the weighted
+    co-occurrence count divided by the geometric mean of their weighted
+    popularity. Everything is vectorised: every basket is expanded into its
+    item pairs with repeat/offset arithmetic, pairs are aggregated with
+    unique/bincount, and a lexsort ranks each item's neighbours. Baskets
+    are truncated to `max_basket` items to bound the quadratic expansion.
+    `rows` (a boolean mask over items) restricts the output to those items.
+
+    Returns parallel arrays (item, neighbour, score), best first per item.
+    """
+    order = np.lexsort((items, baskets))
+    baskets, items = baskets[order], items[order]
+    unique = np.ones(len(items), dtype=bool)
+    unique[1:] = (baskets[1:] != baskets[:-1]) | (items[1:] != items[:-1])
+    baskets, items = baskets[unique], items[unique]
+    
+    starts = np.flatnonzero(np.r_[True, baskets[1:] != baskets[:-1]])
+    sizes = np.diff(np.r_[starts, len(items)])
+    within = np.arange(len(items)) - np.repeat(starts, sizes)
+    if (within >= max_basket).any():
+        baskets, items = baskets[within < max_basket], items[within < max_basket]
+        starts = np.flatnonzero(np.r_[True, baskets[1:] != baskets[:-1]])
+        sizes = np.diff(np.r_[starts, len(items)])
+    weights = basket_weights[baskets]
+    popularity = np.bincount(items, weights=weights, minlength=n_items)
+    
+    left = np.arange(len(items))
+    if rows is not None:
+        left = left[rows[items]]
+    size_of = np.repeat(sizes, sizes)[left]
+    start_of = np.repeat(starts, sizes)[left]
+    ends = np.cumsum(size_of)
+    total = int(ends[-1]) if len(ends) else 0
+    partner = np.repeat(start_of - (ends - size_of), size_of) + np.arange(total)
+    left = np.repeat(left, size_of)
+    distinct = left != partner
+    left, partner = left[distinct], partner[distinct]
+    
+    keys = items[left].astype(np.int64) * n_items + items[partner]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    co_occurrence = np.bincount(inverse, weights=weights[left])
+    item, neighbour = keys // n_items, keys % n_items
+    score = co_occurrence / np.sqrt(popularity[item] * popularity[neighbour])
+    
+    order = np.lexsort((-score, item))
+    item, neighbour, score = item[order], neighbour[order], score[order]
+    group_starts = np.flatnonzero(np.r_[True, item[1:] != item[:-1]])
+    rank = np.arange(len(item)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(item)]))
+    top = rank < k
+    return item[top], neighbour[top], score[top]
+
+class CoLikeMatrix:
+    """Product/basket memberships behind the similarity index.
+
+    A basket is a set of products seen together: everything one user has
+    liked ("like:<user>") or the products of one order ("order:<id>",
+    weighted SIMILAR_ORDER_WEIGHT). Memberships are kept as parallel NumPy
+    arrays so a refresh only has to patch them and recompute the rows
+    whose baskets changed.
+    """
+
+    def __init__(self):
+        self.product_ids = []
+        self.product_index = {}
+        self.basket_index = {}
+        self.basket_weights = []
+        self.is_like_basket = []
+        self.baskets = np.zeros(0, dtype=np.int64)
+        self.items = np.zeros(0, dtype=np.int64)
+
+    def product(self, product_id: str) -> int:
+        index = self.product_index.get(product_id)
+        if index is None:
+            index = self.product_index[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+        return index
+
+    def basket(self, key: str, weight: float = 1.0) -> int:
+        index = self.basket_index.get(key)
+        if index is None:
+            index = self.basket_index[key] = len(self.basket_weights)
+            self.basket_weights.append(weight)
+            self.is_like_basket.append(key.startswith("like:"))
+        return index
+
+    def rows_affected_by(self, changed: np.ndarray, old_baskets: np.ndarray) -> np.ndarray:
+        # A changed product's popularity enters the score of every product it shares a basket with
+        baskets = np.union1d(self.baskets[np.isin(self.items, changed)], old_baskets)
+        rows = np.zeros(len(self.product_ids), dtype=bool)
+        rows[self.items[np.isin(self.baskets, baskets)]] = True
+        rows[changed] = True
+        return rows
+
+    def replace_likes(self, likes: dict) -> np.ndarray:
+        """Set the users who like each product in `likes`; returns the rows to recompute"""
+        changed = np.fromiter((self.product(product_id) for product_id in likes), dtype=np.int64, count=len(likes))
+        new_baskets = np.fromiter(
+            (self.basket(f"like:{user_id}") for users in likes.values() for user_id in users), dtype=np.int64
+        )
+        new_items = np.repeat(changed, [len(users) for users in likes.values()])
+        
+        is_like = np.array(self.is_like_basket, dtype=bool)
+        stale = np.isin(self.items, changed) & is_like[self.baskets]
+        old_baskets = self.baskets[stale]
+        self.baskets = np.concatenate([self.baskets[~stale], new_baskets])
+        self.items = np.concatenate([self.items[~stale], new_items])
+        return self.rows_affected_by(changed, old_baskets)
+
+    def add_orders(self, orders: dict) -> np.ndarray:
+        """Add baskets for orders not seen before; returns the rows to recompute"""
+        orders = {order_id: products for order_id, products in orders.items() if f"order:{order_id}" not in self.basket_index}
+        new_baskets = np.fromiter(
+            (self.basket(f"order:{order_id}", SIMILAR_ORDER_WEIGHT) for order_id, products in orders.items() for _ in products),
+            dtype=np.int64
+        )
+        new_items = np.fromiter(
+            (self.product(product_id) for products in orders.values() for product_id in products), dtype=np.int64
+        )
+        self.baskets = np.concatenate([self.baskets, new_baskets])
+        self.items = np.concatenate([self.items, new_items])
+        return self.rows_affected_by(np.unique(new_items), np.zeros(0, dtype=np.int64))
+
+    def neighbours(self, rows: Optional[np.ndarray] = None, k: int = SIMILAR_PRODUCTS_K) -> dict:
+        """{product_id: [(neighbour_id, score), ...]} for every product, or only `rows`"""
+        n_items = len(self.product_ids)
+        if rows is not None and len(rows) < n_items:
+            rows = np.r_[rows, np.zeros(n_items - len(rows), dtype=bool)]
+        item, neighbour, score = item_neighbours(
+            self.baskets, self.items, np.array(self.basket_weights), n_items, k, rows
+        )
+        result = {self.product_ids[index]: [] for index in (np.flatnonzero(rows) if rows is not None else range(n_items))}
+        for i, j, value in zip(item.tolist(), neighbour.tolist(), score.tolist()):
+            result[self.product_ids[i]].append((self.product_ids[j], round(value, 4)))
+        return result
+
+async def load_likes(query: dict) -> dict:
+    products = db.products.find(query, {"_id": 0, "id": 1, "liked_by": 1})
+    return {product['id']: product.get('liked_by', []) async for product in products}
+
+async def load_order_baskets(query: dict) -> dict:
+    # Single-item orders pair nothing with anything
+    query = {**query, "order_status": {"$ne": "cancelled"}, "items.1": {"$exists": True}}
+    orders = db.orders.find(query, {"_id": 0, "id": 1, "items.product_id": 1})
+    return {
+        order['id']: [item['product_id'] for item in order['items'] if item.get('product_id')]
+        async for order in orders
+    }
+
+class SimilarProductsIndex:
+    """In-memory neighbour lists, synced from `product_similarities` on every worker"""
+
+    def __init__(self):
+        self.neighbours = {}
+        self.synced_at = None
+
+    def get(self, product_id: str, limit: int) -> List[str]:
+        return [neighbour_id for neighbour_id, _ in self.neighbours.get(product_id, ())[:limit]]
+
+    async def sync(self):
+        # $gte: documents written in the same millisecond as the last sync may have been missed
+        query = {"updated_at": {"$gte": self.synced_at}} if self.synced_at else {}
+        async for doc in db.product_similarities.find(query):
+            self.neighbours[doc['_id']] = [(n['id'], n['score']) for n in doc['neighbours']]
+            if self.synced_at is None or doc['updated_at'] > self.synced_at:
+                self.synced_at = doc['updated_at']
+
+similar_products_index = SimilarProductsIndex()
+
+async def save_similarities(neighbours: dict, batch_size: int = 1000):
+    now = datetime.now(timezone.utc)
+    operations = [
+        ReplaceOne(
+            {"_id": product_id},
+            {"neighbours": [{"id": n, "score": score} for n, score in ranked], "updated_at": now},
+            upsert=True
+        )
+        for product_id, ranked in neighbours.items()
+    ]
+    for start in range(0, len(operations), batch_size):
+        await db.product_similarities.bulk_write(operations[start:start + batch_size], ordered=False)
+
+async def maintain_similar_products():
+    """Leader builds and refreshes the index in `product_similarities`; every worker syncs from it"""
+    owner = new_id()
+    matrix, built_at, changes_since = None, 0.0, None
+    while True:
+        try:
+            await similar_products_index.sync()
+            if await acquire_lease("similar_products", owner, SIMILAR_REFRESH_SECONDS * 3):
+                started = datetime.now(timezone.utc)
+                if matrix is None or time.monotonic() - built_at > SIMILAR_REBUILD_SECONDS:
+                    likes = await load_likes({"liked_by.0": {"$exists": True}})
+                    baskets = await load_order_baskets({})
+                    matrix = CoLikeMatrix()
+                    await asyncio.to_thread(matrix.replace_likes, likes)
+                    await asyncio.to_thread(matrix.add_orders, baskets)
+                    rows = None
+                    built_at = time.monotonic()
+                else:
+                    # Cancelled orders are only dropped by the next full build
+                    likes = await load_likes({"likes_changed_at": {"$gte": changes_since}})
+                    baskets = await load_order_baskets({"created_at": {"$gte": changes_since}})
+                    liked = await asyncio.to_thread(matrix.replace_likes, likes)
+                    rows = await asyncio.to_thread(matrix.add_orders, baskets)
+                    rows[:len(liked)] |= liked
+                changes_since = started
+                if rows is None or rows.any():
+                    await save_similarities(await asyncio.to_thread(matrix.neighbours, rows))
+                    await similar_products_index.sync()
+            else:
+                matrix = None
+        except Exception:
+            # A half-applied incremental update leaves the matrix inconsistent; rebuild it
+            matrix = None
+            logger.exception("Similar products refresh failed")
+        await asyncio.sleep(SIMILAR_REFRESH_SECONDS)
+
+@api_router.get("/products/{product_id}/similar", response_model=List[Product])
+async def get_similar_products(product_id: str, limit: int = 10):
+    """Products liked or ordered together with this one, best match first"""
+    neighbour_ids = similar_products_index.get(product_id, max(1, min(limit, SIMILAR_PRODUCTS_K)))
+    if not neighbour_ids:
+        return []
+    products = await db_read.products.find(
+        {"id": {"$in": neighbour_ids}}, {"_id": 0, "liked_by": 0}
+    ).to_list(len(neighbour_ids))
+    by_id = {product['id']: product for product in products}
+    return [by_id[neighbour_id] for neighbour_id in neighbour_ids if neighbour_id in by_id]
+
+# ==========================
+# HOME FEED
+# ==========================
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire `ttl` seconds after being set"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+feed_cache = TTLCache(FEED_CACHE_SIZE, FEED_CACHE_TTL_SECONDS)
+
+def feed_cell(latitude: float, longitude: float) -> str:
+    """Grid cell of FEED_GRID_DEGREES holding a location, the key of its nearby candidates"""
+    return f"cell:{math.floor(latitude / FEED_GRID_DEGREES)}:{math.floor(longitude / FEED_GRID_DEGREES)}"
+
+def ranked(scores: dict, limit: int) -> list:
+    """Top `limit` [id, score] pairs, scores scaled so the best is 1"""
+    top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+    best = top[0][1] if top and top[0][1] > 0 else 1
+    return [[item_id, round(score / best, 4)] for item_id, score in top]
+
+async def trending_candidates(since: datetime) -> list:
+    """Products ordered or liked the most since `since`"""
+    scores = {}
+    pipeline = [
+        {"$match": {"created_at": {"$gte": since}, "order_status": {"$ne": "cancelled"}}},
+        {"$unwind": "$items"},
+        {"$match": {"items.product_id": {"$ne": None}}},
+        {"$group": {"_id": "$items.product_id", "units": {"$sum": "$items.quantity"}}},
+        {"$sort": {"units": -1}},
+        {"$limit": FEED_CANDIDATES},
+    ]
+    async for row in db.orders.aggregate(pipeline):
+        scores[row['_id']] = FEED_ORDER_WEIGHT * row['units']
+    liked = db.products.find(
+        {"likes_changed_at": {"$gte": since}}, {"_id": 0, "id": 1, "likes": 1}
+    ).sort("likes", -1).limit(FEED_CANDIDATES)
+    async for product in liked:
+        scores[product['id']] = scores.get(product['id'], 0) + product.get('likes', 0)
+    return ranked(scores, FEED_CANDIDATES)
+
+async def category_candidates() -> dict:
+    """{category: most liked products in it}"""
+    tops = {}
+    for category in await db.products.distinct("category"):
+        products = await db.products.find(
+            {"category": category, "likes": {"$gt": 0}}, {"_id": 0, "id": 1, "likes": 1}
+        ).sort("likes", -1).limit(FEED_CANDIDATES).to_list(FEED_CANDIDATES)
+        tops[category] = ranked({product['id']: product['likes'] for product in products}, FEED_CANDIDATES)
+    return tops
+
+async def nearby_candidates() -> dict:
+    """{cell: best rated stores and most liked products in it and the 8 cells around it}"""
+    stores_by_cell, products_by_cell = {}, {}
+    async for store in db.stores.find({}, STORE_SNAPSHOT_PROJECTION):
+        cell = (math.floor(store['latitude'] / FEED_GRID_DEGREES), math.floor(store['longitude'] / FEED_GRID_DEGREES))
+        stores_by_cell.setdefault(cell, []).append(store)
+    products = db.products.find(
+        {"likes": {"$gt": 0}}, {"_id": 0, "id": 1, "likes": 1, "store.latitude": 1, "store.longitude": 1}
+    )
+    async for product in products:
+        store = product.get('store')
+        if not store:
+            continue
+        cell = (math.floor(store['latitude'] / FEED_GRID_DEGREES), math.floor(store['longitude'] / FEED_GRID_DEGREES))
+        heap = products_by_cell.setdefault(cell, [])
+        entry = (product['likes'], product['id'])
+        if len(heap) < FEED_CANDIDATES:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    
+    neighbourhood = {(i + di, j + dj) for i, j in stores_by_cell for di in (-1, 0, 1) for dj in (-1, 0, 1)}
+    cells = {}
+    for i, j in neighbourhood:
+        around = [(i + di, j + dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+        stores = heapq.nlargest(
+            FEED_NEARBY_STORES, itertools.chain.from_iterable(stores_by_cell.get(c, ()) for c in around),
+            key=lambda store: (store.get('rating', 0), store.get('reviews_count', 0))
+        )
+        liked = {product_id: likes for c in around for likes, product_id in products_by_cell.get(c, ())}
+        cells[f"cell:{i}:{j}"] = {
+            "stores": [store_snapshot(store) for store in stores],
+            "products": ranked(liked, FEED_CANDIDATES),
+        }
+    return cells
+
+async def category_affinities(user_ids: Optional[List[str]] = None) -> dict:
+    """{user_id: {category: weight}} from the products users liked and ordered, for all users or `user_ids`"""
+    affinities = {}
+    
+    def add(user_id, category, weight):
+        if category:
+            user = affinities.setdefault(user_id, {})
+            user[category] = user.get(category, 0) + weight
+    
+    match = {"liked_by.0": {"$exists": True}} if user_ids is None else {"liked_by": {"$in": user_ids}}
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "category": 1, "liked_by": 1}},
+        {"$unwind": "$liked_by"},
+    ]
+    if user_ids is not None:
+        pipeline.append({"$match": {"liked_by": {"$in": user_ids}}})
+    pipeline.append({"$group": {"_id": {"user": "$liked_by", "category": "$category"}, "count": {"$sum": 1}}})
+    async for row in db.products.aggregate(pipeline, allowDiskUse=True):
+        add(row['_id']['user'], row['_id'].get('category'), row['count'])
+    
+    match = {"order_status": {"$ne": "cancelled"}}
+    if user_ids is not None:
+        match["user_id"] = {"$in": user_ids}
+    pipeline = [
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$match": {"items.product_id": {"$ne": None}}},
+        {"$lookup": {"from": "products", "localField": "items.product_id", "foreignField": "id", "as": "product"}},
+        {"$unwind": "$product"},
+        {"$group": {"_id": {"user": "$user_id", "category": "$product.category"}, "units": {"$sum": "$items.quantity"}}},
+    ]
+    async for row in db.orders.aggregate(pipeline, allowDiskUse=True):
+        add(row['_id']['user'], row['_id'].get('category'), FEED_ORDER_WEIGHT * row['units'])
+    return affinities
+
+async def active_user_ids(since: datetime) -> List[str]:
+    """Users who liked or ordered since `since`; unlikes are only picked up by the next full build"""
+    user_ids = set()
+    async for product in db.products.find({"likes_changed_at": {"$gte": since}}, {"_id": 0, "liked_by": 1}):
+        user_ids.update(product.get('liked_by', []))
+    user_ids.update(await db.orders.distinct("user_id", {"created_at": {"$gte": since}}))
+    return list(user_ids)
+
+def personal_candidates(affinity: dict, category_tops: dict) -> list:
+    total = sum(affinity.values())
+    scores = {}
+    for category, weight in affinity.items():
+        for product_id, score in category_tops.get(category, ()):
+            scores[product_id] = scores.get(product_id, 0) + score * weight / total
+    return ranked(scores, FEED_CANDIDATES)
+
+async def build_feed_candidates(since: Optional[datetime] = None, batch_size: int = 1000):
+    """Write the feed's candidate lists to `feed_candidates`.
+
+    Trending and per-cell lists are global and rebuilt on every pass; the
+    per-user lists only for users active since `since` (all users when None).
+    """
+    started = datetime.now(timezone.utc)
+    trending_since = started - timedelta(days=FEED_TRENDING_DAYS)
+    top_stores = await db.stores.find({}, STORE_SNAPSHOT_PROJECTION).sort("rating", -1).limit(FEED_NEARBY_STORES).to_list(FEED_NEARBY_STORES)
+    docs = {
+        "trending": {
+            "stores": [store_snapshot(store) for store in top_stores],
+            "products": await trending_candidates(trending_since),
+        },
+        **await nearby_candidates(),
+    }
+    
+    category_tops = await category_candidates()
+    if since is None:
+        affinities = await category_affinities()
+    else:
+        user_ids, affinities = await active_user_ids(since), {}
+        for start in range(0, len(user_ids), batch_size):
+            affinities.update(await category_affinities(user_ids[start:start + batch_size]))
+    for user_id, affinity in affinities.items():
+        docs[f"user:{user_id}"] = {"products": personal_candidates(affinity, category_tops)}
+    
+    operations = [ReplaceOne({"_id": key}, {**doc, "updated_at": started}, upsert=True) for key, doc in docs.items()]
+    for start in range(0, len(operations), batch_size):
+        await db.feed_candidates.bulk_write(operations[start:start + batch_size], ordered=False)
+    if since is None:
+        # Cells whose stores are gone and users whose history is empty
+        await db.feed_candidates.delete_many({"updated_at": {"$lt": started}})
+
+async def maintain_feed_candidates():
+    owner = new_id()
+    built_at, since = 0.0, None
+    while True:
+        try:
+            if await acquire_lease("feed_candidates", owner, FEED_REFRESH_SECONDS * 3):
+                started = datetime.now(timezone.utc)
+                if since is None or time.monotonic() - built_at > FEED_REBUILD_SECONDS:
+                    await build_feed_candidates()
+                    built_at = time.monotonic()
+                else:
+                    await build_feed_candidates(since)
+                since = started
+            else:
+                since = None
+        except Exception:
+            logger.exception("Feed candidates refresh failed")
+        await asyncio.sleep(FEED_REFRESH_SECONDS)
+
+async def assemble_feed(user_id: str, cell: Optional[str]) -> dict:
+    """Blend the user's, the trending and the nearby candidate lists into one ranking"""
+    sources = {"personal": f"user:{user_id}", "trending": "trending"}
+    if cell:
+        sources["nearby"] = cell
+    docs = {
+        doc['_id']: doc
+        async for doc in db_read.feed_candidates.find({"_id": {"$in": list(sources.values())}})
+    }
+    scores = {}
+    for source, key in sources.items():
+        for product_id, score in docs.get(key, {}).get("products", ()):
+            scores[product_id] = scores.get(product_id, 0) + FEED_WEIGHTS[source] * score
+    stores = docs.get(cell, {}).get("stores") or docs.get("trending", {}).get("stores", [])
+    return {
+        "stores": stores,
+        "products": [product_id for product_id, _ in heapq.nlargest(FEED_CANDIDATES, scores.items(), key=lambda item: item[1])],
+    }
+
+class Feed(BaseModel):
+    stores: List[StoreSnapshot]
+    products: List[Product]
+
+@api_router.get("/feed", response_model=Feed)
+async def get_feed(latitude: Optional[float] = None, longitude: Optional[float] = None, limit: int = FEED_SIZE,
+                   current_user: User = Depends(get_current_user)):
+    """Personalised home feed: nearby stores, and products from the categories
+    the user likes and orders, from nearby stores and trending overall.
+
+    Candidates are precomputed by `maintain_feed_candidates`; a request is a
+    cache lookup plus one `$in` for the products.
+    """
+    cell = feed_cell(latitude, longitude) if latitude is not None and longitude is not None else None
+    key = (current_user.id, cell)
+    feed = feed_cache.get(key)
+    if feed is None:
+        feed = await assemble_feed(current_user.id, cell)
+        feed_cache.set(key, feed)
+    
+    product_ids = feed['products'][:max(1, min(limit, FEED_CANDIDATES))]
+    products = await db_read.products.find(
+        {"id": {"$in": product_ids}}, {"_id": 0, "liked_by": 0}
+    ).to_list(len(product_ids))
+    by_id = {product['id']: product for product in products}
+    
+    return {"stores": feed['stores'], "products": [by_id[product_id] for product_id in product_ids if product_id in by_id]}
+
+# ==========================
+# BROWSE
+# ==========================
+
+# How each browsable collection exposes the filterable fields: products and
+# services filter on their embedded store snapshot's rating and location
+BrowseKind = namedtuple("BrowseKind", "model rating location price stock sorts")
+
+BROWSE_KINDS = {
+    "products": BrowseKind(Product, "store.rating", "store.", True, True, ("newest", "price_asc", "price_desc", "rating", "likes")),
+    "services": BrowseKind(Service, "store.rating", "store.", True, False, ("newest", "price_asc", "price_desc", "rating")),
+    "stores": BrowseKind(Store, "rating", "", False, False, ("newest", "rating")),
+}
+
+# Sort orders end on `id` so equal keys page deterministically; None is the kind's rating field
+BROWSE_SORTS = {
+    "newest": [("created_at", DESCENDING), ("id", DESCENDING)],
+    "price_asc": [("price", ASCENDING), ("id", ASCENDING)],
+    "price_desc": [("price", DESCENDING), ("id", DESCENDING)],
+    "rating": [(None, DESCENDING), ("id", DESCENDING)],
+    "likes": [("likes", DESCENDING), ("id", DESCENDING)],
+    "stock": [("stock", DESCENDING), ("id", DESCENDING)],
+}
+
+STORE_CATALOGUE_SORTS = {
+    "products": ("newest", "price_asc", "price_desc", "likes", "stock"),
+    "services": ("newest", "price_asc", "price_desc"),
+}
+
+def keyset_after(sort_spec: list, anchor: dict) -> dict:
+    """Filter for the documents after `anchor` in a two-key sort order whose second key is unique"""
+    (field, direction), (tie, tie_direction) = sort_spec
+    value = anchor.get(field)
+    return {"$or": [
+        {field: {"$gt" if direction == ASCENDING else "$lt": value}},
+        {field: value, tie: {"$gt" if tie_direction == ASCENDING else "$lt": anchor[tie]}},
+    ]}
+
+async def store_catalogue(name: str, store_id: str, sort: str, category: Optional[str], min_price: Optional[float],
+                          max_price: Optional[float], in_stock: bool, after: Optional[str], limit: int) -> list:
+    """One page of a store's products or services, served from the (store_id, sort key, id) indexes"""
+    if sort not in STORE_CATALOGUE_SORTS[name]:
+        raise HTTPException(status_code=400, detail="ترتيب غير مدعوم")
+    sort_spec = BROWSE_SORTS[sort]
+    limit = max(1, min(limit, STORE_CATALOGUE_PAGE_MAX))
+    
+    query = {"store_id": store_id}
+    if category:
+        query['category'] = category
+    if min_price is not None or max_price is not None:
+        query['price'] = {}
+        if min_price is not None:
+            query['price']['$gte'] = min_price
+        if max_price is not None:
+            query['price']['$lte'] = max_price
+    if in_stock:
+        query['stock'] = {"$gt": 0}
+    if after:
+        anchor = await db[name].find_one(
+            {"id": after, "store_id": store_id}, {"_id": 0, **{field: 1 for field, _ in sort_spec}}
+        )
+        if not anchor:
+            raise HTTPException(status_code=404, detail="العنصر غير موجود")
+        query = {"$and": [query, keyset_after(sort_spec, anchor)]}
+    
+    return await db[name].find(query, {"_id": 0}).sort(sort_spec).limit(limit).to_list(limit)
+
+browse_facet_cache = TTLCache(BROWSE_FACET_CACHE_SIZE, BROWSE_FACET_CACHE_TTL_SECONDS)
+
+def browse_filters(kind: BrowseKind, min_price: Optional[float], max_price: Optional[float], min_rating: Optional[float],
+                   in_stock: bool, latitude: Optional[float], longitude: Optional[float], radius_km: float) -> dict:
+    """Mongo filter for everything but the category"""
+    query = {}
+    if kind.price and (min_price is not None or max_price is not None):
+        query['price'] = {}
+        if min_price is not None:
+            query['price']['$gte'] = min_price
+        if max_price is not None:
+            query['price']['$lte'] = max_price
+    if min_rating is not None:
+        query[kind.rating] = {"$gte": min_rating}
+    if kind.stock and in_stock:
+        query['stock'] = {"$gt": 0}
+    if latitude is not None and longitude is not None:
+        # Bounding box of the radius; there is no geo index on these fields
+        lat_delta = radius_km / 111.32
+        lng_delta = radius_km / (111.32 * max(math.cos(math.radians(latitude)), 0.01))
+        query[f"{kind.location}latitude"] = {"$gte": latitude - lat_delta, "$lte": latitude + lat_delta}
+        query[f"{kind.location}longitude"] = {"$gte": longitude - lng_delta, "$lte": longitude + lng_delta}
+    return query
+
+async def browse_facets(name: str, kind: BrowseKind, query: dict, categories: Optional[List[str]]) -> dict:
+    """Result count and facet counts for a filter, in one `$facet` aggregation.
+
+    Category counts ignore the category filter so the sidebar keeps listing
+    every category; the other facets count within all current filters.
+    Results are cached per filter for BROWSE_FACET_CACHE_TTL_SECONDS.
+    """
+    cache_key = (name, json.dumps(query, sort_keys=True), tuple(categories or ()))
+    facets = browse_facet_cache.get(cache_key)
+    if facets is not None:
+        return facets
+    
+    in_category = [{"$match": {"category": {"$in": categories}}}] if categories else []
+    pipelines = {
+        "total": in_category + [{"$count": "count"}],
+        "category": [{"$group": {"_id": "$category", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+        "rating": in_category + [
+            {"$group": {"_id": {"$floor": {"$ifNull": [f"${kind.rating}", 0]}}, "count": {"$sum": 1}}},
+        ],
+    }
+    if kind.price:
+        pipelines["price"] = in_category + [{"$bucket": {
+            "groupBy": "$price", "boundaries": BROWSE_PRICE_BUCKETS, "default": "other",
+            "output": {"count": {"$sum": 1}},
+        }}]
+    if kind.stock:
+        pipelines["in_stock"] = in_category + [{"$match": {"stock": {"$gt": 0}}}, {"$count": "count"}]
+    result = (await db_read[name].aggregate([{"$match": query}, {"$facet": pipelines}]).to_list(1))[0]
+    
+    facets = {
+        "total": result["total"][0]["count"] if result["total"] else 0,
+        "category": [{"value": row["_id"], "count": row["count"]} for row in result["category"]],
+        "rating": [
+            {"min": int(row["_id"]), "count": row["count"]}
+            for row in sorted(result["rating"], key=lambda row: row["_id"], reverse=True)
+        ],
+    }
+    if kind.price:
+        # Each bucket is [boundary, next boundary); "other" is everything from the last boundary up
+        upper = dict(zip(BROWSE_PRICE_BUCKETS, BROWSE_PRICE_BUCKETS[1:]))
+        facets["price"] = [
+            {"min": row["_id"], "max": upper[row["_id"]], "count": row["count"]} if row["_id"] != "other"
+            else {"min": BROWSE_PRICE_BUCKETS[-1], "max": None, "count": row["count"]}
+            for row in result["price"]
+        ]
+    if kind.stock:
+        facets["in_stock"] = result["in_stock"][0]["count"] if result["in_stock"] else 0
+    browse_facet_cache.set(cache_key, facets)
+    return facets
+
+@api_router.get("/browse/{kind}")
+async def browse(kind: str, category: Optional[str] = None, min_price: Optional[float] = None,
+                 max_price: Optional[float] = None, min_rating: Optional[float] = None, in_stock: bool = False,
+                 latitude: Optional[float] = None, longitude: Optional[float] = None,
+                 radius_km: float = BROWSE_DEFAULT_RADIUS_KM, sort: str = "newest", page: int = 1, limit: int = 20):
+    """Filtered page of products, services or stores with facet counts for the filter sidebar.
+
+    `category` takes a comma-separated list. Filters and sort orders are
+    served by the compound indexes in INDEXES; facet counts come from
+    `browse_facets`.
+    """
+    browse_kind = BROWSE_KINDS.get(kind)
+    if browse_kind is None:
+        raise HTTPException(status_code=404, detail="نوع التصفح غير موجود")
+    if sort not in browse_kind.sorts:
+        raise HTTPException(status_code=400, detail="ترتيب غير مدعوم")
+    limit = max(1, min(limit, BROWSE_PAGE_MAX))
+    page = max(1, page)
+    
+    categories = [value.strip() for value in category.split(",") if value.strip()] if category else None
+    query = browse_filters(browse_kind, min_price, max_price, min_rating, in_stock, latitude, longitude, radius_km)
+    items_query = {**query, "category": {"$in": categories}} if categories else query
+    sort_spec = [(field or browse_kind.rating, direction) for field, direction in BROWSE_SORTS[sort]]
+    
+    items, facets = await asyncio.gather(
+        db_read[kind].find(items_query, {"_id": 0, "liked_by": 0}).sort(sort_spec).skip((page - 1) * limit).limit(limit).to_list(limit),
+        browse_facets(kind, browse_kind, query, categories),
+    )
+    if kind != "stores":
+        await attach_store_snapshots(items)
+    
+    return {
+        "items": [browse_kind.model(**item) for item in items],
+        "page": page,
+        "limit": limit,
+        "facets": facets,
+    }
+
 # ==========================
 # IMAGE UPLOAD
 # ==========================
@@ -931,6 +3681,753 @@ async def upload_image(file: UploadFile = File(...), current_user: User = Depend
     
     return {"image_url": data_url}
 
+# ==========================
+# ADMIN ROUTES
+# ==========================
+
+def job_status(job_doc: dict) -> dict:
+    return {
+        "id": job_doc['_id'],
+        **{field: job_doc.get(field) for field in ("name", "status", "attempts", "error", "run_at", "created_at", "finished_at")},
+    }
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Status of a background job queued by the current user"""
+    job_doc = await db.jobs.find_one({"_id": job_id})
+    if not job_doc or (job_doc.get('user_id') != current_user.id and current_user.email.lower() not in ADMIN_EMAILS):
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+    return job_status(job_doc)
+
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(limit: int = 50, current_user: User = Depends(get_admin_user)):
+    entries = list(slow_query_recorder.entries)
+    return {
+        "threshold_ms": slow_query_recorder.threshold_ms,
+        "worst_offenders": slow_query_recorder.worst_offenders(entries, limit=10),
+        "recent": entries[-limit:][::-1],
+    }
+
+@api_router.get("/admin/jobs")
+async def get_jobs(status: Optional[str] = None, limit: int = 50, current_user: User = Depends(get_admin_user)):
+    query = {"status": status} if status else {}
+    jobs = await db.jobs.find(query).sort("created_at", DESCENDING).limit(min(limit, 500)).to_list(min(limit, 500))
+    return [job_status(job_doc) for job_doc in jobs]
+
+# ==========================
+# RATE LIMITING
+# ==========================
+
+RateLimit = namedtuple("RateLimit", ["capacity", "rate"])
+
+def parse_rate_limit(value: str) -> Optional[RateLimit]:
+    """Parse "<requests>/<seconds>" into a token bucket (burst capacity, refill per second)."""
+    if not value:
+        return None
+    requests_count, seconds = value.split("/")
+    return RateLimit(capacity=float(requests_count), rate=float(requests_count) / float(seconds))
+
+# Exact API paths mapped to their route group; every other /api path is "default"
+RATE_LIMIT_ROUTES = {
+    "/api/auth/login": "auth",
+    "/api/auth/register": "auth",
+    # Unauthenticated and answers whether an email is registered; its own
+    # bucket so typing never uses up the login and registration allowance
+    "/api/auth/availability": "availability",
+    "/api/search": "search",
+    "/api/browse/products": "search",
+    "/api/browse/services": "search",
+    "/api/browse/stores": "search",
+    "/api/upload-image": "upload",
+    "/api/auth/upload-avatar": "upload",
+}
+
+class RateLimitBackend(ABC):
+    """Token bucket store. Subclass to share buckets across workers (e.g. Redis)."""
+
+    @abstractmethod
+    async def take(self, key: str, limit: RateLimit) -> float:
+        """Consume one token; return 0 if allowed, else the seconds until a token is available."""
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """In-process buckets, bounded to `max_keys` least recently used keys."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, limit: RateLimit) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = limit.capacity
+        else:
+            tokens = min(limit.capacity, bucket[0] + (now - bucket[1]) * limit.rate)
+            self._buckets.move_to_end(key)
+        
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            retry_after = 0.0
+        else:
+            self._buckets[key] = (tokens, now)
+            retry_after = (1 - tokens) / limit.rate
+        
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+def rate_limit_identity(scope, use_token: bool = True) -> str:
+    """Key requests by the verified JWT subject, falling back to the client IP."""
+    headers = dict(scope.get("headers") or [])
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if use_token and authorization[:7].lower() == "bearer ":
+        try:
+            user_id = decode_access_token(authorization[7:]).get("sub")
+            if user_id:
+                return f"user:{user_id}"
+        except JWTError:
+            pass
+    
+    forwarded_for = headers.get(b"x-forwarded-for")
+    if forwarded_for:
+        if RATE_LIMIT_PROXY_HOPS:
+            hops = [hop.strip() for hop in forwarded_for.decode("latin-1").split(",")]
+            return f"ip:{hops[-min(RATE_LIMIT_PROXY_HOPS, len(hops))]}"
+        warn_untrusted_proxy()
+    client_addr = scope.get("client")
+    return f"ip:{client_addr[0] if client_addr else 'unknown'}"
+
+@functools.lru_cache(maxsize=1)
+def warn_untrusted_proxy():
+    # Once per worker: behind a proxy every anonymous client would share the proxy's buckets
+    logger.warning(
+        "Requests carry X-Forwarded-For but RATE_LIMIT_PROXY_HOPS=0: anonymous clients are rate "
+        "limited by the proxy's address, as one client. Set RATE_LIMIT_PROXY_HOPS to the number of proxies."
+    )
+
+class RateLimitMiddleware:
+    """ASGI middleware applying per-route-group token buckets to /api requests.
+
+    Auth routes are always keyed by IP since their callers have no token yet.
+    Rejected requests get a 429 with a `Retry-After` header.
+    """
+
+    def __init__(self, app, backend: Optional[RateLimitBackend] = None, limits: Optional[dict] = None):
+        self.app = app
+        self.backend = backend or MemoryRateLimitBackend()
+        self.limits = {group: parse_rate_limit(value) for group, value in (limits or RATE_LIMITS).items()}
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "") if scope["type"] == "http" else ""
+        if not path.startswith("/api") or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+        
+        group = RATE_LIMIT_ROUTES.get(path.rstrip("/") or path, "default")
+        limit = self.limits.get(group)
+        if limit is None:
+            return await self.app(scope, receive, send)
+        
+        identity = rate_limit_identity(scope, use_token=group not in ("auth", "availability"))
+        retry_after = await self.backend.take(f"{group}:{identity}", limit)
+        if not retry_after:
+            return await self.app(scope, receive, send)
+        
+        body = json.dumps({"detail": "طلبات كثيرة جدًا، يرجى المحاولة لاحقًا"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(math.ceil(retry_after)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+# ==========================
+# LOAD SHEDDING
+# ==========================
+
+PRIORITY_ORDER = {"critical": 0, "normal": 1, "low": 2}
+
+metrics.describe("boral_admission_queue_seconds", "histogram", "Time requests waited for an admission slot.")
+metrics.describe("boral_admission_rejected_total", "counter", "Requests shed by admission control.")
+metrics.describe("boral_admission_latency_seconds", "gauge", "Smoothed request latency used as the overload signal.")
+
+# Long-lived responses bypass admission control instead of holding a slot
+# and skewing its latency estimate: event streams hold no database work
+# between events, and exports are bounded by EXPORT_MAX_CONCURRENT
+STREAM_PATH_SUFFIXES = ("/orders/stream", "/export/orders", "/export/products", "/export/reviews")
+
+def request_priority(method: str, path: str) -> str:
+    if path in ("/api/auth/login", "/api/auth/register") or (method == "POST" and path == "/api/orders"):
+        return "critical"
+    if path.startswith("/api/search") or path.startswith("/api/analytics/") or path.endswith("/analytics"):
+        return "low"
+    return "normal"
+
+class AdmissionController:
+    """Bounds concurrent requests and sheds load by priority.
+
+    At most `max_concurrent` requests run at once; the rest wait in a
+    priority queue for up to their priority's queue budget. Independently,
+    an exponentially smoothed latency is compared with the target: above it
+    low-priority requests are rejected straight away, above twice the
+    target normal ones are too. Critical requests are only ever limited by
+    the queue.
+    """
+
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+                 latency_target: float = ADMISSION_LATENCY_TARGET_MS / 1000,
+                 queue_wait: Optional[dict] = None, smoothing_seconds: float = 5.0):
+        self.max_concurrent = max_concurrent
+        self.latency_target = latency_target
+        self.queue_wait = {key: value / 1000 for key, value in (queue_wait or ADMISSION_QUEUE_WAIT_MS).items()}
+        self.smoothing_seconds = smoothing_seconds
+        self.in_flight = 0
+        self._latency = 0.0
+        self._latency_at = time.monotonic()
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    def latency(self, now: Optional[float] = None) -> float:
+        # Decays towards zero while nothing completes, so shedding every
+        # low-priority request cannot freeze the signal above the target
+        now = time.monotonic() if now is None else now
+        return self._latency * math.exp(-(now - self._latency_at) / self.smoothing_seconds)
+
+    def record_latency(self, seconds: float):
+        now = time.monotonic()
+        current = self.latency(now)
+        self._latency = current + 0.1 * (seconds - current)
+        self._latency_at = now
+        metrics.set("boral_admission_latency_seconds", (), round(self._latency, 4))
+
+    def shed_reason(self, priority: str) -> Optional[str]:
+        if priority == "critical":
+            return None
+        overload = self.latency() / self.latency_target
+        if overload > (1 if priority == "low" else 2):
+            return "latency"
+        return None
+
+    async def acquire(self, priority: str) -> bool:
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            return True
+        
+        max_wait = self.queue_wait.get(priority, 0)
+        if max_wait <= 0:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITY_ORDER[priority], next(self._sequence), future))
+        try:
+            await asyncio.wait({future}, timeout=max_wait)
+        except asyncio.CancelledError:
+            # The client went away while queued: pass on a slot handed over
+            # in the meantime, or make sure release() skips this waiter
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        if future.done():
+            # release() handed its slot over
+            return True
+        future.cancel()
+        return False
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.in_flight -= 1
+
+class AdmissionControlMiddleware:
+    """ASGI middleware applying AdmissionController and per-request deadlines to /api requests.
+
+    Shed requests get a fast 503 with `Retry-After`. Admitted requests get a
+    deadline (arrival plus their priority's REQUEST_DEADLINE_MS) that the
+    route handler turns into the Mongo time budget.
+    """
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None, deadlines: Optional[dict] = None):
+        self.app = app
+        self.controller = controller or AdmissionController()
+        self.deadlines = {key: value / 1000 for key, value in (deadlines or REQUEST_DEADLINE_MS).items()}
+
+    async def reject(self, send, priority: str, reason: str):
+        metrics.inc("boral_admission_rejected_total", (("priority", priority), ("reason", reason)))
+        body = json.dumps({"detail": "الخدمة مشغولة حاليًا، يرجى المحاولة لاحقًا"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", b"1"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "") if scope["type"] == "http" else ""
+        if not path.startswith("/api") or scope["method"] == "OPTIONS" or path.endswith(STREAM_PATH_SUFFIXES):
+            return await self.app(scope, receive, send)
+        
+        priority = request_priority(scope["method"], path)
+        reason = self.controller.shed_reason(priority)
+        if reason:
+            return await self.reject(send, priority, reason)
+        
+        arrived = time.monotonic()
+        if not await self.controller.acquire(priority):
+            return await self.reject(send, priority, "queue")
+        queued = time.monotonic() - arrived
+        metrics.observe("boral_admission_queue_seconds", (("priority", priority),), queued)
+        
+        token = request_deadline.set(arrived + self.deadlines[priority])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_deadline.reset(token)
+            self.controller.release()
+            if priority != "critical":
+                self.controller.record_latency(time.monotonic() - arrived)
+
+# ==========================
+# LEASES
+# ==========================
+
+async def acquire_lease(name: str, owner: str, seconds: float, collection=None) -> bool:
+    """Take or renew a named lease so only one worker runs a background task at a time.
+
+    Succeeds if the lease is free, expired or already held by `owner`.
+    """
+    collection = db.leases if collection is None else collection
+    now = datetime.now(timezone.utc)
+    try:
+        await collection.update_one(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+# ==========================
+# INDEXES
+# ==========================
+
+INDEXES = {
+    "users": [
+        # The unique email and username indexes are built by migration 7,
+        # once any duplicate accounts are renamed
+        # Account name filter refresh
+        IndexModel([("updated_at", ASCENDING)], sparse=True),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Conversation history pages, newest first
+        IndexModel([("conversation_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "messages_archive": [
+        IndexModel([("conversation_id", ASCENDING), ("last_at", DESCENDING)]),
+        IndexModel([("conversation_id", ASCENDING), ("messages.id", ASCENDING)]),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("likes_changed_at", ASCENDING)], sparse=True),
+        # Feed: most liked products per category, and a user's liked products
+        IndexModel([("category", ASCENDING), ("likes", DESCENDING)]),
+        IndexModel([("liked_by", ASCENDING)]),
+        # Browse: category plus each sort key, and the location box
+        IndexModel([("category", ASCENDING), ("price", ASCENDING)]),
+        IndexModel([("category", ASCENDING), ("store.rating", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("store.latitude", ASCENDING), ("store.longitude", ASCENDING)]),
+        # A store's catalogue in each sort order (descending sorts walk these backwards)
+        IndexModel([("store_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("price", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("likes", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("stock", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "services": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("category", ASCENDING), ("price", ASCENDING)]),
+        IndexModel([("category", ASCENDING), ("store.rating", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("store.latitude", ASCENDING), ("store.longitude", ASCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("store_id", ASCENDING), ("price", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "stores": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Ownership checks and a user's stores
+        IndexModel([("owner_id", ASCENDING)]),
+        IndexModel([("category", ASCENDING), ("rating", DESCENDING)]),
+        IndexModel([("category", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("latitude", ASCENDING), ("longitude", ASCENDING)]),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        # A store's orders newest first, and exports by date range
+        IndexModel([("store_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "reviews": [
+        IndexModel([("store_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "product_similarities": [
+        IndexModel([("updated_at", ASCENDING)]),
+    ],
+    "order_events": [
+        IndexModel([("store_id", ASCENDING), ("seq", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=ORDER_EVENT_LOG_HOURS * 3600),
+    ],
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+        # Finished jobs only; queued and running ones have no finished_at
+        IndexModel([("finished_at", ASCENDING)], expireAfterSeconds=JOB_RETENTION_HOURS * 3600),
+    ],
+    "conversation_members": [
+        IndexModel([("conversation_id", ASCENDING), ("user_id", ASCENDING)], unique=True),
+        # Per-conversation unread counts, and the conversation list newest first
+        IndexModel([("user_id", ASCENDING), ("unread", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("last_at", DESCENDING)]),
+    ],
+}
+
+async def ensure_indexes():
+    await asyncio.gather(*(
+        db[collection].create_indexes(indexes) for collection, indexes in INDEXES.items()
+    ))
+
+# ==========================
+# MIGRATIONS
+# ==========================
+
+MIGRATION_LOCK_SECONDS = 300
+
+Backfill = namedtuple("Backfill", "collection query projection transform")
+
+class Migration:
+    """A versioned schema change made of backfills over one or more collections.
+
+    Each backfill selects the documents still in the old shape with `query`
+    and maps each one to an update with `transform` (None to skip it; an
+    async transform is awaited, for updates that need a lookup). The
+    runner walks matches in `_id` order and checkpoints the last `_id` after
+    every batch, so an interrupted migration resumes where it stopped.
+    Steps are async callables run once the backfills are done, for changes
+    that are not per-document (aggregations, counters); they must be safe
+    to run again after an interruption.
+    """
+
+    def __init__(self, version: int, name: str):
+        self.version = version
+        self.name = name
+        self.backfills = []
+        self.steps = []
+
+    def step(self, operation):
+        self.steps.append(operation)
+        return operation
+
+    def backfill(self, collection: str, query: dict, projection: Optional[dict] = None):
+        def register(transform):
+            self.backfills.append(Backfill(collection, query, projection, transform))
+            return transform
+        return register
+
+migrations = []
+
+def register_migration(version: int, name: str) -> Migration:
+    migration = Migration(version, name)
+    migrations.append(migration)
+    migrations.sort(key=lambda m: m.version)
+    return migration
+
+product_images = register_migration(1, "products: image -> images")
+
+@product_images.backfill("products", {"image": {"$exists": True}}, {"image": 1, "images": 1})
+def move_product_image(doc):
+    update = {"$unset": {"image": ""}}
+    if "images" not in doc:
+        update["$set"] = {"images": [doc["image"]] if doc["image"] else []}
+    return update
+
+# Date fields written as ISO strings before dates were stored as BSON dates;
+# "array.field" names a field inside each element of an array
+DATE_FIELDS = {
+    "users": ["created_at"],
+    "stores": ["created_at", "updated_at"],
+    "products": ["created_at", "updated_at"],
+    "services": ["created_at"],
+    "messages": ["created_at"],
+    "reviews": ["created_at"],
+    "orders": ["created_at", "status_history.changed_at"],
+}
+
+def parse_date(value):
+    if not isinstance(value, str):
+        return value
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def date_fields_update(fields: List[str]):
+    def transform(doc):
+        update = {}
+        for field in fields:
+            array, _, key = field.partition(".")
+            if key:
+                items = doc.get(array) or []
+                if any(isinstance(item.get(key), str) for item in items):
+                    update[array] = [{**item, key: parse_date(item.get(key))} for item in items]
+            elif isinstance(doc.get(field), str):
+                update[field] = parse_date(doc[field])
+        return {"$set": update} if update else None
+    return transform
+
+string_dates = register_migration(2, "ISO date strings -> BSON dates")
+for collection_name, fields in DATE_FIELDS.items():
+    string_dates.backfill(
+        collection_name,
+        {"$or": [{field: {"$type": "string"}} for field in fields]},
+        {field.partition(".")[0]: 1 for field in fields},
+    )(date_fields_update(fields))
+
+message_conversations = register_migration(3, "messages: conversation_id")
+
+@message_conversations.backfill("messages", {"conversation_id": {"$exists": False}}, {"sender_id": 1, "receiver_id": 1})
+def set_conversation_id(doc):
+    return {"$set": {"conversation_id": conversation_key(doc['sender_id'], doc['receiver_id'])}}
+
+badge_counters = register_migration(4, "counters: unread messages and new orders")
+
+@badge_counters.step
+async def initialise_badge_counters():
+    # Unread: messages past the receiver's watermark that were not flagged
+    # read before watermarks existed
+    unread = await db.messages.aggregate([
+        {"$match": {"is_read": {"$ne": True}}},
+        {"$lookup": {
+            "from": "conversation_members",
+            "localField": "conversation_id",
+            "foreignField": "conversation_id",
+            "as": "members"
+        }},
+        # (conversation_id, user_id) is unique, so there is at most one receiver entry
+        {"$addFields": {"watermark": {"$ifNull": [{"$arrayElemAt": [{"$map": {
+            "input": {"$filter": {"input": "$members", "as": "member", "cond": {"$eq": ["$$member.user_id", "$receiver_id"]}}},
+            "as": "member",
+            "in": "$$member.last_read_at"
+        }}, 0]}, None]}}},
+        {"$match": {"$expr": {"$gt": ["$created_at", "$watermark"]}}},
+        {"$group": {"_id": {"conversation_id": "$conversation_id", "user_id": "$receiver_id"}, "unread": {"$sum": 1}}}
+    ]).to_list(None)
+    new_orders = await db.orders.aggregate([
+        {"$match": {"order_status": "pending"}},
+        {"$group": {"_id": "$store_id", "new_orders": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    totals = {}
+    for group in unread:
+        totals[group['_id']['user_id']] = totals.get(group['_id']['user_id'], 0) + group['unread']
+    await db.conversation_members.update_many({}, {"$set": {"unread": 0}})
+    await db.counters.update_many({}, {"$set": {"unread_messages": 0, "new_orders": 0}})
+    member_updates = [
+        UpdateOne(group['_id'], {"$set": {"unread": group['unread']}}, upsert=True) for group in unread
+    ]
+    counter_updates = [
+        UpdateOne({"_id": user_counter_id(user_id)}, {"$set": {"unread_messages": total}}, upsert=True)
+        for user_id, total in totals.items()
+    ] + [
+        UpdateOne({"_id": store_counter_id(group['_id'])}, {"$set": {"new_orders": group['new_orders']}}, upsert=True)
+        for group in new_orders
+    ]
+    if member_updates:
+        await db.conversation_members.bulk_write(member_updates, ordered=False)
+    if counter_updates:
+        await db.counters.bulk_write(counter_updates, ordered=False)
+
+conversation_list = register_migration(5, "conversation_members: last message time")
+
+@conversation_list.step
+async def initialise_conversation_last_at():
+    # Newest message per conversation, hot or archived, for both members
+    latest = {}
+    for collection, field in (("messages", "$created_at"), ("messages_archive", "$last_at")):
+        async for group in db[collection].aggregate([
+            {"$match": {"conversation_id": {"$exists": True}}},
+            {"$group": {"_id": "$conversation_id", "last_at": {"$max": field}}}
+        ]):
+            if group['_id'] not in latest or group['last_at'] > latest[group['_id']]:
+                latest[group['_id']] = group['last_at']
+    updates = [
+        UpdateOne({"conversation_id": conversation_id, "user_id": user_id}, {"$max": {"last_at": last_at}}, upsert=True)
+        for conversation_id, last_at in latest.items()
+        for user_id in set(conversation_id.split(":"))
+    ]
+    if updates:
+        await db.conversation_members.bulk_write(updates, ordered=False)
+
+store_snapshots = register_migration(6, "products and services: store snapshot")
+
+# Snapshots are otherwise only filled in on read, so browse filters and
+# feed candidates on `store.*` skip older documents. One store lookup
+# serves all of its documents in the cache's lifetime.
+migration_store_snapshots = TTLCache(STORE_OWNER_CACHE_SIZE, 60)
+
+@store_snapshots.backfill("products", {"store": None}, {"store_id": 1})
+@store_snapshots.backfill("services", {"store": None}, {"store_id": 1})
+async def set_store_snapshot(doc):
+    snapshot = migration_store_snapshots.get(doc['store_id'])
+    if snapshot is None:
+        store = await db.stores.find_one({"id": doc['store_id']}, STORE_SNAPSHOT_PROJECTION)
+        # Documents of deleted stores are left to the catalogue cleanup
+        snapshot = store_snapshot(store) if store else {}
+        migration_store_snapshots.set(doc['store_id'], snapshot)
+    return {"$set": {"store": snapshot}} if snapshot else None
+
+unique_account_names = register_migration(7, "users: unique email and username")
+
+# One account per email and per username; they also serve login and the
+# availability check
+USER_UNIQUE_INDEXES = [
+    IndexModel([("email", ASCENDING)], unique=True),
+    IndexModel([("username", ASCENDING)], unique=True),
+]
+
+def deduplicated_account_name(field: str, value: str, user_id: str) -> str:
+    suffix = user_id.replace("-", "")[-6:]
+    if field == "email":
+        local, _, domain = value.partition("@")
+        return f"{local}+dup-{suffix}@{domain}"
+    return f"{value}_{suffix}"
+
+@unique_account_names.step
+async def deduplicate_account_names():
+    # Login only ever found the oldest account of a duplicated email, so the
+    # newer ones are renamed and logged for support to merge by hand
+    for field in ("email", "username"):
+        duplicates = await db.users.aggregate([
+            {"$sort": {"created_at": 1, "_id": 1}},
+            {"$group": {"_id": f"${field}", "ids": {"$push": "$id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ], allowDiskUse=True).to_list(None)
+        for group in duplicates:
+            for user_id in group['ids'][1:]:
+                renamed = deduplicated_account_name(field, group['_id'], user_id)
+                await db.users.update_one(
+                    {"id": user_id, field: group['_id']},
+                    {"$set": {field: renamed, "updated_at": datetime.now(timezone.utc)}}
+                )
+                logger.warning("Renamed duplicate %s %r of user %s to %r", field, group['_id'], user_id, renamed)
+    await db.users.create_indexes(USER_UNIQUE_INDEXES)
+
+async def applied_migration_versions() -> set:
+    applied = await db._migrations.find({"status": "applied"}, {"_id": 0, "version": 1}).to_list(None)
+    return {doc['version'] for doc in applied}
+
+async def pending_migrations() -> List[Migration]:
+    applied = await applied_migration_versions()
+    return [migration for migration in migrations if migration.version not in applied]
+
+async def acquire_migration_lock(owner: str) -> bool:
+    """Take the single-runner lock in `_migrations`, or renew it if `owner` already holds it"""
+    return await acquire_lease("lock", owner, MIGRATION_LOCK_SECONDS, collection=db._migrations)
+
+async def release_migration_lock(owner: str):
+    await db._migrations.delete_one({"_id": "lock", "owner": owner})
+
+def log_migration_progress(migration: Migration, backfill: Backfill, done: int, total: int):
+    logger.info("Migration %s (%s) %s: %d/%d", migration.version, migration.name, backfill.collection, done, total)
+
+async def run_migration(migration: Migration, owner: str, batch_size: int, pause: float, progress):
+    record = await db._migrations.find_one({"version": migration.version}) or {}
+    checkpoints = record.get("checkpoints", {})
+    await db._migrations.update_one(
+        {"version": migration.version},
+        {
+            "$set": {"name": migration.name, "status": "running"},
+            "$setOnInsert": {"started_at": datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+    
+    for index, backfill in enumerate(migration.backfills):
+        key = f"{index}-{backfill.collection}"
+        checkpoint = checkpoints.get(key, {})
+        last_id, done = checkpoint.get("last_id"), checkpoint.get("done", 0)
+        collection = db[backfill.collection]
+        
+        def remaining_query():
+            if last_id is None:
+                return backfill.query
+            return {"$and": [backfill.query, {"_id": {"$gt": last_id}}]}
+        
+        total = done + await collection.count_documents(remaining_query())
+        projection = {"_id": 1, **(backfill.projection or {})} if backfill.projection else None
+        while True:
+            batch = await collection.find(remaining_query(), projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            
+            operations = []
+            for doc in batch:
+                update = backfill.transform(doc)
+                if asyncio.iscoroutine(update):
+                    update = await update
+                if update:
+                    operations.append(UpdateOne({"_id": doc["_id"]}, update))
+            if operations:
+                await collection.bulk_write(operations, ordered=False)
+            
+            last_id = batch[-1]["_id"]
+            done += len(batch)
+            await db._migrations.update_one(
+                {"version": migration.version},
+                {"$set": {f"checkpoints.{key}": {"last_id": last_id, "done": done}}}
+            )
+            progress(migration, backfill, done, total)
+            if not await acquire_migration_lock(owner):
+                raise RuntimeError("Migration lock lost to another runner")
+            if pause:
+                await asyncio.sleep(pause)
+    
+    for operation in migration.steps:
+        await operation()
+    
+    await db._migrations.update_one(
+        {"version": migration.version},
+        {"$set": {"status": "applied", "applied_at": datetime.now(timezone.utc)}}
+    )
+
+async def apply_migrations(target: Optional[int] = None, batch_size: int = MIGRATION_BATCH_SIZE,
+                           pause: float = MIGRATION_BATCH_PAUSE_MS / 1000, progress=log_migration_progress) -> List[Migration]:
+    """Apply pending migrations up to `target` in version order, holding the runner lock"""
+    owner = new_id()
+    if not await acquire_migration_lock(owner):
+        raise RuntimeError("Another migration runner holds the lock")
+    applied = []
+    try:
+        for migration in await pending_migrations():
+            if target is not None and migration.version > target:
+                break
+            logger.info("Applying migration %s: %s", migration.version, migration.name)
+            await run_migration(migration, owner, batch_size, pause, progress)
+            applied.append(migration)
+    finally:
+        await release_migration_lock(owner)
+    return applied
+
 # ==========================
 # ROOT ROUTE
 # ==========================
@@ -939,9 +4436,44 @@ async def upload_image(file: UploadFile = File(...), current_user: User = Depend
 async def root():
     return {"message": "Boral API - منصة بورال"}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))):
+    # Served on the public app, so only to the scraper holding METRICS_TOKEN
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not credentials or not hmac.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="غير مصرح", headers={"WWW-Authenticate": "Bearer"})
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready", include_in_schema=False)
+async def readiness():
+    """Readiness probe: 503 until warm_up() has finished, so rolling deploys only route to warm workers"""
+    if not getattr(app.state, "ready", False):
+        pending = getattr(app.state, "pending_migrations", [])
+        if pending:
+            return JSONResponse(status_code=503, content={"status": "migrations_pending", "pending_migrations": pending})
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready", "startup_seconds": startup_timings}
+
+@app.exception_handler(PyMongoError)
+async def mongo_error_handler(request, exc: PyMongoError):
+    if exc.timeout:
+        # Pool exhausted, server selection or the request's time budget ran out
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "الخدمة مشغولة حاليًا، يرجى المحاولة لاحقًا"},
+            headers={"Retry-After": "1"}
+        )
+    raise exc
+
 # Include router
 app.include_router(api_router)
 
+# Rate limiting and admission control (added before CORS so 429/503
+# responses still carry CORS headers)
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(AdmissionControlMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -949,8 +4481,12 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# Metrics (outermost, so rate-limited and CORS responses are counted too)
+app.add_middleware(MetricsMiddleware)
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -958,6 +4494,142 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+async def log_slow_query_summaries():
+    while True:
+        await asyncio.sleep(SLOW_QUERY_LOG_INTERVAL_SECONDS)
+        slow_query_recorder.log_summary()
+
+# ==========================
+# STARTUP
+# ==========================
+
+# startup() runs before the first request is accepted and never waits on
+# Mongo. warm_up() continues in the background, retrying while Mongo is
+# unreachable: it creates the collections and indexes, applies or waits for
+# migrations, then flips /ready once the Mongo pool, the account name filter
+# and the WARMUP_PATHS routes (their indexes, serializers and facet caches)
+# are warm. Timings are measured from the top of this module, so
+# `python backend_benchmark.py startup` can hold import-to-ready to a budget.
+
+async def check_migrations() -> List[Migration]:
+    """Apply pending migrations if MIGRATE_ON_STARTUP is set; return those still pending"""
+    pending = await pending_migrations()
+    if pending and MIGRATE_ON_STARTUP:
+        try:
+            await apply_migrations()
+        except RuntimeError as exc:
+            # Another worker is applying them
+            logger.info("Not applying migrations: %s", exc)
+        pending = await pending_migrations()
+    return pending
+
+async def warm_request(path: str) -> int:
+    """Status of an in-process GET through the whole middleware stack"""
+    path, _, query_string = path.partition("?")
+    statuses = []
+    
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+    
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query_string.encode(), "root_path": "",
+        "headers": [], "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80),
+    }
+    try:
+        await app(scope, receive, send)
+    except PyMongoError:
+        raise
+    except Exception:
+        # A broken route shouldn't keep the worker out of rotation
+        logger.exception("Warm-up request to %s failed", path)
+        return 500
+    return statuses[0]
+
+async def warm_up():
+    """Warm the worker, retrying with backoff while Mongo is unreachable, then report it ready"""
+    started = time.perf_counter()
+    delay = 1
+    schema_ready = False
+    while True:
+        try:
+            # Concurrent pings check out separate connections, opening the pool up to minPoolSize
+            await asyncio.gather(*(
+                client.admin.command("ping") for _ in range(max(1, MONGO_CLIENT_OPTIONS["minPoolSize"]))
+            ))
+            if not schema_ready:
+                await ensure_message_archive()
+                await ensure_indexes()
+                schema_ready = True
+            # Routes read documents in the migrated shape only
+            app.state.pending_migrations = [migration.version for migration in await check_migrations()]
+            if app.state.pending_migrations:
+                logger.warning(
+                    "Not ready: migrations %s pending%s; retrying in %ss",
+                    ", ".join(map(str, app.state.pending_migrations)),
+                    "" if MIGRATE_ON_STARTUP else "; run `python backend_migrate.py apply`", delay
+                )
+            else:
+                if USER_FILTER_REFRESH_SECONDS and account_names.filter is None:
+                    await account_names.load()
+                statuses = [await warm_request(path) for path in WARMUP_PATHS]
+                if 503 not in statuses:
+                    break
+                logger.warning("Warm-up requests timed out; retrying in %ss", delay)
+        except PyMongoError as exc:
+            logger.warning("Warm-up waiting for Mongo (%s); retrying in %ss", exc, delay)
+        except Exception:
+            logger.exception("Warm-up failed; retrying in %ss", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+    
+    # The first login would load and self-test the bcrypt backend, the first
+    # /docs visit would build every model's JSON schema
+    pwd_context.handler("bcrypt").get_backend()
+    app.openapi()
+    
+    startup_timings["warm_up"] = time.perf_counter() - started
+    startup_timings["ready"] = time.perf_counter() - IMPORT_STARTED
+    for phase, seconds in startup_timings.items():
+        metrics.set("boral_startup_seconds", (("phase", phase),), seconds)
+    app.state.ready = True
+    logger.info(
+        "Ready %.2fs after import (%s)", startup_timings["ready"],
+        ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items() if phase != "ready")
+    )
+
+metrics.describe("boral_startup_seconds", "gauge", "Worker startup time by phase; ready is import to ready.")
+
+async def startup():
+    started = time.perf_counter()
+    app.state.ready = False
+    app.state.pending_migrations = []
+    await job_runner.start()
+    await order_event_broker.start()
+    slow_query_recorder.loop = asyncio.get_running_loop()
+    
+    background = {"slow_query_summary": log_slow_query_summaries()}
+    if MESSAGE_HOT_DAYS:
+        background["message_archive"] = archive_messages_periodically()
+    if USER_FILTER_REFRESH_SECONDS:
+        background["account_names"] = maintain_account_names()
+    if FEED_REFRESH_SECONDS:
+        background["feed_candidates"] = maintain_feed_candidates()
+    if SIMILAR_REFRESH_SECONDS:
+        background["similar_products"] = maintain_similar_products()
+    background["warm_up"] = warm_up()
+    app.state.background_tasks = [asyncio.create_task(coro, name=name) for name, coro in background.items()]
+    startup_timings["startup"] = time.perf_counter() - started
+
+async def shutdown():
+    for task in app.state.background_tasks:
+        task.cancel()
+    await order_event_broker.stop()
+    await job_runner.stop()
     client.close()
+
+startup_timings = {"import": time.perf_counter() - IMPORT_STARTED}
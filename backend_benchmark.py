@@ -0,0 +1,806 @@
+#!/usr/bin/env python3
+"""
+Performance Benchmarks for Boral Backend
+Runs the FastAPI app in-process over ASGI, no deployment or network required
+
+Usage:
+    python backend_benchmark.py load --mongo-url mongodb://localhost:27017 --scale full
+    python backend_benchmark.py load --in-memory --save-baseline baseline.json
+    python backend_benchmark.py load --in-memory --baseline baseline.json
+    python backend_benchmark.py micro
+    python backend_benchmark.py overload --load-factor 2
+    python backend_benchmark.py similar --likes 1000000
+    python backend_benchmark.py startup --in-memory --max-seconds 5
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+# Rate limits would throttle the benchmark's own traffic
+for group in ("AUTH", "SEARCH", "UPLOAD", "DEFAULT"):
+    os.environ[f"RATE_LIMIT_{group}"] = ""
+# Archival would move the seeded history out from under the benchmark
+os.environ['MESSAGE_HOT_DAYS'] = "0"
+# ...and the similar-products and feed builds would compete with it for the database
+os.environ['SIMILAR_REFRESH_SECONDS'] = "0"
+os.environ['FEED_REFRESH_SECONDS'] = "0"
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'boral_benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import httpx  # noqa: E402
+
+# Imported in main() once MONGO_URL reflects --mongo-url
+server = None
+
+# Dataset sizes: stores, products, services, users, messages, orders
+SCALES = {
+    "small": {"stores": 200, "products": 5000, "services": 1000, "users": 500, "messages": 20000, "orders": 2000},
+    "medium": {"stores": 2000, "products": 100000, "services": 10000, "users": 5000, "messages": 1000000, "orders": 50000},
+    "full": {"stores": 10000, "products": 1000000, "services": 50000, "users": 20000, "messages": 10000000, "orders": 200000},
+}
+
+BENCHMARK_PASSWORD = "BenchPass123!"
+SEED_BATCH_SIZE = 10000
+
+ARABIC_WORDS = [
+    "متجر", "الأمل", "النور", "السلام", "الرياض", "جدة", "مكة", "قهوة", "عطور", "ملابس", "هواتف", "إلكترونيات",
+    "مطعم", "حلويات", "تمور", "عسل", "كتب", "ألعاب", "أثاث", "ساعات", "نظارات", "أحذية", "حقائب", "مخبز",
+    "صيدلية", "ورود", "هدايا", "رياضة", "سيارات", "صيانة", "تصميم", "جديد", "أصلي", "فاخر", "مميز", "سريع",
+]
+CATEGORIES = ["مطاعم", "إلكترونيات", "ملابس", "عطور", "مقاهي", "خدمات", "صيانة", "هدايا"]
+SEARCH_TERMS = ["قهوة", "عطور", "هواتف", "الرياض", "حلويات", "صيانة", "فاخر"]
+
+
+def print_header(title):
+    print(f"\n=== {title} ===")
+
+
+def arabic_text(rng, words):
+    return " ".join(rng.choice(ARABIC_WORDS) for _ in range(words))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# ==========================
+# DATASET
+# ==========================
+
+async def insert_batched(collection, make_doc, count, label):
+    """Insert `count` generated documents in batches, reporting progress"""
+    start = time.perf_counter()
+    for offset in range(0, count, SEED_BATCH_SIZE):
+        batch = [make_doc(i) for i in range(offset, min(count, offset + SEED_BATCH_SIZE))]
+        await collection.insert_many(batch, ordered=False)
+        done = offset + len(batch)
+        if done % (SEED_BATCH_SIZE * 10) == 0 or done == count:
+            print(f"   {label}: {done}/{count} ({time.perf_counter() - start:.1f}s)")
+
+
+async def seed_dataset(db, sizes, seed=42):
+    """Seed a realistic dataset and return the ids the traffic mix needs"""
+    print_header("Seeding Dataset")
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    password_hash = server.get_password_hash(BENCHMARK_PASSWORD)
+
+    for name in ("users", "stores", "products", "services", "messages", "orders", "reviews"):
+        await db[name].drop()
+
+    def created_at(i):
+        return now - timedelta(minutes=i)
+
+    # Ids carry the same timestamp as created_at, as if minted at the time
+    def new_id(i):
+        return server.new_id(now - timedelta(minutes=i))
+
+    user_ids = [new_id(i) for i in range(sizes["users"])]
+    store_ids = [new_id(i) for i in range(sizes["stores"])]
+    product_ids = [new_id(i) for i in range(sizes["products"])]
+
+    await insert_batched(db.users, lambda i: {
+        "id": user_ids[i],
+        "username": f"user{i}",
+        "email": f"user{i}@bench.example.com",
+        "full_name": arabic_text(rng, 2),
+        "phone": None,
+        "avatar": None,
+        "is_store_owner": i < len(store_ids),
+        "created_at": created_at(i),
+        "password_hash": password_hash,
+    }, sizes["users"], "users")
+
+    stores = [{
+        "id": store_ids[i],
+        "owner_id": user_ids[i % len(user_ids)],
+        "name": arabic_text(rng, 2),
+        "description": arabic_text(rng, 12),
+        "category": rng.choice(CATEGORIES),
+        "address": arabic_text(rng, 3),
+        "latitude": 24.7 + rng.uniform(-0.3, 0.3),
+        "longitude": 46.7 + rng.uniform(-0.3, 0.3),
+        "rating": round(rng.uniform(1, 5), 1),
+        "reviews_count": rng.randint(0, 200),
+        "created_at": created_at(i),
+        "updated_at": created_at(i),
+    } for i in range(sizes["stores"])]
+    await insert_batched(db.stores, lambda i: stores[i], sizes["stores"], "stores")
+    snapshots = [server.store_snapshot(store) for store in stores]
+
+    await insert_batched(db.products, lambda i: {
+        "id": product_ids[i],
+        "store_id": store_ids[i % len(store_ids)],
+        "store": snapshots[i % len(store_ids)],
+        "name": arabic_text(rng, 3),
+        "description": arabic_text(rng, 15),
+        "price": round(rng.uniform(5, 2000), 2),
+        "images": [],
+        "stock": rng.randint(0, 500),
+        "category": rng.choice(CATEGORIES),
+        "likes": rng.randint(0, 1000),
+        "liked_by": [],
+        "created_at": created_at(i),
+        "updated_at": created_at(i),
+    }, sizes["products"], "products")
+
+    await insert_batched(db.services, lambda i: {
+        "id": new_id(i),
+        "store_id": store_ids[i % len(store_ids)],
+        "store": snapshots[i % len(store_ids)],
+        "name": arabic_text(rng, 2),
+        "description": arabic_text(rng, 10),
+        "price": round(rng.uniform(20, 500), 2),
+        "duration": "ساعة",
+        "category": rng.choice(CATEGORIES),
+        "image": None,
+        "created_at": created_at(i),
+    }, sizes["services"], "services")
+
+    # Messages cluster into conversations between a user and a handful of partners
+    def make_message(i):
+        sender = rng.randrange(len(user_ids))
+        receiver = (sender + rng.randint(1, 5)) % len(user_ids)
+        return {
+            "id": new_id(i),
+            "conversation_id": server.conversation_key(user_ids[sender], user_ids[receiver]),
+            "sender_id": user_ids[sender],
+            "receiver_id": user_ids[receiver],
+            "content": arabic_text(rng, 8),
+            "is_read": rng.random() < 0.8,
+            "created_at": created_at(i),
+        }
+    await insert_batched(db.messages, make_message, sizes["messages"], "messages")
+
+    def make_order(i):
+        quantity = rng.randint(1, 3)
+        price = round(rng.uniform(5, 500), 2)
+        return {
+            "id": new_id(i),
+            "store_id": store_ids[i % len(store_ids)],
+            "user_id": user_ids[rng.randrange(len(user_ids))],
+            "items": [{"product_id": product_ids[rng.randrange(len(product_ids))], "service_id": None,
+                       "quantity": quantity, "price": price, "name": arabic_text(rng, 2)}],
+            "total": round(price * quantity, 2),
+            "notes": None,
+            "order_status": rng.choice(list(server.ORDER_TRANSITIONS)),
+            "status_history": [],
+            "created_at": created_at(i),
+        }
+    await insert_batched(db.orders, make_order, sizes["orders"], "orders")
+
+    products = [(product_id, store_ids[i % len(store_ids)]) for i, product_id in enumerate(product_ids)]
+    return {"user_ids": user_ids, "store_ids": store_ids, "products": products}
+
+
+async def load_dataset_ids(db):
+    """Reuse a previously seeded dataset"""
+    users = await db.users.find({}, {"_id": 0, "id": 1}).to_list(None)
+    stores = await db.stores.find({}, {"_id": 0, "id": 1}).to_list(None)
+    products = await db.products.find({}, {"_id": 0, "id": 1, "store_id": 1}).limit(100000).to_list(None)
+    return {
+        "user_ids": [u["id"] for u in users],
+        "store_ids": [s["id"] for s in stores],
+        "products": [(p["id"], p["store_id"]) for p in products],
+    }
+
+
+# ==========================
+# TRAFFIC MIX
+# ==========================
+
+class TrafficMix:
+    """Weighted scenarios approximating production traffic"""
+
+    def __init__(self, dataset, seed=7):
+        self.rng = random.Random(seed)
+        self.data = dataset
+        self.tokens = {}
+        self.scenarios = [
+            # (name, weight, route template used for DB op attribution, callable)
+            ("browse_stores", 20, "/api/stores", self.browse_stores),
+            ("store_details", 15, "/api/stores/{store_id}", self.store_details),
+            ("store_products", 15, "/api/stores/{store_id}/products", self.store_products),
+            ("popular_products", 5, "/api/analytics/popular-products", self.popular_products),
+            ("search", 10, "/api/search", self.search),
+            ("chat_poll", 20, "/api/messages/{user_id}", self.chat_poll),
+            ("conversations", 5, "/api/messages/conversations", self.conversations),
+            ("login", 3, "/api/auth/login", self.login),
+            ("order", 7, "/api/orders", self.order),
+        ]
+        self.weights = [weight for _, weight, _, _ in self.scenarios]
+
+    def pick(self):
+        return self.rng.choices(self.scenarios, weights=self.weights)[0]
+
+    def auth(self, user_id):
+        token = self.tokens.get(user_id)
+        if token is None:
+            token = self.tokens[user_id] = server.create_access_token({"sub": user_id})
+        return {"Authorization": f"Bearer {token}"}
+
+    def any_user(self):
+        return self.rng.choice(self.data["user_ids"])
+
+    def any_store(self):
+        return self.rng.choice(self.data["store_ids"])
+
+    async def browse_stores(self, client):
+        params = {"category": self.rng.choice(CATEGORIES)} if self.rng.random() < 0.5 else {}
+        return await client.get("/api/stores", params=params)
+
+    async def store_details(self, client):
+        return await client.get(f"/api/stores/{self.any_store()}")
+
+    async def store_products(self, client):
+        return await client.get(f"/api/stores/{self.any_store()}/products")
+
+    async def popular_products(self, client):
+        return await client.get("/api/analytics/popular-products")
+
+    async def search(self, client):
+        return await client.get("/api/search", params={"q": self.rng.choice(SEARCH_TERMS)})
+
+    async def chat_poll(self, client):
+        # Poll one of the partners the dataset gave this user a conversation with
+        users = self.data["user_ids"]
+        index = self.rng.randrange(len(users))
+        partner = users[(index + self.rng.randint(1, 5)) % len(users)]
+        return await client.get(f"/api/messages/{partner}", headers=self.auth(users[index]))
+
+    async def conversations(self, client):
+        return await client.get("/api/messages/conversations", headers=self.auth(self.any_user()))
+
+    async def login(self, client):
+        index = self.rng.randrange(len(self.data["user_ids"]))
+        return await client.post("/api/auth/login", json={
+            "email": f"user{index}@bench.example.com", "password": BENCHMARK_PASSWORD
+        })
+
+    async def order(self, client):
+        product_id, store_id = self.rng.choice(self.data["products"])
+        return await client.post("/api/orders", headers=self.auth(self.any_user()), json={
+            "store_id": store_id, "items": [{"product_id": product_id, "quantity": 1}]
+        })
+
+
+async def run_traffic(app, mix, concurrency, duration=None, total_requests=None):
+    """Replay the traffic mix with `concurrency` workers; return per-scenario samples"""
+    samples = {name: [] for name, _, _, _ in mix.scenarios}
+    statuses = {name: {} for name, _, _, _ in mix.scenarios}
+    issued = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker(client):
+        nonlocal issued
+        while True:
+            if deadline and time.perf_counter() >= deadline:
+                return
+            if total_requests and issued >= total_requests:
+                return
+            issued += 1
+            name, _, _, scenario = mix.pick()
+            start = time.perf_counter()
+            response = await scenario(client)
+            samples[name].append(time.perf_counter() - start)
+            statuses[name][response.status_code] = statuses[name].get(response.status_code, 0) + 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return samples, statuses, elapsed
+
+
+def db_ops_by_route(before, after):
+    """Mongo commands and HTTP requests per route between two metric snapshots"""
+    commands, requests_count = {}, {}
+    for (name, labels), value in after.items():
+        delta = value - before.get((name, labels), 0)
+        route = dict(labels).get("route")
+        if name == "boral_mongo_commands_total":
+            commands[route] = commands.get(route, 0) + delta
+        elif name == "boral_http_requests_total":
+            requests_count[route] = requests_count.get(route, 0) + delta
+    return {route: commands.get(route, 0) / count for route, count in requests_count.items() if count}
+
+
+def summarize(mix, samples, statuses, elapsed, db_ops):
+    results = {"elapsed_seconds": round(elapsed, 2), "routes": {}}
+    total = 0
+    for name, _, route, _ in mix.scenarios:
+        latencies = sorted(samples[name])
+        total += len(latencies)
+        results["routes"][name] = {
+            "route": route,
+            "requests": len(latencies),
+            "req_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "db_ops_per_request": round(db_ops[route], 2) if route in db_ops else None,
+            "statuses": {str(code): count for code, count in sorted(statuses[name].items())},
+        }
+    results["total_requests"] = total
+    results["req_per_sec"] = round(total / elapsed, 1) if elapsed else 0
+    return results
+
+
+def print_results(results):
+    print_header("Results")
+    print(f"{'scenario':<18}{'reqs':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db ops':>8}  statuses")
+    for name, row in results["routes"].items():
+        db_ops = "n/a" if row["db_ops_per_request"] is None else f"{row['db_ops_per_request']:.1f}"
+        print(f"{name:<18}{row['requests']:>7}{row['req_per_sec']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}"
+              f"{row['p99_ms']:>9}{db_ops:>8}  {row['statuses']}")
+    print(f"\nTotal: {results['total_requests']} requests in {results['elapsed_seconds']}s "
+          f"({results['req_per_sec']} req/s)")
+
+
+def compare_to_baseline(results, baseline, threshold, min_samples=20):
+    """Print deltas against a baseline; return the list of regressions
+
+    Throughput is compared for the whole mix (per-route rates only follow the
+    weights); latency percentiles per route with enough samples.
+    """
+    print_header("Comparison With Baseline")
+    checks = [("overall", "req_per_sec", results["req_per_sec"], baseline.get("req_per_sec"), False)]
+    for name, row in results["routes"].items():
+        base = baseline.get("routes", {}).get(name)
+        if not base or min(row["requests"], base["requests"]) < min_samples:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            checks.append((name, metric, row[metric], base[metric], True))
+
+    regressions = []
+    for name, metric, value, base_value, higher_is_worse in checks:
+        if not base_value:
+            continue
+        change = (value - base_value) / base_value
+        worse = change > threshold if higher_is_worse else change < -threshold
+        marker = "❌" if worse else "✅"
+        print(f"{marker} {name:<18}{metric:<12}{base_value:>10} -> {value:<10} ({change:+.0%})")
+        if worse:
+            regressions.append((name, metric, change))
+    return regressions
+
+
+# ==========================
+# HARNESS
+# ==========================
+
+def use_in_memory_database():
+    """Point the app at mongomock-motor (optional dependency, small scales only)"""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("❌ --in-memory needs mongomock-motor: pip install mongomock-motor")
+    server.client = AsyncMongoMockClient()
+    server.db = server.db_read = server.client[os.environ['DB_NAME']]
+    print("Using in-memory Mongo stand-in (command monitoring unavailable: db ops shown as n/a)")
+
+
+async def run_load(args):
+    if args.in_memory:
+        use_in_memory_database()
+        # mongomock rejects the archive's storage options; create it plainly
+        await server.db.create_collection("messages_archive")
+    sizes = dict(SCALES[args.scale])
+
+    async with server.app.router.lifespan_context(server.app):
+        # Let the warm-up finish before seeding drops the collections under it
+        await wait_until_ready()
+        if args.skip_seed:
+            dataset = await load_dataset_ids(server.db)
+        else:
+            dataset = await seed_dataset(server.db, sizes)
+            # Seeding drops the collections, and their indexes with them
+            await server.ensure_indexes()
+        mix = TrafficMix(dataset)
+
+        print_header(f"Warm-up ({args.warmup} requests)")
+        await run_traffic(server.app, mix, args.concurrency, total_requests=args.warmup)
+
+        print_header(f"Load ({args.concurrency} concurrent clients)")
+        before = server.metrics.snapshot()
+        samples, statuses, elapsed = await run_traffic(
+            server.app, mix, args.concurrency, duration=args.duration, total_requests=args.requests
+        )
+        # The in-memory stand-in emits no command events to count
+        db_ops = {} if args.in_memory else db_ops_by_route(before, server.metrics.snapshot())
+
+    results = summarize(mix, samples, statuses, elapsed, db_ops)
+    results["scale"] = args.scale
+    results["concurrency"] = args.concurrency
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n⚠️  {len(regressions)} regression(s) beyond {args.threshold:.0%}")
+            return 1
+        print("\n🎉 No regressions against baseline")
+    return 0
+
+
+async def bench_rate_limit_overhead(iterations=100000):
+    """Measure the per-request cost of the rate limiter on the hot path"""
+    print_header("Rate Limiter Overhead")
+
+    backend = server.MemoryRateLimitBackend()
+    limit = server.parse_rate_limit("1000000/1")
+    token = server.create_access_token({"sub": "benchmark-user"})
+    scope = {
+        "type": "http",
+        "path": "/api/stores",
+        "client": ("127.0.0.1", 12345),
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+    }
+    anonymous_scope = {**scope, "headers": []}
+
+    for label, request_scope in [("authenticated", scope), ("anonymous", anonymous_scope)]:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            identity = server.rate_limit_identity(request_scope)
+            await backend.take(f"default:{identity}", limit)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>14}: {elapsed / iterations * 1e6:.2f} µs/request")
+
+
+def bench_auth_overhead(iterations=20000):
+    """Per-request cost of verifying the bearer token, per JWT backend, with and without the claims cache"""
+    print_header("Auth Token Verification")
+
+    for name in ("jose", "pyjwt"):
+        if name == "pyjwt" and server.pyjwt is None:
+            print(f"{name:>6}: not installed")
+            continue
+        backend = server.jwt_backend(name)
+        token = backend.encode({"sub": "benchmark-user", "exp": int(time.time()) + 3600}, server.SECRET_KEY, None)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            backend.decode(token, server.SECRET_KEY)
+        uncached = (time.perf_counter() - start) / iterations
+
+        cache = server.VerifiedTokenCache(server.JWT_CACHE_SIZE)
+        cache.set(token, backend.decode(token, server.SECRET_KEY))
+        start = time.perf_counter()
+        for _ in range(iterations):
+            cache.get(token)
+        cached = (time.perf_counter() - start) / iterations
+        print(f"{name:>6}: {uncached * 1e6:8.2f} µs/request verified, {cached * 1e6:6.2f} µs/request cached")
+
+
+async def run_micro(args):
+    await bench_rate_limit_overhead()
+    bench_auth_overhead()
+    return 0
+
+
+# Request mix for the overload benchmark: (path, method, weight)
+OVERLOAD_MIX = [
+    ("/api/stores", "GET", 50),
+    ("/api/search", "GET", 25),
+    ("/api/analytics/popular-products", "GET", 5),
+    ("/api/auth/login", "POST", 10),
+    ("/api/orders", "POST", 10),
+]
+
+
+class SimulatedDatabase:
+    """A database with a fixed number of slots and a fixed service time.
+
+    Throughput is capped at slots / service_time; anything beyond that
+    queues, like a saturated Mongo connection pool. Callers past their
+    request deadline give up instead of queueing, as pymongo.timeout does.
+    """
+
+    def __init__(self, slots, service_time):
+        self.slots = asyncio.Semaphore(slots)
+        self.service_time = service_time
+        self.capacity = slots / service_time
+
+    async def query(self):
+        remaining = server.request_time_remaining()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), remaining)
+        except asyncio.TimeoutError:
+            return False
+        try:
+            await asyncio.sleep(self.service_time)
+        finally:
+            self.slots.release()
+        return True
+
+
+def simulated_app(database):
+    async def app(scope, receive, send):
+        status = 200 if await database.query() else 503
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+    return app
+
+
+async def asgi_status(app, method, path):
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [], "client": ("127.0.0.1", 0)}
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def open_loop(app, rate, duration, slo, seed=11):
+    """Send requests at a fixed arrival rate regardless of how fast they complete"""
+    rng = random.Random(seed)
+    paths, weights = [(path, method) for path, method, _ in OVERLOAD_MIX], [w for _, _, w in OVERLOAD_MIX]
+    outcomes = []
+
+    async def one(path, method):
+        start = time.perf_counter()
+        status = await asgi_status(app, method, path)
+        outcomes.append((path, status, time.perf_counter() - start))
+
+    tasks = []
+    start = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - start < duration:
+        due = int((time.perf_counter() - start) * rate) - sent
+        for _ in range(due):
+            path, method = rng.choices(paths, weights)[0]
+            tasks.append(asyncio.create_task(one(path, method)))
+        sent += max(due, 0)
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*tasks)
+
+    by_path = {}
+    for path, status, latency in outcomes:
+        entry = by_path.setdefault(path, {"sent": 0, "good": 0, "shed": 0, "late": 0})
+        entry["sent"] += 1
+        if status != 200:
+            entry["shed"] += 1
+        elif latency > slo:
+            entry["late"] += 1
+        else:
+            entry["good"] += 1
+    return by_path
+
+
+async def run_overload(args):
+    """Goodput under overload with and without admission control"""
+    database = SimulatedDatabase(args.db_slots, args.service_ms / 1000)
+    rate = database.capacity * args.load_factor
+    slo = args.slo_ms / 1000
+    print_header(f"Overload: {rate:.0f} req/s offered against {database.capacity:.0f} req/s capacity, SLO {args.slo_ms:.0f} ms")
+
+    controller = server.AdmissionController(
+        max_concurrent=args.db_slots * 4,
+        latency_target=slo / 4,
+        queue_wait={"critical": slo * 500, "normal": slo * 250, "low": 0},
+    )
+    deadlines = {"critical": args.slo_ms, "normal": args.slo_ms, "low": args.slo_ms / 2}
+    variants = [
+        ("without admission control", simulated_app(database)),
+        ("with admission control", server.AdmissionControlMiddleware(simulated_app(database), controller, deadlines)),
+    ]
+
+    for label, app in variants:
+        by_path = await open_loop(app, rate, args.duration, slo)
+        good = sum(entry["good"] for entry in by_path.values())
+        print(f"\n{label}: goodput {good / args.duration:.0f} req/s "
+              f"({good / database.capacity / args.duration:.0%} of capacity)")
+        print(f"{'path':<36} {'sent':>7} {'in SLO':>7} {'late':>7} {'503':>7}")
+        for path, _, _ in OVERLOAD_MIX:
+            entry = by_path.get(path, {"sent": 0, "good": 0, "late": 0, "shed": 0})
+            print(f"{path:<36} {entry['sent']:>7} {entry['good']:>7} {entry['late']:>7} {entry['shed']:>7}")
+    return 0
+
+
+def synthetic_likes(rng, n_likes, n_products, n_users):
+    """{product_id: [user_id, ...]} with Zipf-distributed product popularity and user activity"""
+    import numpy as np
+    products = (rng.zipf(1.3, n_likes * 2) - 1)
+    products = products[products < n_products][:n_likes]
+    users = (rng.zipf(1.5, len(products) * 2) - 1)
+    users = users[users < n_users][:len(products)]
+    products = products[:len(users)]
+    likes = {}
+    for product, user in zip(products.tolist(), users.tolist()):
+        likes.setdefault(f"p{product}", []).append(f"u{user}")
+    return likes
+
+
+async def run_similar(args):
+    """Build time of the similar-products index from a synthetic co-like matrix"""
+    import numpy as np
+    rng = np.random.default_rng(7)
+    likes = synthetic_likes(rng, args.likes, args.products, args.users)
+    n_likes = sum(len(users) for users in likes.values())
+    print_header(f"Similar products: {n_likes} likes, {len(likes)} products, k={server.SIMILAR_PRODUCTS_K}")
+
+    started = time.perf_counter()
+    matrix = server.CoLikeMatrix()
+    matrix.replace_likes(likes)
+    loaded = time.perf_counter()
+    neighbours = matrix.neighbours()
+    built = time.perf_counter()
+    print(f"load matrix        {(loaded - started) * 1000:>9.0f} ms")
+    print(f"full build         {(built - loaded) * 1000:>9.0f} ms  ({len(neighbours)} products)")
+
+    changed_ids = rng.choice(sorted(likes), size=min(args.changed, len(likes)), replace=False).tolist()
+    changed = {product_id: likes[product_id] + [f"u{rng.integers(args.users)}"] for product_id in changed_ids}
+    started = time.perf_counter()
+    rows = matrix.replace_likes(changed)
+    refreshed = matrix.neighbours(rows)
+    elapsed = time.perf_counter() - started
+    print(f"incremental        {elapsed * 1000:>9.0f} ms  ({len(changed)} changed, {len(refreshed)} recomputed)")
+    return 0
+
+
+async def wait_until_ready(timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not getattr(server.app.state, "ready", False):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"not ready after {timeout:.0f}s")
+        await asyncio.sleep(0.01)
+
+
+async def startup_child(args):
+    """One worker's startup, run in a fresh process so imports are cold; prints its timings as JSON"""
+    if args.in_memory:
+        use_in_memory_database()
+        await server.db.create_collection("messages_archive")
+    async with server.app.router.lifespan_context(server.app):
+        await wait_until_ready()
+    print(json.dumps(server.startup_timings))
+    return 0
+
+
+async def run_startup(args):
+    """Median import-to-ready time of fresh worker processes, checked against a budget and/or a baseline"""
+    if args.child:
+        return await startup_child(args)
+
+    command = [sys.executable, os.path.abspath(__file__), "startup", "--child"]
+    if args.in_memory:
+        command.append("--in-memory")
+    runs = []
+    for _ in range(args.runs):
+        child = subprocess.run(command, capture_output=True, text=True, timeout=120)
+        if child.returncode:
+            print(child.stderr[-2000:])
+            return 1
+        runs.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    results = {phase: statistics.median(run[phase] for run in runs) for phase in runs[0]}
+    print_header(f"Startup (median of {args.runs} fresh processes)")
+    for phase, seconds in results.items():
+        print(f"{phase:<10} {seconds * 1000:>8.0f} ms")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    failed = False
+    if args.max_seconds and results["ready"] > args.max_seconds:
+        print(f"\n⚠️  Ready after {results['ready']:.2f}s, budget is {args.max_seconds:.2f}s")
+        failed = True
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        change = results["ready"] / baseline["ready"] - 1
+        print(f"\nready {change:+.1%} against baseline")
+        if change > args.threshold:
+            print(f"⚠️  Startup regressed beyond {args.threshold:.0%}")
+            failed = True
+    if not failed and (args.max_seconds or args.baseline):
+        print("\n🎉 Startup within budget")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Boral backend benchmarks")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    load = subparsers.add_parser("load", help="seed a dataset and replay a weighted traffic mix")
+    load.add_argument("--mongo-url", help="Mongo to benchmark against (default: MONGO_URL)")
+    load.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of a real Mongo")
+    load.add_argument("--scale", choices=sorted(SCALES), default="small")
+    load.add_argument("--skip-seed", action="store_true", help="reuse the dataset from a previous run")
+    load.add_argument("--concurrency", type=int, default=20)
+    load.add_argument("--duration", type=float, default=30.0, help="seconds of measured load")
+    load.add_argument("--requests", type=int, help="stop after this many requests instead")
+    load.add_argument("--warmup", type=int, default=200)
+    load.add_argument("--baseline", help="JSON results file to compare against")
+    load.add_argument("--save-baseline", help="write results to this JSON file")
+    load.add_argument("--threshold", type=float, default=0.2, help="allowed regression before failing")
+
+    subparsers.add_parser("micro", help="micro-benchmarks of hot-path helpers")
+
+    overload = subparsers.add_parser("overload", help="goodput of admission control against a saturated database")
+    overload.add_argument("--load-factor", type=float, default=2.0, help="offered load as a multiple of capacity")
+    overload.add_argument("--db-slots", type=int, default=8)
+    overload.add_argument("--service-ms", type=float, default=20.0, help="simulated query time")
+    overload.add_argument("--slo-ms", type=float, default=2000.0, help="client timeout counted as failure")
+    overload.add_argument("--duration", type=float, default=10.0)
+
+    similar = subparsers.add_parser("similar", help="build time of the similar-products index")
+    similar.add_argument("--likes", type=int, default=1000000)
+    similar.add_argument("--products", type=int, default=100000)
+    similar.add_argument("--users", type=int, default=50000)
+    similar.add_argument("--changed", type=int, default=1000, help="products touched before the incremental refresh")
+
+    startup = subparsers.add_parser("startup", help="import-to-ready time of a fresh worker process")
+    startup.add_argument("--mongo-url", help="Mongo to start against (default: MONGO_URL)")
+    startup.add_argument("--in-memory", action="store_true", help="use mongomock-motor instead of a real Mongo")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--max-seconds", type=float, help="fail if the median import-to-ready exceeds this")
+    startup.add_argument("--baseline", help="JSON results file to compare against")
+    startup.add_argument("--save-baseline", help="write results to this JSON file")
+    startup.add_argument("--threshold", type=float, default=0.2, help="allowed regression before failing")
+    startup.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if getattr(args, "mongo_url", None):
+        os.environ['MONGO_URL'] = args.mongo_url
+
+    global server
+    import server
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    runner = {"load": run_load, "micro": run_micro, "overload": run_overload, "similar": run_similar,
+              "startup": run_startup}[args.suite]
+    sys.exit(asyncio.run(runner(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Schema migrations for Boral Backend
+Applies the versioned migrations registered in server.py and records them in `_migrations`
+
+Usage:
+    python backend_migrate.py status
+    python backend_migrate.py apply
+    python backend_migrate.py apply --to 1 --batch-size 500 --pause-ms 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+# Imported in main() once MONGO_URL reflects --mongo-url
+server = None
+
+
+async def show_status(args):
+    applied = await server.applied_migration_versions()
+    records = {doc['version']: doc for doc in await server.db._migrations.find({"version": {"$exists": True}}).to_list(None)}
+    for migration in server.migrations:
+        record = records.get(migration.version, {})
+        if migration.version in applied:
+            state = f"✅ applied {record['applied_at']:%Y-%m-%d %H:%M}"
+        elif record.get("status") == "running":
+            done = sum(checkpoint.get("done", 0) for checkpoint in record.get("checkpoints", {}).values())
+            state = f"⏸️  interrupted after {done} documents"
+        else:
+            state = "⏳ pending"
+        print(f"{migration.version:>4}  {migration.name:<40} {state}")
+    return 0
+
+
+async def apply(args):
+    started = time.perf_counter()
+    last_report = {}
+
+    def progress(migration, backfill, done, total):
+        # One line per backfill, updated in place
+        key = (migration.version, backfill.collection)
+        if last_report.get(key) != done:
+            last_report[key] = done
+            percent = done / total if total else 1
+            end = "\n" if done >= total else ""
+            print(f"\r  {migration.version} {backfill.collection:<10} {done:>10}/{total:<10} {percent:>6.1%}", end=end, flush=True)
+
+    try:
+        applied = await server.apply_migrations(
+            target=args.to, batch_size=args.batch_size, pause=args.pause_ms / 1000, progress=progress
+        )
+    except RuntimeError as exc:
+        print(f"\n❌ {exc}")
+        return 1
+
+    if not applied:
+        print("✅ Nothing to apply")
+    else:
+        print(f"✅ Applied {', '.join(str(m.version) for m in applied)} in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Boral schema migrations")
+    parser.add_argument("--mongo-url", help="Mongo to migrate (default: MONGO_URL)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("status", help="list migrations and whether they are applied")
+
+    apply_parser = subparsers.add_parser("apply", help="apply pending migrations in order")
+    apply_parser.add_argument("--to", type=int, help="stop after this version")
+    apply_parser.add_argument("--batch-size", type=int, help="documents per bulk_write")
+    apply_parser.add_argument("--pause-ms", type=float, help="pause between batches")
+
+    args = parser.parse_args()
+    if args.mongo_url:
+        os.environ['MONGO_URL'] = args.mongo_url
+
+    global server
+    import server
+    if args.command == "apply":
+        args.batch_size = args.batch_size or server.MIGRATION_BATCH_SIZE
+        args.pause_ms = server.MIGRATION_BATCH_PAUSE_MS if args.pause_ms is None else args.pause_ms
+
+    runner = {"status": show_status, "apply": apply}[args.command]
+    sys.exit(asyncio.run(runner(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ import BottomNavigation from '../components/BottomNavigation';
 import LoginPrompt from '../components/LoginPrompt';
 import { FaComments, FaPaperPlane, FaStore, FaBox, FaArrowRight, FaSearch, FaCircle } from 'react-icons/fa';
 
+// Matches MESSAGE_PAGE_SIZE on the backend
+const MESSAGE_PAGE_SIZE = 50;
+
 const Messages = () => {
   const { isAuthenticated, user } = useAuth();
   const [searchParams] = useSearchParams();
@@ -22,7 +25,13 @@ const Messages = () => {
   const [loading, setLoading] = useState(true);
   const [sending, setSending] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
+  const [hasOlder, setHasOlder] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const messagesEndRef = useRef(null);
+  const messagesContainerRef = useRef(null);
+  const newestMessageIdRef = useRef(null);
+  const messagesRef = useRef([]);
+  const restoreScrollRef = useRef(null);
 
   useEffect(() => {
     if (isAuthenticated) {
@@ -47,11 +56,27 @@ const Messages = () => {
   }, [selectedConversation]);
 
   useEffect(() => {
-    scrollToBottom();
+    messagesRef.current = messages;
+    const container = messagesContainerRef.current;
+    if (restoreScrollRef.current !== null && container) {
+      // Keep the view on the same message after older ones were prepended
+      container.scrollTop += container.scrollHeight - restoreScrollRef.current;
+      restoreScrollRef.current = null;
+      return;
+    }
+    // Only follow new messages; polling the same page must not yank the view down
+    const newestId = messages.length > 0 ? messages[messages.length - 1].id : null;
+    if (newestId !== newestMessageIdRef.current) {
+      // Jump straight to the bottom of a freshly opened conversation, so the
+      // scroll does not pass the top and trigger loading older messages
+      const appended = messages.some(msg => msg.id === newestMessageIdRef.current);
+      newestMessageIdRef.current = newestId;
+      scrollToBottom(appended ? 'smooth' : 'auto');
+    }
   }, [messages]);
 
-  const scrollToBottom = () => {
-    messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
+  const scrollToBottom = (behavior = 'smooth') => {
+    messagesEndRef.current?.scrollIntoView({ behavior });
   };
 
   const initializeConversationWithReceiver = async (ownerId, prodId) => {
@@ -98,13 +123,48 @@ const Messages = () => {
 
   const fetchMessages = async (userId) => {
     try {
-      const response = await axiosInstance.get(`/messages/${userId}`);
-      setMessages(response.data);
+      const response = await axiosInstance.get(`/messages/${userId}`, { params: { limit: MESSAGE_PAGE_SIZE } });
+      // The API returns the latest page newest-first; show it oldest-first
+      const latest = [...response.data].reverse();
+      // Keep older pages already loaded if the latest page still joins up with them
+      const previous = messagesRef.current;
+      const joinAt = latest.length > 0 ? previous.findIndex(msg => msg.id === latest[0].id) : -1;
+      if (joinAt > 0) {
+        setMessages([...previous.slice(0, joinAt), ...latest]);
+      } else {
+        setMessages(latest);
+        setHasOlder(latest.length === MESSAGE_PAGE_SIZE);
+      }
     } catch (error) {
       console.error('Error fetching messages:', error);
     }
   };
 
+  const fetchOlderMessages = async () => {
+    if (!selectedConversation || !hasOlder || loadingOlder || messages.length === 0) return;
+
+    setLoadingOlder(true);
+    try {
+      const response = await axiosInstance.get(`/messages/${selectedConversation.user.id}`, {
+        params: { before: messages[0].id, limit: MESSAGE_PAGE_SIZE }
+      });
+      const older = [...response.data].reverse();
+      restoreScrollRef.current = messagesContainerRef.current?.scrollHeight ?? null;
+      setMessages(previous => [...older, ...previous]);
+      setHasOlder(older.length === MESSAGE_PAGE_SIZE);
+    } catch (error) {
+      console.error('Error fetching older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
+  const handleMessagesScroll = (e) => {
+    if (e.currentTarget.scrollTop < 80) {
+      fetchOlderMessages();
+    }
+  };
+
   const sendMessage = async (e) => {
     e.preventDefault();
     if (!newMessage.trim() || !selectedConversation) return;
@@ -290,9 +350,18 @@ const Messages = () => {
                   )}
 
                   {/* Messages */}
-                  <div className="flex-1 overflow-y-auto p-4 bg-gray-50">
+                  <div
+                    ref={messagesContainerRef}
+                    onScroll={handleMessagesScroll}
+                    className="flex-1 overflow-y-auto p-4 bg-gray-50"
+                  >
                     {messages.length > 0 ? (
                       <div className="space-y-4">
+                        {loadingOlder && (
+                          <div className="flex justify-center">
+                            <div className="animate-spin rounded-full h-6 w-6 border-b-2 border-blue-600"></div>
+                          </div>
+                        )}
                         {messages.map((msg) => {
                           const isMyMessage = msg.sender_id === user.id;
                           return (
@@ -14,11 +14,22 @@ const ProductDetails = () => {
   const [store, setStore] = useState(null);
   const [loading, setLoading] = useState(true);
   const [selectedImageIndex, setSelectedImageIndex] = useState(0);
+  const [similarProducts, setSimilarProducts] = useState([]);
 
   useEffect(() => {
     fetchProductData();
+    fetchSimilarProducts();
   }, [id]);
 
+  const fetchSimilarProducts = async () => {
+    try {
+      const response = await axiosInstance.get(`/products/${id}/similar`, { params: { limit: 8 } });
+      setSimilarProducts(response.data);
+    } catch (error) {
+      console.error('Error fetching similar products:', error);
+    }
+  };
+
   const fetchProductData = async () => {
     try {
       // Get all stores to find the product
@@ -230,6 +241,37 @@ const ProductDetails = () => {
             </div>
           </div>
         </div>
+
+        {/* Similar Products */}
+        {similarProducts.length > 0 && (
+          <div className="mt-8">
+            <h2 className="text-2xl font-bold text-gray-900 mb-4">منتجات مشابهة</h2>
+            <div className="grid grid-cols-2 md:grid-cols-4 gap-4">
+              {similarProducts.map((similar) => (
+                <Link
+                  key={similar.id}
+                  to={`/products/${similar.id}`}
+                  className="bg-white rounded-lg shadow hover:shadow-lg transition overflow-hidden"
+                >
+                  <div className="h-32 bg-gray-200">
+                    {similar.images && similar.images.length > 0 ? (
+                      <img src={similar.images[0]} alt={similar.name} className="w-full h-full object-cover" />
+                    ) : (
+                      <div className="h-full flex items-center justify-center">
+                        <span className="text-gray-400 text-4xl">📦</span>
+                      </div>
+                    )}
+                  </div>
+                  <div className="p-3">
+                    <h3 className="font-semibold text-gray-900 truncate">{similar.name}</h3>
+                    <p className="text-blue-600 font-bold">{similar.price} ر.س</p>
+                    {similar.store && <p className="text-gray-500 text-sm truncate">{similar.store.name}</p>}
+                  </div>
+                </Link>
+              ))}
+            </div>
+          </div>
+        )}
       </div>
 
       <BottomNavigation />
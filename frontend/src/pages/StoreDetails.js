@@ -30,16 +30,27 @@ const StoreDetails = () => {
   const [loading, setLoading] = useState(true);
   const [activeTab, setActiveTab] = useState('products');
   const [selectedProduct, setSelectedProduct] = useState(null);
+  const [productSort, setProductSort] = useState('newest');
 
   useEffect(() => {
     fetchStoreData();
   }, [id]);
 
+  const handleProductSort = async (sort) => {
+    setProductSort(sort);
+    try {
+      const response = await axiosInstance.get(`/stores/${id}/products`, { params: { sort } });
+      setProducts(response.data);
+    } catch (error) {
+      console.error('Error sorting products:', error);
+    }
+  };
+
   const fetchStoreData = async () => {
     try {
       const [storeRes, productsRes, servicesRes, reviewsRes] = await Promise.all([
         axiosInstance.get(`/stores/${id}`),
-        axiosInstance.get(`/stores/${id}/products`),
+        axiosInstance.get(`/stores/${id}/products`, { params: { sort: productSort } }),
         axiosInstance.get(`/stores/${id}/services`),
         axiosInstance.get(`/stores/${id}/reviews`)
       ]);
@@ -273,6 +284,19 @@ const StoreDetails = () => {
           <div className="p-6">
             {activeTab === 'products' && (
               <div data-testid="products-section">
+                <div className="flex justify-end mb-4">
+                  <select
+                    value={productSort}
+                    onChange={(e) => handleProductSort(e.target.value)}
+                    className="border border-gray-300 rounded-lg px-3 py-2 text-sm"
+                    data-testid="products-sort"
+                  >
+                    <option value="newest">الأحدث</option>
+                    <option value="price_asc">السعر: من الأقل</option>
+                    <option value="price_desc">السعر: من الأعلى</option>
+                    <option value="likes">الأكثر إعجاباً</option>
+                  </select>
+                </div>
                 {products.length > 0 ? (
                   <div className="grid md:grid-cols-2 lg:grid-cols-3 gap-4">
                     {products.map((product) => (